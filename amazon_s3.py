@@ -1,4 +1,24 @@
-import configparser, boto3, botocore, os
+import configparser, boto3, botocore, os, shutil, hashlib, time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Ranged download settings
+PART_SIZE = 16 * 1024 * 1024
+CONCURRENCY = 8
+PART_RETRIES = 5
+CHUNK_SIZE = 256 * 1024
+
+
+def file_md5(path):
+	'''
+	Returns hex md5 of the file at given path.
+	'''
+
+	md5 = hashlib.md5()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+			md5.update(chunk)
+	return md5.hexdigest()
 
 
 class Amazon_S3(object):
@@ -36,14 +56,24 @@ class Amazon_S3(object):
 
 		return page_iterator
 
-	def download_file(self, key):
+	def download_file(self, key, md5=None, part_size=PART_SIZE, concurrency=CONCURRENCY, limiter=None):
 	    """
-	    Downloads given filename from source bucket to destination directory.
+	    Downloads given filename from source bucket to destination directory,
+	    fetching byte ranges concurrently into a preallocated file.
+	    Returns True on success, False if the key doesn't exist or fails verification.
 
 	    Parameters
 	    ----------
 	    key : str
 	        Name of file to download
+	    md5 : str
+	        Expected md5 of the file, e.g. from the manifest. Skips verification if None
+	    part_size : int
+	        Bytes per ranged GET
+	    concurrency : int
+	        Number of parts downloaded at once
+	    limiter : throttle.TokenBucket
+	        Bandwidth cap in bytes per second, shared across pool workers
 	    """
 
 	    # Ensure src directory exists 
@@ -51,23 +81,139 @@ class Amazon_S3(object):
 	        os.makedirs('src')
 	    
 	    print('Downloading s3://arxiv/{}'.format(key))
-	    
-	    # Download file
+	    size = self.get_size(key)
+	    if size is None:
+	        print('ERROR: ' + key + " does not exist in arxiv bucket")
+	        return False
+
+	    # Preallocate, so parts can be written into place as they arrive
+	    partial_path = key + '.part'
+	    with open(partial_path, 'wb') as f:
+	        f.truncate(size)
+
+	    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
 	    try:
-	        self.s3resource.meta.client.download_file(
-	            Bucket='arxiv', 
-	            Key=key,  # name of key to download from
-	            Filename=key,  # path to file to download to
-	            ExtraArgs={'RequestPayer':'requester'})
-	    except botocore.exceptions.ClientError as e:
-	        if e.response['Error']['Code'] == "404":
-	            print('ERROR: ' + key + " does not exist in arxiv bucket")
-	            
+	        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+	            for _ in executor.map(lambda byte_range: self.download_part(key, partial_path, byte_range, limiter), ranges):
+	                pass
+	    except Exception:
+	        os.remove(partial_path)
+	        raise
+
+	    if md5 and file_md5(partial_path) != md5:
+	        print('ERROR: s3://arxiv/{} failed md5 verification'.format(key))
+	        os.remove(partial_path)
+	        return False
+
+	    os.replace(partial_path, key)
 	    print('Successfully downloaded s3://arxiv/{} to {}'.format(key, key))
+	    return True
+
+
+	def get_size(self, key):
+		'''
+		Returns the size of the given key in bytes, or None if it doesn't exist.
+		'''
+
+		try:
+			return self.s3resource.meta.client.head_object(Bucket='arxiv', Key=key, RequestPayer='requester')['ContentLength']
+		except botocore.exceptions.ClientError as e:
+			if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+				return None
+			raise
+
+
+	def download_part(self, key, path, byte_range, limiter=None):
+	    """
+	    Downloads the inclusive (start, end) byte range of key into the same offsets of path,
+	    retrying just this part if it fails.
+	    """
+
+	    start, end = byte_range
+	    for attempt in range(PART_RETRIES):
+	        try:
+	            body = self.s3resource.meta.client.get_object(
+	                Bucket='arxiv',
+	                Key=key,
+	                RequestPayer='requester',
+	                Range='bytes={}-{}'.format(start, end))['Body']
+	            written = 0
+	            with open(path, 'r+b') as f:
+	                f.seek(start)
+	                for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+	                    if limiter:
+	                        limiter.consume(len(chunk))
+	                    f.write(chunk)
+	                    written += len(chunk)
+	            if written != end - start + 1:
+	                raise IOError('short read: got {} of {} bytes'.format(written, end - start + 1))
+	            return
+	        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, IOError) as e:
+	            if attempt == PART_RETRIES - 1:
+	                raise
+	            print('Retrying bytes {}-{} of s3://arxiv/{}: {}'.format(start, end, key, e))
+	            time.sleep(2 ** attempt)
+
+
+	def open_stream(self, key):
+		'''
+		Returns a file-like body for the given key, which reads the object
+		as it arrives instead of staging it on disk first.
+		Suitable for tarfile's stream mode, see utils.extract_stream.
+		'''
+
+		print('Streaming s3://arxiv/{}'.format(key))
+		response = self.s3resource.meta.client.get_object(
+			Bucket='arxiv',
+			Key=key,
+			RequestPayer='requester')
+		return response['Body']
 
 
 	def __init__(self):
 		self.setup()
+
+
+class LocalBucket(object):
+	'''
+	Stand-in for Amazon_S3 that serves keys from a local directory laid out
+	like the arxiv bucket (e.g. <root>/src/arXiv_src_0001_001.tar).
+	Useful for testing the pipeline without paying for requests.
+	'''
+
+	root = None
+
+	def get_page_iterator(self):
+		'''
+		Yields a single page of src/ keys, shaped like a list_objects_v2 page.
+		'''
+
+		src_dir = os.path.join(self.root, 'src')
+		contents = [{'Key': 'src/' + name, 'Size': os.path.getsize(os.path.join(src_dir, name))}
+			for name in sorted(os.listdir(src_dir))]
+		return iter([{'Contents': contents}])
+
+	def download_file(self, key, md5=None, **kwargs):
+		if not os.path.isdir('src'):
+			os.makedirs('src')
+		if not os.path.isfile(os.path.join(self.root, key)):
+			print('ERROR: ' + key + ' does not exist in ' + self.root)
+			return False
+		shutil.copyfile(os.path.join(self.root, key), key)
+		if md5 and file_md5(key) != md5:
+			os.remove(key)
+			return False
+		return True
+
+	def get_size(self, key):
+		path = os.path.join(self.root, key)
+		return os.path.getsize(path) if os.path.isfile(path) else None
+
+	def open_stream(self, key):
+		return open(os.path.join(self.root, key), 'rb')
+
+	def __init__(self, root):
+		self.root = root
 		
 
 
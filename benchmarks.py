@@ -0,0 +1,1052 @@
+'''
+Benchmarks for the hot paths of the download/convert/parse pipeline.
+Run e.g. `python benchmarks.py identifier_filter` from the command line.
+Fixtures are synthesized into a temporary directory unless stated otherwise;
+latexml_backends converts the submissions found in tests/fixtures.
+'''
+
+import sys
+import time
+import random
+import tarfile
+import tempfile
+import io
+import os
+
+
+def timed(fn, *args, **kwargs):
+    '''
+    Returns (result, seconds) for a single call of fn.
+    '''
+
+    starttime = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - starttime
+
+
+def make_identifiers(n, seed=0):
+    '''
+    Returns n synthetic astro-ph identifiers, mixing old and new styles.
+    '''
+
+    rng = random.Random(seed)
+    ids = []
+    for i in range(n):
+        yymm = '{:02d}{:02d}'.format(rng.randint(0, 18), rng.randint(1, 12))
+        if int(yymm) < 704:
+            ids.append('astro-ph{}{:03d}'.format(yymm, i % 1000))
+        else:
+            ids.append('{}.{:05d}'.format(yymm, i % 100000))
+    return ids
+
+
+def make_tar(path, member_ids):
+    '''
+    Writes a tar with one tiny .gz member per given id, laid out like the arxiv src tars.
+    '''
+
+    with tarfile.open(path, 'w') as tar:
+        for member_id in member_ids:
+            data = b'\\documentclass{article}'
+            info = tarfile.TarInfo(name='0001/' + member_id + '.gz')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def bench_identifier_filter(num_identifiers=200000, num_members=2000):
+    '''
+    Compares per-tar member filtering with the pandas substring scan
+    against the prebuilt IdentifierIndex.
+    '''
+
+    import pandas as pd
+    from identifier_index import IdentifierIndex
+
+    identifiers = make_identifiers(num_identifiers)
+    series = pd.Series(identifiers)
+    rng = random.Random(1)
+    member_ids = rng.sample(identifiers, num_members // 2) + make_identifiers(num_members // 2, seed=2)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tar_path = os.path.join(tmp, 'arXiv_src_0001_001.tar')
+        make_tar(tar_path, member_ids)
+
+        def scan(matches):
+            with tarfile.open(tar_path) as tar:
+                return sum(1 for submission in tar.getmembers()
+                           if matches(os.path.splitext(os.path.basename(submission.name))[0]))
+
+        old, old_seconds = timed(scan, lambda x: series.str.contains(x).any())
+        index, build_seconds = timed(IdentifierIndex, identifiers)
+        new, new_seconds = timed(scan, lambda x: x in index)
+
+    print('Members: {}, identifiers: {}'.format(num_members, num_identifiers))
+    print('pandas str.contains: {:.3f}s ({} matches)'.format(old_seconds, old))
+    print('IdentifierIndex:     {:.3f}s ({} matches), built once in {:.3f}s'.format(new_seconds, new, build_seconds))
+
+
+def bench_latexml_backends(fixture_dir='tests/fixtures', workers=2):
+    '''
+    Compares documents per minute of one-shot latexmlc against persistent
+    latexmls servers, converting every .tex/.zip submission in fixture_dir.
+    '''
+
+    import glob
+    import subprocess as sp
+    from concurrent.futures import ThreadPoolExecutor
+    import latexml
+    import utils
+
+    submissions = sorted(glob.glob(os.path.join(fixture_dir, '*.tex')) + glob.glob(os.path.join(fixture_dir, '*.zip')))
+    if not submissions:
+        print('No submissions found in ' + fixture_dir)
+        return
+
+    for backend in (latexml.OneShotBackend(), latexml.ServerBackend(workers)):
+        with tempfile.TemporaryDirectory() as tmp:
+            def run(submission):
+                slot = backend.acquire()
+                try:
+                    outpath = os.path.join(tmp, os.path.splitext(os.path.basename(submission))[0] + '.xml')
+                    return utils.run_latexmlc(backend.command(submission, outpath, slot), sp.DEVNULL)
+                finally:
+                    backend.release(slot)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                _, seconds = timed(lambda: list(executor.map(run, submissions)))
+        if isinstance(backend, latexml.ServerBackend):
+            backend.shutdown()
+        print('{:8s} {:.1f} documents/minute ({} documents in {:.1f}s)'.format(
+            backend.name, len(submissions) / seconds * 60, len(submissions), seconds))
+
+
+def make_latexml_xml(path, num_sections=20, paras_per_section=10, num_bibitems=50, seed=0, multi_key_rate=0.1):
+    '''
+    Writes a synthetic LaTeXML document with sections, math, figures, tables,
+    footnotes, errors and parenthetical, in-text and unresolved citations,
+    a multi_key_rate fraction of them citing two bibitems at once.
+    '''
+
+    rng = random.Random(seed)
+    words = 'the star galaxy mass of and in 12 halo dust x_1 disk we 2018 flux'.split()
+
+    def sentence():
+        return ' '.join(rng.choice(words) for _ in range(rng.randint(5, 15)))
+
+    def cite():
+        kind = rng.choice(['ltx_citemacro_citep', 'ltx_citemacro_citet', 'ltx_citemacro_cite', 'ltx_citemacro_citet'])
+        key = 'bib{}'.format(rng.randint(0, num_bibitems + 5))
+        if rng.random() < multi_key_rate:
+            key += ',bib{}'.format(rng.randint(0, num_bibitems))
+        return '<cite class="{}">(<bibref bibrefs="{}" separator="," yyseparator=","/>)</cite>'.format(kind, key)
+
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<?latexml class="aa"?>\n',
+             '<document xmlns="http://dlmf.nist.gov/LaTeXML"><title>A <Math tex="x">x</Math> title</title>\n']
+    for s in range(num_sections):
+        parts.append('<section xml:id="S{0}"><tags><tag>{0}</tag></tags><title>Section {0}</title>\n'.format(s))
+        for p in range(paras_per_section):
+            parts.append('<para xml:id="S{}.p{}"><p>{} {} <Math mode="inline" tex="M_\\odot"><XMath><XMTok name="odot">M</XMTok></XMath></Math> {}'.format(
+                s, p, sentence(), cite(), sentence()))
+            if rng.random() < 0.2:
+                parts.append('<note role="footnote"><tags><tag>1</tag></tags>{}</note>'.format(sentence()))
+            if rng.random() < 0.1:
+                parts.append(' <ERROR class="undefined">\\pcite</ERROR>')
+            parts.append(' {}.</p></para>\n<!-- comment -->\n'.format(sentence()))
+        if s % 3 == 0:
+            parts.append('<figure><graphics graphic="f.eps"/><caption>{}</caption><toccaption>x</toccaption></figure>\n'.format(sentence()))
+            parts.append('<table><tabular><tbody><tr><td>1</td></tr></tbody></tabular></table>\n')
+        parts.append('</section>\n')
+    parts.append('<bibliography><biblist>\n')
+    for b in range(num_bibitems):
+        refnum = '({})'.format(b) if b % 4 == 0 else 'Author{} et al. ({})'.format(b, 1990 + b % 30)
+        if b % 10 == 7:
+            parts.append('<bibitem key="bib{}"><bibblock>{}</bibblock></bibitem>\n'.format(b, sentence()))
+        else:
+            parts.append('<bibitem key="bib{}"><tags><tag role="refnum">{}</tag></tags><bibblock>{}</bibblock></bibitem>\n'.format(
+                b, refnum, sentence()))
+    parts.append('</biblist></bibliography></document>\n')
+    with open(path, 'w') as f:
+        f.write(''.join(parts))
+
+
+def bench_parser_engines(num_sections=200, paras_per_section=20):
+    '''
+    Checks the lxml parser engine gives the same text as the BeautifulSoup one,
+    and compares their throughput.
+    '''
+
+    from parser_ec2 import Parser, LxmlParser
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_path = os.path.join(tmp, 'doc.xml')
+        make_latexml_xml(xml_path, num_sections, paras_per_section)
+        size = os.path.getsize(xml_path)
+        old, old_seconds = timed(Parser().parse, xml_path)
+        new, new_seconds = timed(LxmlParser().parse, xml_path)
+
+    print('Output identical: {}'.format(old == new))
+    print('BeautifulSoup: {:.2f}s ({:.1f} MB/s)'.format(old_seconds, size / old_seconds / 1e6))
+    print('lxml:          {:.2f}s ({:.1f} MB/s)'.format(new_seconds, size / new_seconds / 1e6))
+
+
+def bench_citations(num_sections=50, paras_per_section=20, num_bibitems=2000):
+    '''
+    Compares resolving citations through the per-document bibitem index against
+    searching the whole tree for each citation's bibitem, as the parser used to.
+    Citations here cite a single key, where both must give the same text.
+    '''
+
+    from parser_ec2 import Parser
+
+    class ScanningParser(Parser):
+        def index_bibitems(self):
+            self.bib_authors = {}
+            self.numeric_keys = {}
+
+        def resolve_citation(self, bibrefs):
+            bib_item = self.soup.find('bibitem', attrs={'key': bibrefs})
+            if not bib_item:
+                return 'missing', None
+            authors = bib_item.find(attrs={'role': 'refnum'}, recursive=True)
+            if authors == None or authors.text == None:
+                return 'no_authors', None
+            if Parser.numeric_authors.match(authors.text.strip()):
+                return 'numeric', None
+            return 'intext', authors.text
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_path = os.path.join(tmp, 'doc.xml')
+        make_latexml_xml(xml_path, num_sections, paras_per_section, num_bibitems, multi_key_rate=0)
+        old, old_seconds = timed(ScanningParser().parse, xml_path)
+        new, new_seconds = timed(Parser().parse, xml_path)
+
+    print('Output identical: {}'.format(old == new))
+    print('Tree search per citation: {:.2f}s'.format(old_seconds))
+    print('Bibitem index:            {:.2f}s'.format(new_seconds))
+
+
+def bench_corpus_format(num_docs=2000, tokens_per_doc=3000, vocabulary_size=50000):
+    '''
+    Compares the old one .npy of unicode tokens per document against token-id shards:
+    size on disk, and the time to read every document back.
+    '''
+
+    import glob
+    import numpy as np
+    from corpus import CorpusWriter, Corpus
+
+    rng = random.Random(0)
+    words = ['w{}'.format(i) for i in range(vocabulary_size)] + ['<num>', '<latex>', 'photodisintegration']
+    with tempfile.TemporaryDirectory() as tmp:
+        npy_dir = os.path.join(tmp, 'npy')
+        os.makedirs(npy_dir)
+        for d in range(num_docs):
+            tokens = [words[min(int(rng.paretovariate(1.0)) - 1, len(words) - 1)] for _ in range(tokens_per_doc)]
+            np.save(os.path.join(npy_dir, '{:05d}.npy'.format(d)), tokens)
+        npy_paths = glob.glob(os.path.join(npy_dir, '*.npy'))
+        npy_bytes = sum(os.path.getsize(path) for path in npy_paths)
+        _, npy_seconds = timed(lambda: [np.load(path) for path in npy_paths])
+
+        shard_dir = os.path.join(tmp, 'shards')
+        os.makedirs(shard_dir)
+        writer = CorpusWriter(shard_dir)
+        for path in npy_paths:
+            writer.add(os.path.splitext(os.path.basename(path))[0], np.load(path).tolist())
+        writer.close()
+        shard_bytes = sum(os.path.getsize(path) for path in glob.glob(os.path.join(shard_dir, '*')))
+        _, shard_seconds = timed(lambda: [int(ids.sum()) for doc_id, ids in Corpus(shard_dir)])
+
+        corpus = Corpus(shard_dir)
+        identical = all(corpus.tokens(os.path.splitext(os.path.basename(path))[0]) == np.load(path).tolist() for path in npy_paths[:100])
+
+    print('Tokens identical: {}'.format(identical))
+    print('.npy files: {:.1f} MB, read in {:.2f}s'.format(npy_bytes / 1e6, npy_seconds))
+    print('Shards:     {:.1f} MB, read in {:.2f}s'.format(shard_bytes / 1e6, shard_seconds))
+
+
+def bench_tokenizer(num_words=2000000):
+    '''
+    Checks tokenizer.tokenize gives the same tokens as the old nltk-based
+    Parser.cleanse, and compares their speed on a large text.
+    '''
+
+    import re
+    import nltk
+    import tokenizer
+
+    def cleanse(doc):
+        doc = doc.lower()
+        tokenizer = nltk.tokenize.RegexpTokenizer(r'\w+')
+        num_pattern = re.compile(r'^\d*$')
+        return ['<num>' if num_pattern.match(x) else '<latex>' if x == 'latex_metatoken' else x for x in tokenizer.tokenize(doc)]
+
+    rng = random.Random(0)
+    # Recent nltk matches \w with the regex module, which differs from re on rare
+    # characters such as subscripts, so those are left out
+    words = 'The star Galaxy mass, of 12 and in (2018) latex_metatoken x_1 disk flux 3.5 M_sun \u00c5ngstr\u00f6m \u0661\u0662 e.g. 1e10'.split()
+    doc = ' '.join(rng.choice(words) for _ in range(num_words))
+    old, old_seconds = timed(cleanse, doc)
+    new, new_seconds = timed(tokenizer.tokenize, doc)
+
+    print('Output identical: {}'.format(old == new))
+    print('nltk:      {:.2f}s'.format(old_seconds))
+    print('tokenizer: {:.2f}s'.format(new_seconds))
+
+
+def make_oai_page(path, num_records=1000, seed=0, resumption_token='5555|1001'):
+    '''
+    Writes a synthetic OAI-PMH ListRecords page in arXiv metadata format,
+    including deleted records and authors without forenames.
+    '''
+
+    rng = random.Random(seed)
+    words = 'the star galaxy mass of and in halo dust disk we flux a &amp; $M_\\odot$ &lt;b&gt;'.split()
+
+    def sentence(n):
+        return ' '.join(rng.choice(words) for _ in range(n))
+
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" '
+             'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n<responseDate>2019-01-01T00:00:00Z</responseDate>\n'
+             '<request verb="ListRecords" set="physics:astro-ph" metadataPrefix="arXiv">http://export.arxiv.org/oai2</request>\n<ListRecords>\n']
+    for r in range(num_records):
+        identifier = '{:02d}{:02d}.{:05d}'.format(rng.randint(7, 18), rng.randint(1, 12), r) if r % 5 else 'astro-ph/{:07d}'.format(r)
+        if r % 97 == 3:
+            parts.append('<record><header status="deleted"><identifier>oai:arXiv.org:{}</identifier><datestamp>2018-01-01</datestamp>'
+                         '<setSpec>physics:astro-ph</setSpec></header></record>\n'.format(identifier))
+            continue
+        authors = ''.join('<author><keyname>Name{}</keyname>{}</author>'.format(a, '' if a % 7 == 6 else '<forenames> A. B. </forenames>')
+                          for a in range(rng.randint(1, 12)))
+        optional = ''
+        if rng.random() < 0.5:
+            optional += '<comments>{} pages, {} figures</comments>'.format(rng.randint(1, 40), rng.randint(0, 9))
+        if rng.random() < 0.3:
+            optional += '<journal-ref>ApJ {}</journal-ref><doi>10.1000/{}</doi>'.format(rng.randint(1, 900), r)
+        parts.append('<record><header><identifier>oai:arXiv.org:{0}</identifier><datestamp>2018-0{1}-01</datestamp>'
+                     '<setSpec>physics:astro-ph</setSpec>{2}</header><metadata>'
+                     '<arXiv xmlns="http://arxiv.org/OAI/arXiv/" xsi:schemaLocation="http://arxiv.org/OAI/arXiv/ http://arxiv.org/OAI/arXiv.xsd">'
+                     '<id>{0}</id><created>2017-01-01</created>{3}<authors>{4}</authors><title>{5}</title>'
+                     '<categories>astro-ph.GA</categories>{6}<license>http://arxiv.org/licenses/nonexclusive-distrib/1.0/</license>'
+                     '<abstract>  {7}\n</abstract></arXiv></metadata></record>\n'.format(
+                         identifier, r % 9 + 1, '<setSpec>physics:gr-qc</setSpec>' if r % 11 == 0 else '',
+                         '<updated>2018-01-01</updated><updated>2018-02-01</updated>' if r % 3 == 0 else '',
+                         authors, sentence(10), optional, sentence(150)))
+    parts.append('<resumptionToken cursor="0" completeListSize="5555">{}</resumptionToken>\n'.format(resumption_token))
+    parts.append('</ListRecords>\n</OAI-PMH>\n')
+    with open(path, 'w') as f:
+        f.write(''.join(parts))
+
+
+def bench_oai_parser(fixture_dir='fixtures/oai', num_pages=5):
+    '''
+    Checks oai.OAIPage gives the same rows and resumption token as the BeautifulSoup parsing
+    Metadata.request_bulk_metadata used to do, and compares their speed, on the saved OAI pages
+    in fixture_dir if there are any, otherwise on synthetic ones.
+    '''
+
+    import glob
+    from bs4 import BeautifulSoup
+    from oai import OAIPage
+
+    def parse_soup(results):
+        rows = []
+        soup = BeautifulSoup(results, 'xml')
+        for record in soup.find_all('record'):
+            authors = []
+            for author in record.find_all('author'):
+                if author.forenames and author.keyname:
+                    authors.append(author.forenames.text.strip() + ' ' + author.keyname.text.strip())
+            row = {}
+            for column, name in [('identifier', 'identifier'), ('filename', 'id'), ('spec', 'setSpec'), ('title', 'title'),
+                                 ('datestamp', 'datestamp'), ('created', 'created'), ('updated', 'updated'),
+                                 ('authors', None), ('categories', 'categories'), ('journal', 'journal-ref'),
+                                 ('doi', 'doi'), ('abstract', 'abstract'), ('comments', 'comments')]:
+                row[column] = ', '.join(authors) if name is None else getattr(record.find(name), 'text', None)
+            rows.append(row)
+        token = soup.find('resumptionToken')
+        return rows, token.text if token is not None else None
+
+    def parse_pull(results):
+        page = OAIPage(io.BytesIO(results))
+        rows = list(page)
+        return rows, page.resumption_token
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = sorted(glob.glob(os.path.join(fixture_dir, '*.xml')))
+        if not paths:
+            for p in range(num_pages):
+                paths.append(os.path.join(tmp, 'page{}.xml'.format(p)))
+                make_oai_page(paths[-1], seed=p)
+        pages = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                pages.append(f.read())
+
+    old, old_seconds = timed(lambda: [parse_soup(page) for page in pages])
+    new, new_seconds = timed(lambda: [parse_pull(page) for page in pages])
+    size = sum(len(page) for page in pages)
+
+    print('Output identical: {} ({} pages, {} records)'.format(old == new, len(pages), sum(len(rows) for rows, token in new)))
+    print('BeautifulSoup: {:.2f}s ({:.1f} MB/s)'.format(old_seconds, size / old_seconds / 1e6))
+    print('OAIPage:       {:.2f}s ({:.1f} MB/s)'.format(new_seconds, size / new_seconds / 1e6))
+
+
+def bench_metadata_store(num_records=200000, num_partitions=4):
+    '''
+    Compares cold-start loading of the metadata CSV against the Parquet store,
+    for the identifiers alone and for every column.
+    '''
+
+    import datetime
+    import pandas as pd
+    from metadata_store import MetadataStore, CSV_DTYPES
+
+    rng = random.Random(0)
+    identifiers = make_identifiers(num_records)
+    categories = ['astro-ph', 'astro-ph.GA', 'astro-ph.CO astro-ph.GA', 'astro-ph.SR', 'astro-ph.HE gr-qc', 'astro-ph.EP']
+    words = 'the star galaxy mass of and in halo dust disk we flux'.split()
+    df = pd.DataFrame({
+        'identifier': ['oai:arXiv.org:' + identifier for identifier in identifiers],
+        'filename': identifiers,
+        'spec': [rng.choice(['physics:astro-ph', 'physics:gr-qc']) for _ in identifiers],
+        'title': [' '.join(rng.choice(words) for _ in range(8)) for _ in identifiers],
+        'datestamp': '2019-01-01',
+        'created': '2018-01-01',
+        'updated': None,
+        'authors': 'A. Author, B. Author',
+        'categories': [rng.choice(categories) for _ in identifiers],
+        'journal': None,
+        'doi': None,
+        'abstract': [' '.join(rng.choice(words) for _ in range(150)) for _ in identifiers],
+        'comments': '10 pages',
+        'date_retrieved': datetime.datetime(2019, 2, 22),
+        'filename_parsed': identifiers,
+    })
+
+    def read_csv(csv_path):
+        return pd.read_csv(csv_path, dtype=CSV_DTYPES, parse_dates=['date_retrieved'])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'metadata.csv')
+        df.to_csv(csv_path, index=False)
+        store = MetadataStore(os.path.join(tmp, 'metadata'))
+        for part in range(num_partitions):
+            store.append(df.iloc[part::num_partitions])
+        csv_bytes = os.path.getsize(csv_path)
+        store_bytes = sum(os.path.getsize(path) for path in store.partitions())
+
+        old, old_seconds = timed(lambda: read_csv(csv_path)['filename_parsed'])
+        new, new_seconds = timed(store.identifiers)
+        _, old_full_seconds = timed(read_csv, csv_path)
+        _, new_full_seconds = timed(store.load)
+        _, get_seconds = timed(store.get, identifiers[12345])
+
+    print('Identifiers identical: {}'.format(sorted(old) == sorted(new)))
+    print('CSV:     {:.1f} MB, identifiers in {:.2f}s, all columns in {:.2f}s'.format(csv_bytes / 1e6, old_seconds, old_full_seconds))
+    print('Parquet: {:.1f} MB, identifiers in {:.2f}s, all columns in {:.2f}s, one row in {:.2f}s'.format(
+        store_bytes / 1e6, new_seconds, new_full_seconds, get_seconds))
+
+
+class FakeOAI(object):
+    '''
+    Local OAI-PMH endpoint serving ListRecords pages of canned records in arXiv format,
+    with a given latency per request, answering every throttle_every-th request
+    with a 503 and a Retry-After of retry_after seconds, and every request
+    after the first fail_after with a 500, as if the harvest crashed.
+    The requests numbered in drop are dropped without an answer, and the first
+    expire_tokens resumption tokens given are answered with badResumptionToken.
+    Identify reports the earliest datestamp of the records.
+    records are (identifier, datestamp, set_spec) tuples.
+    '''
+
+    def __init__(self, records, page_size=100, latency=0.0, throttle_every=0, retry_after=1, fail_after=None,
+                 drop=(), expire_tokens=0):
+        import http.server
+        import threading
+
+        self.records = sorted(records, key=lambda record: (record[1], record[0]))
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.fail_after = fail_after
+        self.drop = set(drop)
+        self.expire_tokens = expire_tokens
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                response = fake.respond(self.path)
+                if response is None:
+                    self.close_connection = True
+                    return
+                status, headers, body = response
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/oai2'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, path):
+        import urllib.parse
+
+        with self.lock:
+            self.requests += 1
+            if self.requests in self.drop:
+                return None
+            throttle = self.throttle_every and self.requests % self.throttle_every == 0
+            if throttle:
+                self.throttled += 1
+        time.sleep(self.latency)
+        if self.fail_after is not None and self.requests > self.fail_after:
+            return 500, {}, b'Internal error'
+        if throttle:
+            return 503, {'Retry-After': str(self.retry_after)}, b'Retry later'
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(path).query))
+        header = ('<?xml version="1.0" encoding="UTF-8"?>\n<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+                  '<responseDate>2019-01-01T00:00:00Z</responseDate><request verb="{}">http://export.arxiv.org/oai2</request>'.format(query.get('verb')))
+        if query.get('verb') == 'Identify':
+            return 200, {'Content-Type': 'text/xml'}, (header + '<Identify><earliestDatestamp>{}</earliestDatestamp></Identify></OAI-PMH>'.format(
+                self.records[0][1])).encode('utf-8')
+        if 'resumptionToken' in query:
+            with self.lock:
+                expire = self.expire_tokens > 0
+                self.expire_tokens -= expire
+            if expire:
+                return 200, {'Content-Type': 'text/xml'}, (header + '<error code="badResumptionToken">Expired</error></OAI-PMH>').encode('utf-8')
+            set_spec, start, end, cursor = query['resumptionToken'].split('|')
+            cursor = int(cursor)
+        else:
+            set_spec, start, end, cursor = query['set'], query.get('from', '0000'), query.get('until', '9999'), 0
+        matches = [record for record in self.records if record[2] == set_spec and start <= record[1] <= end]
+        parts = [header]
+        if not matches:
+            parts.append('<error code="noRecordsMatch">No records</error></OAI-PMH>')
+            return 200, {'Content-Type': 'text/xml'}, ''.join(parts).encode('utf-8')
+        parts.append('<ListRecords>')
+        for identifier, datestamp, spec in matches[cursor:cursor + self.page_size]:
+            parts.append('<record><header><identifier>oai:arXiv.org:{0}</identifier><datestamp>{1}</datestamp>'
+                         '<setSpec>{2}</setSpec></header><metadata><arXiv xmlns="http://arxiv.org/OAI/arXiv/">'
+                         '<id>{0}</id><created>{1}</created><authors><author><keyname>Author</keyname><forenames>A.</forenames></author></authors>'
+                         '<title>Title of {0}</title><categories>astro-ph.GA</categories><abstract>Abstract of {0}</abstract>'
+                         '</arXiv></metadata></record>'.format(identifier, datestamp, spec))
+        if cursor + self.page_size < len(matches):
+            parts.append('<resumptionToken cursor="{}" completeListSize="{}">{}|{}|{}|{}</resumptionToken>'.format(
+                cursor, len(matches), set_spec, start, end, cursor + self.page_size))
+        elif cursor > 0:
+            parts.append('<resumptionToken cursor="{}" completeListSize="{}"/>'.format(cursor, len(matches)))
+        parts.append('</ListRecords></OAI-PMH>')
+        return 200, {'Content-Type': 'text/xml'}, ''.join(parts).encode('utf-8')
+
+
+def make_oai_records(num_records=3000, start_year=2015, years=4, cross_listed=0.1, seed=0):
+    '''
+    Returns (identifier, datestamp, set_spec) tuples for FakeOAI, some cross-listed in a second set.
+    '''
+
+    import datetime
+
+    rng = random.Random(seed)
+    start = datetime.date(start_year, 1, 1)
+    records = []
+    for r in range(num_records):
+        datestamp = (start + datetime.timedelta(days=rng.randrange(365 * years))).strftime('%Y-%m-%d')
+        identifier = '{}.{:05d}'.format(datestamp[2:4] + datestamp[5:7], r)
+        records.append((identifier, datestamp, 'physics:astro-ph'))
+        if rng.random() < cross_listed:
+            records.append((identifier, datestamp, 'physics:gr-qc'))
+    return records
+
+
+def bench_harvest(num_records=3000, latency=0.05, workers=8, window_days=90):
+    '''
+    Harvests a local FakeOAI endpoint (with latency and periodic 503s) sequentially
+    in a single window and concurrently in date windows, then harvests again after
+    a crash part way through, checking each gets every record once.
+    '''
+
+    import datetime
+    import requests
+    from harvest import Harvester
+
+    records = make_oai_records(num_records)
+    expected = sorted(set('oai:arXiv.org:' + record[0] for record in records))
+    sets = ['physics:astro-ph', 'physics:gr-qc']
+    start, end = datetime.date(2015, 1, 1), datetime.date(2018, 12, 31)
+    for name, harvester_workers, harvester_window_days in (('sequential', 1, 10000), ('concurrent', workers, window_days),
+                                                            ('resumed', workers, window_days)):
+        with tempfile.TemporaryDirectory() as tmp:
+            harvester = Harvester(None, sets, workers=harvester_workers, rate=100, window_days=harvester_window_days,
+                                  root=os.path.join(tmp, 'harvest'))
+            crashed_requests = 0
+            if name == 'resumed':
+                fake = FakeOAI(records, latency=latency, fail_after=30)
+                harvester.url = fake.url
+                try:
+                    harvester.harvest(start, end)
+                except requests.HTTPError:
+                    crashed_requests = fake.fail_after
+                finally:
+                    fake.close()
+            fake = FakeOAI(records, latency=latency, throttle_every=25, retry_after=0.5)
+            harvester.url = fake.url
+            try:
+                _, seconds = timed(harvester.harvest, start, end)
+            finally:
+                fake.close()
+            rows = harvester.load()
+        print('{:10s} {:.2f}s, {} requests ({} before crashing), {} answered 503, all records once: {}'.format(
+            name, seconds, fake.requests, crashed_requests, fake.throttled, sorted(rows['identifier']) == expected))
+
+
+class FakeDrive(object):
+    '''
+    In-memory stand-in for pydrive's GoogleDrive, covering what Gdrive uses:
+    paged files().list queries on the arxiv folder (with modifiedDate and trashed),
+    ranged get_media downloads, CreateFile, and resumable inserts through auth.service,
+    which take chunk_seconds per chunk and fail the chunks numbered in fail_chunks once each.
+    Each http object refuses requests from any thread but the one that made it.
+    '''
+
+    def __init__(self, titles=(), chunk_seconds=0.0, fail_chunks=(), page_size=1000):
+        import threading
+
+        fake = self
+        self.files = {}
+        self.lists = 0
+        self.chunk_seconds = chunk_seconds
+        self.fail_chunks = set(fail_chunks)
+        self.chunks = 0
+        self.page_size = page_size
+        self.lock = threading.Lock()
+
+        class File(dict):
+            def __init__(self, metadata):
+                dict.__init__(self, metadata)
+                self.metadata = self
+
+            def Upload(self):
+                fake.add(self)
+
+        class Http(object):
+            def __init__(self):
+                self.thread = threading.current_thread()
+
+            def check(self):
+                if threading.current_thread() is not self.thread:
+                    raise RuntimeError('http object shared between threads')
+
+            def request(self, uri, method='GET', headers=None, **kwargs):
+                import httplib2
+
+                self.check()
+                content = fake.files[uri.rsplit('/', 1)[1]].get('content', b'')
+                first, last = (int(byte) for byte in headers['range'][len('bytes='):].split('-'))
+                chunk = content[first:last + 1]
+                return httplib2.Response({'status': 206, 'content-range': 'bytes {}-{}/{}'.format(
+                    first, first + len(chunk) - 1, len(content))}), chunk
+
+        class Request(object):
+            def __init__(self, uri=None, result=None):
+                self.uri = uri
+                self.headers = {}
+                self.http = None
+                self.result = result
+
+            def execute(self, http=None):
+                (http or self.http).check()
+                return self.result
+
+        class Insert(object):
+            def __init__(self, body, media_body):
+                self.body = body
+                self.media = media_body
+                self.offset = 0
+
+            def next_chunk(self, http=None, num_retries=0):
+                from googleapiclient.http import MediaUploadProgress
+
+                http.check()
+                time.sleep(fake.chunk_seconds)
+                with fake.lock:
+                    fake.chunks += 1
+                    chunk = fake.chunks
+                if chunk in fake.fail_chunks:
+                    raise ConnectionError('chunk {} dropped'.format(chunk))
+                size = self.media.size()
+                self.offset += len(self.media.getbytes(self.offset, self.media.chunksize()))
+                if self.offset < size:
+                    return MediaUploadProgress(self.offset, size), None
+                file = File(dict(self.body, content=self.media.getbytes(0, size)))
+                fake.add(file)
+                return None, dict(file)
+
+        class Files(object):
+            def insert(self, body, media_body):
+                return Insert(body, media_body)
+
+            def get_media(self, fileId):
+                return Request(uri='fake://files/' + fileId)
+
+            def list(self, q, maxResults=100, pageToken=None):
+                fake.lists += 1
+                start = int(pageToken or 0)
+                items = fake.query(q)
+                page = {'items': [dict(f, fileSize=str(len(f.get('content', b''))))
+                                  for f in items[start:start + min(maxResults, fake.page_size)]]}
+                if start + fake.page_size < len(items):
+                    page['nextPageToken'] = str(start + fake.page_size)
+                return Request(result=page)
+
+        class Service(object):
+            def files(self):
+                return Files()
+
+        class Auth(object):
+            service = Service()
+
+            def Get_Http_Object(self):
+                return Http()
+
+        self.File = File
+        self.auth = Auth()
+        folder = File({'title': 'arxiv'})
+        self.add(folder)
+        for title in titles:
+            self.add(File({'title': title, 'parents': [{'id': folder['id']}]}))
+
+    def query(self, q):
+        import re
+
+        if "title='arxiv'" in q:
+            return [f for f in self.files.values() if f['title'] == 'arxiv']
+        parent = re.search(r"'([^']+)' in parents", q).group(1)
+        since = re.search(r"modifiedDate > '([^']+)'", q)
+        return [f for f in self.files.values() if f.get('parent') == parent
+                and not ('trashed=false' in q and f['labels']['trashed'])
+                and (since is None or f['modifiedDate'] > since.group(1))]
+
+    def add(self, file):
+        with self.lock:
+            file['id'] = 'id{}'.format(len(self.files))
+            self.touch(file)
+            file['labels'] = {'trashed': False}
+            if file.get('parents'):
+                file['parent'] = file['parents'][0]['id']
+            self.files[file['id']] = file
+
+    def touch(self, file):
+        self.modified = getattr(self, 'modified', 0) + 1
+        file['modifiedDate'] = '2019-01-01T00:00:{:09.6f}Z'.format(self.modified / 1e5)
+
+    def trash(self, file_id):
+        with self.lock:
+            self.files[file_id]['labels'] = {'trashed': True}
+            self.touch(self.files[file_id])
+
+    def delete(self, file_id):
+        with self.lock:
+            del self.files[file_id]
+
+    def CreateFile(self, metadata=None):
+        return self.File(metadata or {})
+
+
+def bench_gdrive(num_tars=5000, num_lookups=2000, num_uploads=4, upload_bytes=3 * 1024 * 1024):
+    '''
+    Compares finding tars by scanning the Drive listing against the Gdrive catalog,
+    checks incremental refreshes only list new files, and times handing uploads
+    to the background against uploading in place, on a FakeDrive that drops a chunk.
+    '''
+
+    import gdrive
+    from gdrive import Gdrive
+
+    titles = ['arXiv_src_{:04d}_{:03d}.tar'.format(i // 20, i % 20) for i in range(num_tars)]
+    g = Gdrive(FakeDrive(titles))
+    listing = g.get_tarfiles()
+    lookups = random.Random(0).sample(titles, num_lookups // 2) + ['missing_{}.tar'.format(i) for i in range(num_lookups // 2)]
+
+    def scan():
+        return sum(1 for title in lookups if any(gfile['title'] == title for gfile in listing))
+
+    old, old_seconds = timed(scan)
+    new, new_seconds = timed(lambda: sum(1 for title in lookups if g.get(title) is not None))
+    print('Linear scan: {:.3f}s, catalog: {:.5f}s, same matches: {}'.format(old_seconds, new_seconds, old == new))
+
+    g.drive.add(g.drive.CreateFile({'title': 'new.tar', 'parents': [{'id': g.folder()}]}))
+    listed = len(g.list_files("'{}' in parents and modifiedDate > '{}'".format(g.folder(), g.catalog_updated)))
+    g.refresh()
+    print('Incremental refresh listed {} file(s), found new.tar: {}'.format(listed, 'new.tar' in g))
+
+    gdrive.UPLOAD_CHUNK_SIZE = 256 * 1024
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for u in range(num_uploads):
+            paths.append(os.path.join(tmp, 'upload_{}.tar'.format(u)))
+            with open(paths[-1], 'wb') as f:
+                f.write(os.urandom(upload_bytes))
+        for name in ('in place', 'background'):
+            g = Gdrive(FakeDrive(chunk_seconds=0.01, fail_chunks=[5]))
+            if name == 'in place':
+                _, handoff_seconds = timed(lambda: [g.upload(path) for path in paths])
+            else:
+                _, handoff_seconds = timed(lambda: [g.upload_async(path) for path in paths])
+            _, total_seconds = timed(g.wait_for_uploads)
+            intact = all(open(path, 'rb').read() == g.drive.files[g.get(os.path.basename(path))['id']]['content'] for path in paths)
+            print('{:10s} pipeline waited {:.2f}s, all done after {:.2f}s, uploads intact: {}'.format(
+                name, handoff_seconds, handoff_seconds + total_seconds, intact))
+
+
+def make_submission_tar(path, member_ids, figure_bytes=2 * 1024 * 1024, seed=0):
+    '''
+    Writes a tar like make_tar, but with each member a gzipped tar holding a main .tex,
+    an \\input-ed section and a figure of given size, half random and half repetitive.
+    '''
+
+    import gzip
+
+    rng = random.Random(seed)
+    with tarfile.open(path, 'w') as tar:
+        for member_id in member_ids:
+            inner = io.BytesIO()
+            with tarfile.open(fileobj=inner, mode='w') as submission:
+                files = {
+                    'ms.tex': b'\\documentclass{aastex}\n\\begin{document}\n\\input{sections/intro}\n\\end{document}\n',
+                    'sections/intro.tex': b'Some text. ' * 2000,
+                    'fig1.eps': rng.getrandbits(figure_bytes * 4).to_bytes(figure_bytes // 2, 'little') + b'0 0 moveto\n' * (figure_bytes // 22),
+                }
+                for name, data in files.items():
+                    info = tarfile.TarInfo(name=name)
+                    info.size = len(data)
+                    submission.addfile(info, io.BytesIO(data))
+            data = gzip.compress(inner.getvalue(), compresslevel=6)
+            info = tarfile.TarInfo(name='0001/' + member_id + '.gz')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def bench_extract_modes(num_submissions=40):
+    '''
+    Compares CPU seconds and bytes written extracting the submissions of a tar
+    in each of utils.EXTRACT_MODES, with and without dropping figures,
+    and checks the main .tex is still found.
+    '''
+
+    import shutil
+    import triage
+    import utils
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tar_path = os.path.join(tmp, 'arXiv_src_0001_001.tar')
+        make_submission_tar(tar_path, make_identifiers(num_submissions))
+        print('Tar: {} submissions, {:.1f} MB'.format(num_submissions, os.path.getsize(tar_path) / 1024 ** 2))
+        for mode, filter_members in [('zip', False), ('zip_stored', False), ('directory', False),
+                                     ('zip_stored', True), ('directory', True)]:
+            utils.FILTER_MEMBERS = filter_members
+            out_dir = os.path.join(tmp, mode)
+            os.makedirs(out_dir)
+            starttime = time.process_time()
+            with tarfile.open(tar_path) as tar:
+                for member in tar:
+                    submission_id = os.path.splitext(os.path.basename(member.name))[0]
+                    utils.extract_submission(tar.extractfile(member), os.path.join(out_dir, submission_id), mode)
+            cpu_seconds = time.process_time() - starttime
+            written = sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(out_dir) for name in files)
+            if mode == 'directory':
+                mains = set(os.path.relpath(triage.preflight(os.path.join(out_dir, name)).main, os.path.join(out_dir, name))
+                            for name in os.listdir(out_dir))
+            else:
+                mains = '(.zip)'
+            name = mode + (' filtered' if filter_members else '')
+            print('{:19s} {:.2f} CPU s, {:.1f} MB written per tar, main files: {}'.format(name, cpu_seconds, written / 1024 ** 2, mains))
+            shutil.rmtree(out_dir)
+        utils.FILTER_MEMBERS = True
+
+
+def bench_triage(copies=200):
+    '''
+    Checks triage.preflight gives the expected reason code for each kind of
+    submission that used to run into the conversion timeout, and times it.
+    '''
+
+    import triage
+    import zipfile
+
+    paper = b'\\documentclass{aastex}\n\\begin{document}\n' + b'Some text. ' * 5000 + b'\n\\end{document}\n'
+    reply = b'\\documentclass{article}\n\\begin{document}\nWe thank the referee.\n\\end{document}\n'
+    cases = {
+        'paper.tex': (b'\\documentstyle{aaspp4}\n' + paper[22:], triage.OK),
+        'pdf.tex': (b'%PDF-1.4\n' + b'\0' * 100, triage.NOT_LATEX),
+        'postscript.tex': (b'%!PS-Adobe-2.0\n', triage.NOT_LATEX),
+        'blank.tex': (b'\n\n', triage.EMPTY),
+        'paper': ({'ms.tex': paper, 'reply.tex': reply, 'sections/intro.tex': b'text'}, triage.OK),
+        'split': ({'ms.tex': paper.replace(b'Some text. ' * 5000, b'\\input{body}'), 'body.tex': b'Some text. ' * 5000}, triage.OK),
+        'twins': ({'v1.tex': paper, 'v2.tex': paper + b'%'}, triage.MULTIPLE_ROOTS),
+        'figures': ({'fig1.eps': b'%!PS'}, triage.NO_TEX),
+        'fragments': ({'intro.tex': b'Some text.', 'macros.tex': b'\\def\\x{y}'}, triage.NO_MAIN),
+        'nothing': ({}, triage.EMPTY),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {}
+        for name, (content, expected) in cases.items():
+            path = os.path.join(tmp, name)
+            if isinstance(content, bytes):
+                with open(path, 'wb') as f:
+                    f.write(content)
+            else:
+                os.makedirs(path)
+                for member, data in content.items():
+                    os.makedirs(os.path.dirname(os.path.join(path, member)), exist_ok=True)
+                    with open(os.path.join(path, member), 'wb') as f:
+                        f.write(data)
+                # The same submission as a .zip, which triages the same
+                with zipfile.ZipFile(path + '.zip', 'w') as zipf:
+                    for member, data in content.items():
+                        zipf.writestr(member, data)
+                paths[name + '.zip'] = (path + '.zip', expected)
+            paths[name] = (path, expected)
+
+        for name, (path, expected) in sorted(paths.items()):
+            result = triage.preflight(path)
+            main = os.path.relpath(result.main, tmp) if result.main else None
+            print('{:16s} {:15s} {:5s} main: {}'.format(name, result.reason, 'ok' if result.reason == expected else 'WRONG', main))
+        _, seconds = timed(lambda: [triage.preflight(path) for _ in range(copies) for path, expected in paths.values()])
+        print('{:.2f} ms per submission'.format(seconds * 1000 / (copies * len(paths))))
+
+
+def simulate_conversions(jobs, duration, workers):
+    '''
+    Simulates converting jobs on workers, first come first served, where a job
+    finishes after duration(job) seconds unless that exceeds its timeout.
+    Returns (seconds until the last job ended, jobs converted, worker seconds lost to timeouts).
+    '''
+
+    import heapq
+
+    free_at = [0.0] * workers
+    converted = 0
+    lost = 0.0
+    end = 0.0
+    for job in jobs:
+        start = heapq.heappop(free_at)
+        seconds = duration(job)
+        if seconds <= job.timeout:
+            converted += 1
+        else:
+            seconds = job.timeout
+            lost += seconds
+        heapq.heappush(free_at, start + seconds)
+        end = max(end, start + seconds)
+    return end, converted, lost
+
+
+def bench_conversion_schedule(num_submissions=2000, workers=8, pathological_rate=0.02, seed=0):
+    '''
+    Simulates converting a tar's worth of submissions in glob order against
+    scheduler.Scheduler's longest estimated first, both with a history of past runs
+    to estimate from and without one, all with the 300 s timeout. Checks scheduling
+    converts as many submissions and loses no more time to timeouts. Ordering alone
+    moves the end by less than one timeout either way, as here the pathological papers
+    can't be told apart by size.
+    '''
+
+    import scheduler
+
+    rng = random.Random(seed)
+
+    def make_submissions(tmp, n, prefix):
+        submissions = []
+        for i in range(n):
+            path = os.path.join(tmp, '{}{:05d}.tex'.format(prefix, i))
+            with open(path, 'wb') as f:
+                f.truncate(int(rng.lognormvariate(11, 1.2)))
+            submissions.append(path)
+        return submissions
+
+    # Runtime grows with size, and a few papers take ten minutes whatever their size,
+    # or never finish
+    durations = {}
+
+    def true_duration(job):
+        if job.submission not in durations:
+            if rng.random() < pathological_rate:
+                durations[job.submission] = rng.choice([600.0, float('inf')])
+            else:
+                durations[job.submission] = (3 + 40 * job.input_bytes / 1024 ** 2) * rng.lognormvariate(0, 0.5)
+        return durations[job.submission]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Past runs the cost model learns from
+        history = scheduler.Scheduler(hard_timeout=300).plan(make_submissions(tmp, 2000, 'past'))
+        stats = {}
+        for job in history:
+            key = (scheduler.size_bucket(job.input_bytes), min(job.tex_files, scheduler.MAX_TEX_FILES))
+            runs, seconds = stats.get(key, (0, 0.0))
+            stats[key] = (runs + 1, seconds + min(300.0, true_duration(job)))
+        model = scheduler.CostModel([key + value for key, value in stats.items()])
+
+        submissions = make_submissions(tmp, num_submissions, 'new')
+        fixed = [scheduler.Job(path, os.path.getsize(path), 1, 0, 300) for path in submissions]
+        planned, plan_seconds = timed(scheduler.Scheduler(model, hard_timeout=300).plan, submissions)
+        cold = scheduler.Scheduler(scheduler.CostModel(), hard_timeout=300).plan(submissions)
+
+        print('{} submissions, {} workers, {:.0%} pathological'.format(num_submissions, workers, pathological_rate))
+        outcomes = {}
+        for name, jobs in [('glob order', fixed), ('scheduled, no history', cold), ('scheduled', planned)]:
+            outcomes[name] = end, converted, lost = simulate_conversions(jobs, true_duration, workers)
+            print('{:22s} done after {:5.0f}s, {} converted, {:5.0f} worker-seconds lost to timeouts'.format(
+                name, end, converted, lost))
+        print('Planning took {:.2f}s'.format(plan_seconds))
+
+    baseline_end, baseline_converted, baseline_lost = outcomes['glob order']
+    for name in ['scheduled, no history', 'scheduled']:
+        end, converted, lost = outcomes[name]
+        assert converted >= baseline_converted and lost <= baseline_lost, name
+        assert end <= baseline_end + 300, name
+
+
+BENCHMARKS = {
+    'conversion_schedule': bench_conversion_schedule,
+    'triage': bench_triage,
+    'extract_modes': bench_extract_modes,
+    'gdrive': bench_gdrive,
+    'harvest': bench_harvest,
+    'metadata_store': bench_metadata_store,
+    'oai_parser': bench_oai_parser,
+    'tokenizer': bench_tokenizer,
+    'corpus_format': bench_corpus_format,
+    'citations': bench_citations,
+    'identifier_filter': bench_identifier_filter,
+    'latexml_backends': bench_latexml_backends,
+    'parser_engines': bench_parser_engines,
+}
+
+
+if __name__ == '__main__':
+    '''
+    Runs if script called on command line
+    '''
+
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        print('\n== ' + name + ' ==')
+        BENCHMARKS[name]()
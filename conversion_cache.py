@@ -0,0 +1,173 @@
+import hashlib
+import os
+import re
+import shutil
+import subprocess as sp
+import tempfile
+import threading
+import zipfile
+
+
+CACHE_DIR = 'cache/xml'
+# Total size of cached XML, in bytes, beyond which least recently used entries are evicted
+CACHE_BUDGET = 20 * 1024 ** 3
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def latexml_version():
+	'''
+	Returns the installed LaTeXML version string, or 'unknown'.
+	'''
+
+	try:
+		output = sp.run(['latexmlc', '--VERSION'], stdout=sp.PIPE, stderr=sp.STDOUT, timeout=60).stdout.decode('utf-8', 'replace')
+	except (OSError, sp.TimeoutExpired):
+		return 'unknown'
+	match = re.search(r'\d+(\.\d+)+', output)
+	return match.group(0) if match else 'unknown'
+
+
+def submission_hash(path):
+	'''
+	Returns a sha256 of the normalized submission at given path, i.e. of its
+	member names and contents in sorted order, ignoring timestamps and compression,
+	so the same paper re-extracted from another tar hashes the same.
+	Works on the .zip, .tex or directory that utils.extract produces.
+	'''
+
+	digest = hashlib.sha256()
+
+	def add(name, f):
+		digest.update(name.encode('utf-8') + b'\0')
+		for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+			digest.update(chunk)
+		digest.update(b'\0')
+
+	if os.path.isdir(path):
+		for root, dirs, files in os.walk(path):
+			dirs.sort()
+			for name in sorted(files):
+				filepath = os.path.join(root, name)
+				with open(filepath, 'rb') as f:
+					add(os.path.relpath(filepath, path), f)
+	elif zipfile.is_zipfile(path):
+		with zipfile.ZipFile(path) as zipf:
+			for info in sorted(zipf.infolist(), key=lambda info: info.filename):
+				if info.is_dir():
+					continue
+				with zipf.open(info) as f:
+					add(info.filename, f)
+	else:
+		with open(path, 'rb') as f:
+			add('', f)
+	return digest.hexdigest()
+
+
+class ConversionCache(object):
+	'''
+	Content-addressed store of converted XML, keyed by submission_hash.
+	Entries live under a directory per LaTeXML version, so upgrading LaTeXML
+	invalidates them. Bounded by max_bytes across all versions, evicting least
+	recently used entries, so those of other versions, no longer used, go first.
+	If the LaTeXML version can't be told, e.g. latexmlc was slow to start,
+	the cache is bypassed rather than mixing versions.
+	'''
+
+	root = None
+	max_bytes = CACHE_BUDGET
+
+	def __init__(self, root=CACHE_DIR, max_bytes=CACHE_BUDGET, version=None):
+		self.version = version or latexml_version()
+		self.enabled = self.version != 'unknown'
+		self.cache_root = root
+		self.root = os.path.join(root, re.sub(r'[^\w.-]', '_', self.version))
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		if not self.enabled:
+			print('LaTeXML version unknown, not using the conversion cache')
+		elif not os.path.isdir(self.root):
+			os.makedirs(self.root)
+		self.size = sum(size for path, size, mtime in self.entries())
+
+	def path(self, key):
+		return os.path.join(self.root, key[:2], key + '.xml')
+
+	def entries(self):
+		'''
+		Yields (path, size, mtime) of the entries of every LaTeXML version.
+		'''
+
+		for dirpath, dirs, files in os.walk(self.cache_root):
+			for name in files:
+				path = os.path.join(dirpath, name)
+				try:
+					stat = os.stat(path)
+				except FileNotFoundError:
+					continue
+				yield path, stat.st_size, stat.st_mtime
+
+	def get(self, key, outpath):
+		'''
+		Copies the cached XML for key to outpath, returning whether there was one.
+		'''
+
+		if not self.enabled:
+			return False
+		path = self.path(key)
+		try:
+			shutil.copyfile(path, outpath)
+			# Mark as recently used
+			os.utime(path)
+		except FileNotFoundError:
+			return False
+		return True
+
+	def put(self, key, outpath):
+		'''
+		Stores a copy of the XML at outpath under key.
+		'''
+
+		if not self.enabled:
+			return
+		path = self.path(key)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		# Write under a temporary name first, so readers never see a partial file
+		fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+		os.close(fd)
+		shutil.copyfile(outpath, tmp_path)
+		os.replace(tmp_path, path)
+		with self.lock:
+			self.size += os.path.getsize(path)
+			if self.size > self.max_bytes:
+				self.evict()
+
+	def evict(self):
+		'''
+		Deletes least recently used entries until the cache is 90% of its budget.
+		'''
+
+		entries = sorted(self.entries(), key=lambda entry: entry[2])
+		self.size = sum(size for path, size, mtime in entries)
+		for path, size, mtime in entries:
+			if self.size <= self.max_bytes * 0.9:
+				break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			self.size -= size
+
+
+caches = {}
+
+
+def get_cache(root=CACHE_DIR, max_bytes=CACHE_BUDGET):
+	'''
+	Returns the cache at given root, opening it once per process.
+	'''
+
+	if root not in caches:
+		caches[root] = ConversionCache(root, max_bytes)
+	return caches[root]
@@ -0,0 +1,233 @@
+import fcntl
+import glob
+import os
+import time
+import numpy as np
+
+
+CORPUS_DIR = 'corpus'
+# Shard size in bytes after which a writer starts a new shard
+SHARD_BYTES = 1024 ** 3
+DTYPE = np.dtype('<u4')
+
+
+class Vocabulary(object):
+    '''
+    Maps tokens to uint32 ids, shared by every writer through an append-only
+    file of one token per line, where a token's id is its line number.
+    New tokens are appended under a file lock, so concurrent writers agree on ids.
+    '''
+
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+        self.token_ids = {}
+        self.tokens = []
+        self.offset = 0
+        self.refresh()
+
+    def refresh(self, f=None):
+        '''
+        Reads tokens added to the file since last time, ignoring a partly written last line.
+        '''
+
+        if f is None:
+            if not os.path.isfile(self.path):
+                return
+            with open(self.path, 'rb') as f:
+                return self.refresh(f)
+        f.seek(self.offset)
+        data = f.read()
+        data = data[:data.rfind(b'\n') + 1]
+        for token in data.decode('utf-8').splitlines():
+            self.token_ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        self.offset += len(data)
+
+    def ids(self, tokens):
+        '''
+        Returns the ids of given tokens as a uint32 array, adding unknown tokens to the vocabulary.
+        '''
+
+        new_tokens = set(token for token in tokens if token not in self.token_ids)
+        if new_tokens:
+            with open(self.path, 'ab+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    # Other writers may have added some of them meanwhile
+                    self.refresh(f)
+                    new_tokens = sorted(token for token in new_tokens if token not in self.token_ids)
+                    f.write(''.join(token + '\n' for token in new_tokens).encode('utf-8'))
+                    f.flush()
+                    self.refresh(f)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return np.fromiter((self.token_ids[token] for token in tokens), dtype=DTYPE, count=len(tokens))
+
+    def decode(self, ids):
+        if len(ids) and ids.max() >= len(self.tokens):
+            self.refresh()
+        return [self.tokens[i] for i in ids]
+
+
+class CorpusWriter(object):
+    '''
+    Appends documents' token ids to large shard files under root,
+    recording where each document starts and how many tokens it has in the shard's .idx file.
+    Each writer (i.e. each worker process) writes its own shards.
+    '''
+
+    root = CORPUS_DIR
+    shard_bytes = SHARD_BYTES
+
+    def __init__(self, root=CORPUS_DIR, shard_bytes=SHARD_BYTES):
+        self.root = root
+        self.shard_bytes = shard_bytes
+        if not os.path.isdir(root):
+            os.makedirs(root, exist_ok=True)
+        self.vocabulary = Vocabulary(os.path.join(root, 'vocab.txt'))
+        self.shard = None
+        self.index = None
+
+    def open_shard(self):
+        self.close()
+        # Named by creation time, so a document written again later wins when reading
+        name = os.path.join(self.root, 'tokens-{:x}-{}'.format(time.time_ns(), os.getpid()))
+        self.shard = open(name + '.u32', 'ab')
+        self.index = open(name + '.idx', 'a')
+
+    def add(self, doc_id, tokens):
+        '''
+        Writes the given document's tokens, or their ids from self.vocabulary,
+        returning the number of bytes written.
+        '''
+
+        if self.shard is None or self.shard.tell() >= self.shard_bytes:
+            self.open_shard()
+        ids = tokens if isinstance(tokens, np.ndarray) else self.vocabulary.ids(tokens)
+        start = self.shard.tell() // DTYPE.itemsize
+        self.shard.write(ids.tobytes())
+        self.shard.flush()
+        # Only index the document once its tokens are all written
+        self.index.write('{} {} {}\n'.format(doc_id, start, len(ids)))
+        self.index.flush()
+        return ids.nbytes
+
+    def close(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.index.close()
+            self.shard = None
+            self.index = None
+
+
+def read_index(index_path):
+    '''
+    Yields (doc_id, start, length) for the complete lines of a shard's .idx file.
+    '''
+
+    with open(index_path) as index:
+        for line in index:
+            if line.endswith('\n'):
+                doc_id, start, length = line.split()
+                yield doc_id, int(start), int(length)
+
+
+def doc_ids(root=CORPUS_DIR):
+    '''
+    Yields the id of every document written under root: in shards, or in old <id>.npy files.
+    '''
+
+    for path in glob.glob(os.path.join(root, '*.npy')):
+        yield os.path.splitext(os.path.basename(path))[0]
+    for index_path in sorted(glob.glob(os.path.join(root, 'tokens-*.idx'))):
+        for doc_id, start, length in read_index(index_path):
+            yield doc_id
+
+
+class Corpus(object):
+    '''
+    Read access to the shards under root. Shards are memory-mapped, so a document's
+    token ids are a zero-copy view, and scanning the corpus reads each shard sequentially.
+    '''
+
+    root = CORPUS_DIR
+
+    def __init__(self, root=CORPUS_DIR):
+        self.root = root
+        self.vocabulary = Vocabulary(os.path.join(root, 'vocab.txt'))
+        self.shards = {}
+        self.offsets = {}
+        for index_path in sorted(glob.glob(os.path.join(root, 'tokens-*.idx'))):
+            shard_path = os.path.splitext(index_path)[0] + '.u32'
+            for doc_id, start, length in read_index(index_path):
+                self.offsets[doc_id] = (shard_path, start, length)
+
+    def shard(self, shard_path):
+        if shard_path not in self.shards:
+            if os.path.getsize(shard_path) == 0:
+                self.shards[shard_path] = np.zeros(0, dtype=DTYPE)
+            else:
+                self.shards[shard_path] = np.memmap(shard_path, dtype=DTYPE, mode='r')
+        return self.shards[shard_path]
+
+    def ids(self, doc_id):
+        '''
+        Returns the token ids of given document, as a view into its shard.
+        '''
+
+        shard_path, start, length = self.offsets[doc_id]
+        return self.shard(shard_path)[start:start + length]
+
+    def tokens(self, doc_id):
+        return self.vocabulary.decode(self.ids(doc_id))
+
+    def __contains__(self, doc_id):
+        return doc_id in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        '''
+        Yields (doc_id, ids) in shard order.
+        '''
+
+        for doc_id, (shard_path, start, length) in sorted(self.offsets.items(), key=lambda item: item[1]):
+            yield doc_id, self.shard(shard_path)[start:start + length]
+
+
+def migrate(root=CORPUS_DIR, remove=False):
+    '''
+    Moves the per-document .npy files of the old corpus format into shards,
+    skipping documents already in them. Removes the .npy files if remove is set.
+    Returns the number of documents migrated.
+    '''
+
+    existing = Corpus(root)
+    writer = CorpusWriter(root)
+    migrated = 0
+    old_bytes = new_bytes = 0
+    try:
+        for path in sorted(glob.glob(os.path.join(root, '*.npy'))):
+            doc_id = os.path.splitext(os.path.basename(path))[0]
+            if doc_id not in existing:
+                tokens = np.load(path).tolist()
+                new_bytes += writer.add(doc_id, tokens)
+                old_bytes += os.path.getsize(path)
+                migrated += 1
+            if remove:
+                os.remove(path)
+    finally:
+        writer.close()
+    print('Migrated {} documents, {} MB to {} MB'.format(migrated, old_bytes // 1024 ** 2, new_bytes // 1024 ** 2))
+    return migrated
+
+
+if __name__ == '__main__':
+    '''
+    Runs if script called on command line
+    '''
+
+    migrate()
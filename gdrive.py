@@ -1,10 +1,45 @@
 from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
+from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from concurrent.futures import ThreadPoolExecutor
 import os
+import threading
+import time
+
+
+# Size of each request of a resumable upload, a multiple of 256 KB
+UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+# Retries of a failed chunk, which resumes from the last byte Drive received
+UPLOAD_RETRIES = 5
+# Uploads running in the background at once
+UPLOAD_WORKERS = 2
+# Size of each request of a download, written to disk as it arrives
+DOWNLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+# Retries of a failed download request
+DOWNLOAD_RETRIES = 5
+# Seconds after which looking up a title missing from the catalog refreshes it
+CATALOG_MAX_AGE = 600
+# Seconds after which a refresh lists the whole folder again, dropping files deleted since
+CATALOG_REBUILD_AGE = 24 * 3600
+
+FOLDER_QUERY = "'root' in parents and trashed=false and title='arxiv' and mimeType='application/vnd.google-apps.folder'"
 
 
 class Gdrive(object):
+	'''
+	Keeps a catalog of the tarfiles in the arxiv folder on Google Drive, by title,
+	refreshed incrementally, and uploads tarfiles to it in the background.
+	Every request goes through the http object of the thread making it, see http.
+	drive may be given instead of connecting, e.g. a fake client.
+	'''
+
 	drive = None
+	folder_id = None
+	catalog = None
+	# Most recent modifiedDate in the catalog, for incremental refreshes
+	catalog_updated = None
+	refreshed = 0
+	rebuilt = 0
 
 
 	def connect(self):
@@ -15,66 +50,201 @@ class Gdrive(object):
 
 	def download(self, file, title):
 	    '''
-	    Downloads given file from Google Drive.
+	    Downloads given file from Google Drive in chunks, each written to disk as it arrives.
 
 	    Parameters
 	    ----------
-	    file : str
-	        The file in the form of a GoogleFile object 
+	    file : dict
+	        The file's metadata, as in the catalog
 	    title : str
 	        The filename of the file
 	    '''
-	        
-	    # Ensure src directory exists 
+
+	    # Ensure src directory exists
 	    if not os.path.isdir('src'):
 	        os.makedirs('src')
-	    
+
 	    # Download file
 	    print('Downloading ' + title + ' from Google Drive...')
-	    file.GetContentFile(title) 
+	    request = self.drive.auth.service.files().get_media(fileId=file['id'])
+	    request.http = self.http
+	    with open(title, 'wb') as f:
+	        downloader = MediaIoBaseDownload(f, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+	        done = False
+	        while not done:
+	            status, done = downloader.next_chunk(num_retries=DOWNLOAD_RETRIES)
 	    print('Successfully downloaded drive://arxiv/{} to {}'.format(os.path.basename(title), title))
 
 
+	def folder(self):
+	    '''
+	    Returns the id of the arxiv folder on Google Drive, creating the folder
+	    if there is none. Looked up once, then cached.
+	    '''
+
+	    if self.folder_id is None:
+	        folders = self.list_files(FOLDER_QUERY)
+	        if folders:
+	            self.folder_id = folders[0]['id']
+	        else:
+	            print('Google Drive does not contain a folder named \'arxiv\'. Creating folder...')
+	            arxiv_folder = self.drive.CreateFile({'title': 'arxiv',
+	                                        "mimeType": "application/vnd.google-apps.folder"})
+	            arxiv_folder.Upload()
+	            self.folder_id = arxiv_folder['id']
+	            print('Folder created.')
+	    return self.folder_id
+
+
+	def list_files(self, query):
+	    '''
+	    Returns the metadata of every file matching given query, one page at a time.
+	    '''
+
+	    files = []
+	    page_token = None
+	    while True:
+	        response = self.drive.auth.service.files().list(q=query, maxResults=1000, pageToken=page_token).execute(http=self.http)
+	        files += response.get('items', [])
+	        page_token = response.get('nextPageToken')
+	        if not page_token:
+	            return files
+
+
+	def refresh(self):
+	    '''
+	    Updates the catalog, which maps titles to file metadata, with the files in the
+	    arxiv folder that are new, modified or trashed since the last refresh.
+	    Every CATALOG_REBUILD_AGE it is rebuilt from the whole folder instead,
+	    as files deleted outright are never listed again.
+	    '''
+
+	    query = "'" + self.folder() + "' in parents"
+	    self.refreshed = time.time()
+	    rebuild = self.refreshed - self.rebuilt > CATALOG_REBUILD_AGE
+	    if rebuild:
+	        query += " and trashed=false"
+	        self.rebuilt = self.refreshed
+	    elif self.catalog_updated:
+	        query += " and modifiedDate > '" + self.catalog_updated + "'"
+	    files = self.list_files(query)
+	    with self.lock:
+	        if rebuild:
+	            self.catalog = {}
+	        for file in files:
+	            if file.get('labels', {}).get('trashed'):
+	                self.catalog.pop(file['title'], None)
+	            else:
+	                self.catalog[file['title']] = file
+	            modified = file.get('modifiedDate')
+	            if modified and (self.catalog_updated is None or modified > self.catalog_updated):
+	                self.catalog_updated = modified
+	    return self.catalog
+
+
 	def get_tarfiles(self):
 	    '''
-	    Gets names of all tarfiles in arxiv folder on Google Drive. 
-	    Returns list of strings, each string representing a name. 
-	    If there is no folder or it is empty, an empty list is returned. 
-	    '''
-	    
-	    tars = []
-	    query = "'root' in parents and trashed=false and title='arxiv' and mimeType='application/vnd.google-apps.folder'"
-	    arxiv_folder_id = self.drive.ListFile({'q': query}).GetList()[0].metadata['id']
-	    
-	    # If folder doesn't exist, create and upload it, exit (we will have to query everything from S3)
-	    if not arxiv_folder_id:
-	        print('Google Drive does not contain a folder named \'arxiv\'. Creating folder...')
-	        arxiv_folder = self.drive.CreateFile({'title': 'arxiv', 
-	                                    "mimeType": "application/vnd.google-apps.folder"}) 
-	        arxiv_folder.Upload()
-	        arxiv_folder_id = arxiv_folder['id']
-	        print('Folder created.')
-	    else:
-	        # Get list of files in arxiv folder
-	        tars = self.drive.ListFile({'q': "'" + arxiv_folder_id + "' in parents and trashed=false"}).GetList()
-	        tars_str = [x.metadata['title'] for x in tars]
-	        tars_str.sort()
-	    
-	    return tars
+	    Gets all tarfiles in arxiv folder on Google Drive.
+	    Returns list of file metadata, refreshing the catalog first.
+	    If there is no folder or it is empty, an empty list is returned.
+	    '''
+
+	    return list(self.refresh().values())
+
+
+	def get(self, title):
+	    '''
+	    Returns the metadata of the file with given title in the arxiv folder, or None.
+	    The catalog is refreshed first if the title isn't in it and it is out of date.
+	    '''
+
+	    if title not in self.catalog and time.time() - self.refreshed > CATALOG_MAX_AGE:
+	        self.refresh()
+	    return self.catalog.get(title)
+
+
+	def __contains__(self, title):
+	    '''
+	    Whether a file with given title is in the arxiv folder or being uploaded there.
+	    '''
+
+	    return title in self.catalog or title in self.uploads
+
+
+	@property
+	def http(self):
+	    '''
+	    Authorized http object of the current thread, as they can't be shared between threads.
+	    '''
+
+	    if not hasattr(self.local, 'http'):
+	        self.local.http = self.drive.auth.Get_Http_Object()
+	    return self.local.http
+
 
 	def upload(self, filepath):
-	    query = "'root' in parents and trashed=false and title='arxiv' and mimeType='application/vnd.google-apps.folder'"
-	    arxiv_folder_id = self.drive.ListFile({'q': query}).GetList()[0].metadata['id']
+	    '''
+	    Uploads given file to the arxiv folder in chunks, with a resumable upload,
+	    so a failed chunk is retried from where Drive left off rather than from the start.
+	    '''
 
+	    title = os.path.basename(filepath)
 	    print("Uploading " + filepath + " to Google Drive...")
-	    file = self.drive.CreateFile({'title': os.path.basename(filepath),
-	                             'parents': [{'id': arxiv_folder_id}], # place it into arxiv folder
-	                             'mimeType': 'application/gzip'})
-	    file.SetContentFile(filepath)
-	    file.Upload()
+	    media = MediaFileUpload(filepath, mimetype='application/gzip', chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+	    request = self.drive.auth.service.files().insert(
+	        body={'title': title,
+	              'parents': [{'id': self.folder()}], # place it into arxiv folder
+	              'mimeType': 'application/gzip'},
+	        media_body=media)
+	    response = None
+	    failures = 0
+	    while response is None:
+	        try:
+	            status, response = request.next_chunk(http=self.http, num_retries=UPLOAD_RETRIES)
+	        except Exception as e:
+	            failures += 1
+	            if failures > UPLOAD_RETRIES:
+	                raise
+	            print('Upload of {} interrupted ({}), resuming...'.format(title, e))
+	            time.sleep(2 ** failures)
+	            continue
+	        if status:
+	            print('Uploaded {:.0f}% of {}'.format(status.progress() * 100, title))
+	    with self.lock:
+	        self.catalog[title] = response
 	    print(filepath + ' uploaded.')
+	    return response
+
+
+	def upload_async(self, filepath):
+	    '''
+	    Starts uploading given file on a background thread, returning a Future.
+	    '''
+
+	    title = os.path.basename(filepath)
+	    future = self.executor.submit(self.upload, filepath)
+	    with self.lock:
+	        self.uploads[title] = future
+	    future.add_done_callback(lambda f: self.uploads.pop(title, None))
+	    return future
+
+
+	def wait_for_uploads(self):
+	    '''
+	    Blocks until every background upload has finished.
+	    '''
 
+	    self.executor.shutdown(wait=True)
+	    self.executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
 
-	def __init__(self):
-		self.connect()
 
+	def __init__(self, drive=None):
+		self.catalog = {}
+		self.uploads = {}
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+		if drive is None:
+			self.connect()
+		else:
+			self.drive = drive
@@ -0,0 +1,202 @@
+import contextlib
+import multiprocessing as mp
+import os
+import threading
+import time
+import psutil
+
+
+# Memory to leave available to everything else, in bytes
+MIN_AVAILABLE_MEMORY = 2 * 1024 ** 3
+# Most memory a job may grow to, in bytes: for conversions the address space limit
+# utils.run_latexmlc sets, while extraction copies through bounded buffers
+JOB_MEMORY = {'convert': 4 * 1024 ** 3, 'extract': 256 * 1024 ** 2}
+# Below this much available memory the governed conversion admitted last is killed, in bytes
+CRITICAL_MEMORY = 512 * 1024 ** 2
+POLL_INTERVAL = 1
+
+KINDS = ['convert', 'extract']
+STATS = ['admitted', 'throttled', 'waited', 'shed', 'peak']
+
+
+class ResourceGovernor(object):
+	'''
+	Admits jobs (latexmlc processes, extractions) only while there is memory for them,
+	in place of sizing pools by CPU count alone. Its state lives in shared memory,
+	so one governor can be handed to every pool worker and caps their combined load.
+	Each admitted job holds one of max_jobs slots and reserves the most memory it may
+	grow to (job_memory, the limit its process runs under), less what its process already
+	uses, so jobs still growing count in full and the memory of running jobs never exceeds
+	what was available less min_available (one job is always let through). The limits
+	themselves are set by whoever starts the process, see utils.run_latexmlc.
+	stats counts admissions, throttling (jobs that had to wait, and the seconds waited),
+	children shed to free memory and the peak number of jobs running at once.
+	'''
+
+	max_jobs = None
+	min_available = MIN_AVAILABLE_MEMORY
+
+	def __init__(self, max_jobs=None, min_available=MIN_AVAILABLE_MEMORY, job_memory=None,
+				critical_memory=CRITICAL_MEMORY, poll_interval=POLL_INTERVAL):
+		self.max_jobs = max_jobs or mp.cpu_count()
+		self.min_available = min_available
+		self.job_memory = dict(JOB_MEMORY, **(job_memory or {}))
+		self.critical_memory = critical_memory
+		self.poll_interval = poll_interval
+		# Per slot: 0 if free, -1 if admitted but its process isn't known yet, else its pid
+		self._pids = mp.Array('i', self.max_jobs)
+		self._memory = mp.Array('d', self.max_jobs, lock=False)
+		self._kinds = mp.Array('i', self.max_jobs, lock=False)
+		# Per slot, the number of its job in order of admission
+		self._order = mp.Array('d', self.max_jobs, lock=False)
+		self._stats = mp.Array('d', len(STATS), lock=False)
+
+	def available(self):
+		return psutil.virtual_memory().available
+
+	def tree_rss(self, pid):
+		'''
+		Resident memory of a process and its children, e.g. latexmlc's image converters.
+		'''
+
+		try:
+			proc = psutil.Process(pid)
+			return proc.memory_info().rss + sum(child.memory_info().rss for child in proc.children(recursive=True))
+		except psutil.Error:
+			return 0
+
+	def reserved(self):
+		'''
+		Memory admitted jobs may still take on top of what they use already.
+		'''
+
+		total = 0
+		for slot, pid in enumerate(self._pids[:]):
+			if pid:
+				total += max(0, self._memory[slot] - (self.tree_rss(pid) if pid > 0 else 0))
+		return total
+
+	def try_admit(self, kind, memory):
+		with self._pids.get_lock():
+			pids = self._pids[:]
+			running = sum(1 for pid in pids if pid)
+			if 0 not in pids:
+				return None
+			# Always let one job run, so a large one can't wait forever
+			if running and self.available() - self.reserved() < self.min_available + memory:
+				return None
+			slot = pids.index(0)
+			self._pids[slot] = -1
+			self._memory[slot] = memory
+			self._kinds[slot] = KINDS.index(kind)
+			self._stats[STATS.index('admitted')] += 1
+			self._order[slot] = self._stats[STATS.index('admitted')]
+			self._stats[STATS.index('peak')] = max(self._stats[STATS.index('peak')], running + 1)
+			return slot
+
+	def admit(self, kind='convert', memory=None):
+		'''
+		Blocks until the job may start, and returns its slot, to be given to attach() and release().
+		'''
+
+		memory = self.job_memory[kind] if memory is None else memory
+		slot = self.try_admit(kind, memory)
+		if slot is not None:
+			return slot
+		starttime = time.monotonic()
+		with self._pids.get_lock():
+			self._stats[STATS.index('throttled')] += 1
+		while slot is None:
+			time.sleep(self.poll_interval)
+			slot = self.try_admit(kind, memory)
+		with self._pids.get_lock():
+			self._stats[STATS.index('waited')] += time.monotonic() - starttime
+		return slot
+
+	def attach(self, slot, pid):
+		'''
+		Records the process whose memory an admitted job grows in.
+		'''
+
+		self._pids[slot] = pid
+
+	def release(self, slot):
+		with self._pids.get_lock():
+			self._pids[slot] = 0
+			self._memory[slot] = 0
+
+	@contextlib.contextmanager
+	def job(self, kind='convert', memory=None, pid=None):
+		'''
+		Holds a slot for the duration of the block, e.g. for an extraction run in the current process.
+		'''
+
+		slot = self.admit(kind, memory)
+		try:
+			self.attach(slot, pid or os.getpid())
+			yield slot
+		finally:
+			self.release(slot)
+
+	def shed(self):
+		'''
+		Kills the conversion admitted last (a latexmlc, or a latexmls server, and everything
+		it started) if available memory is critically low, so one conversion fails instead
+		of the whole box running out of memory, and it is the one that has done the least work.
+		Returns the pid killed, or None.
+		'''
+
+		if self.available() >= self.critical_memory:
+			return None
+		own = os.getpid()
+		candidates = [(self._order[slot], pid) for slot, pid in enumerate(self._pids[:])
+			if pid > 0 and pid != own and KINDS[self._kinds[slot]] == 'convert']
+		if not candidates:
+			return None
+		order, pid = max(candidates)
+		rss = self.tree_rss(pid)
+		print('Memory critically low, killing conversion {} ({:.1f} GB)'.format(pid, rss / 1024 ** 3))
+		try:
+			proc = psutil.Process(pid)
+			for child in proc.children(recursive=True) + [proc]:
+				child.kill()
+		except psutil.Error:
+			return None
+		with self._pids.get_lock():
+			self._stats[STATS.index('shed')] += 1
+		return pid
+
+	def watch(self):
+		'''
+		Starts a daemon thread that sheds load whenever memory runs critically low.
+		'''
+
+		def run():
+			while True:
+				self.shed()
+				time.sleep(self.poll_interval)
+
+		thread = threading.Thread(target=run, daemon=True)
+		thread.start()
+		return thread
+
+	def running(self):
+		'''
+		Returns the number of jobs of each kind running now.
+		'''
+
+		counts = dict.fromkeys(KINDS, 0)
+		for slot, pid in enumerate(self._pids[:]):
+			if pid:
+				counts[KINDS[self._kinds[slot]]] += 1
+		return counts
+
+	@property
+	def stats(self):
+		return dict(zip(STATS, self._stats[:]))
+
+	def __str__(self):
+		stats = self.stats
+		running = ', '.join('{} {}'.format(count, kind) for kind, count in self.running().items())
+		return '{} running, {:.0f} admitted, peak {:.0f} at once, {:.0f} throttled for {:.0f}s in total, {:.0f} shed'.format(
+			running, stats['admitted'], stats['peak'], stats['throttled'], stats['waited'], stats['shed'])
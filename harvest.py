@@ -0,0 +1,298 @@
+import collections
+import datetime
+import email.utils
+import glob
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from oai import OAIPage, COLUMNS, earliest_datestamp
+from throttle import TokenBucket
+
+
+OAI_URL = 'http://export.arxiv.org/oai2'
+# Where pages are checkpointed while a harvest is running
+HARVEST_DIR = 'metadata/harvest'
+SETS = ['physics:astro-ph']
+# Where a harvest starts if the endpoint doesn't report its earliest datestamp: astro-ph opened in April 1992
+FIRST_DATE = datetime.date(1992, 4, 1)
+# Length of the date windows harvested concurrently
+WINDOW_DAYS = 365
+HARVEST_WORKERS = 4
+# Requests per second across all workers, slowed further whenever the server sends Retry-After
+REQUEST_RATE = 0.2
+# Wait when a 503 comes without a usable Retry-After, or the connection fails, in seconds
+DEFAULT_RETRY_AFTER = 30
+MAX_RETRIES = 10
+TIMEOUT = 300
+
+# A slice of the harvest: one set between two dates (inclusive)
+Window = collections.namedtuple('Window', ['set_spec', 'start', 'end'])
+
+
+class OAIError(Exception):
+    pass
+
+
+def date_windows(start, end, days=WINDOW_DAYS):
+    '''
+    Splits the dates from start to end (inclusive) into consecutive (start, end) windows of given length.
+    '''
+
+    windows = []
+    while start <= end:
+        windows.append((start, min(end, start + datetime.timedelta(days=days - 1))))
+        start += datetime.timedelta(days=days)
+    return windows
+
+
+def retry_after(response):
+    '''
+    Returns the seconds to wait given in a response's Retry-After header,
+    which may be a number of seconds or an HTTP date.
+    '''
+
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class Harvester(object):
+    '''
+    Harvests OAI-PMH ListRecords by date window and set, several windows at once.
+    Every request goes through one shared TokenBucket, which a 503's Retry-After
+    pauses for all workers, and each worker thread reuses a keep-alive session.
+    Each page is saved under root as soon as it arrives, along with the resumption
+    token to continue from, so only one page per worker is ever held in memory and
+    an interrupted harvest picks up where it stopped. The rows are read back one window
+    at a time, see windows(); call clear() once they are all stored.
+    '''
+
+    url = OAI_URL
+    workers = HARVEST_WORKERS
+    root = HARVEST_DIR
+
+    def __init__(self, url=OAI_URL, sets=SETS, workers=HARVEST_WORKERS, rate=REQUEST_RATE, window_days=WINDOW_DAYS, root=HARVEST_DIR):
+        self.url = url
+        self.sets = sets
+        self.workers = workers
+        self.window_days = window_days
+        self.root = root
+        self.limiter = TokenBucket(rate, 1)
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_maxsize=1))
+            session.mount('https://', HTTPAdapter(pool_maxsize=1))
+            self.local.session = session
+        return self.local.session
+
+    def fetch(self, params):
+        '''
+        Requests one page, waiting out any 503 (or 429) for as long as the server asks,
+        and a failed connection for DEFAULT_RETRY_AFTER.
+        '''
+
+        for attempt in range(MAX_RETRIES):
+            self.limiter.consume()
+            try:
+                response = self.session.get(self.url, params=params, timeout=TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                print('{}: Waiting {:.0f}s to retry requesting metadata...'.format(type(e).__name__, DEFAULT_RETRY_AFTER))
+                self.limiter.pause(DEFAULT_RETRY_AFTER)
+                continue
+            if response.status_code in (503, 429):
+                wait = retry_after(response)
+                print('{}: Waiting {:.0f}s to retry requesting metadata...'.format(response.status_code, wait))
+                self.limiter.pause(wait)
+                continue
+            response.raise_for_status()
+            return response.content
+        raise OAIError('Gave up on {} after {} retries'.format(params, MAX_RETRIES))
+
+    def earliest_date(self):
+        '''
+        Returns the earliest datestamp the endpoint reports, as no record is dated
+        before it, e.g. 2007 for arXiv, whose datestamps were reset then. Else FIRST_DATE.
+        '''
+
+        datestamp = earliest_datestamp(io.BytesIO(self.fetch({'verb': 'Identify'})))
+        if not datestamp:
+            return FIRST_DATE
+        return datetime.date.fromisoformat(datestamp[:10])
+
+    def plan(self, start=None, end=None):
+        '''
+        Returns the windows to harvest, from start (default: the earliest datestamp)
+        to end (default: today). An unfinished harvest from the same start
+        is resumed with its original end date, so its windows line up with the saved ones.
+        '''
+
+        start = start or self.earliest_date()
+        end = end or datetime.datetime.now(datetime.timezone.utc).date()
+        plan_path = os.path.join(self.root, 'plan.json')
+        plan = {'start': start.isoformat(), 'end': end.isoformat(), 'sets': self.sets, 'window_days': self.window_days}
+        if os.path.isfile(plan_path):
+            with open(plan_path) as f:
+                saved = json.load(f)
+            if all(saved[key] == plan[key] for key in ('start', 'sets', 'window_days')):
+                print('Resuming harvest from {} to {}'.format(saved['start'], saved['end']))
+                plan = saved
+            else:
+                self.clear()
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        write_json(plan_path, plan)
+        end = datetime.date.fromisoformat(plan['end'])
+        return [Window(set_spec, window_start, window_end) for set_spec in self.sets
+                for window_start, window_end in date_windows(start, end, self.window_days)]
+
+    def window_dir(self, window):
+        name = '{}_{}_{}'.format(window.set_spec, window.start, window.end)
+        return os.path.join(self.root, re.sub(r'[^\w.-]', '_', name))
+
+    def harvest_window(self, window):
+        '''
+        Saves every page of given window, following its resumption tokens,
+        from the last saved page on. Returns the number of rows saved.
+        '''
+
+        window_dir = self.window_dir(window)
+        state_path = os.path.join(window_dir, 'state.json')
+        first_params = {'verb': 'ListRecords', 'set': window.set_spec, 'metadataPrefix': 'arXiv',
+                        'from': window.start.strftime('%Y-%m-%d'), 'until': window.end.strftime('%Y-%m-%d')}
+        state = {'params': first_params, 'pages': 0, 'rows': 0}
+        if os.path.isfile(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+        elif not os.path.isdir(window_dir):
+            os.makedirs(window_dir)
+
+        while state['params'] is not None:
+            print('Requesting: {}'.format(state['params']))
+            page = OAIPage(io.BytesIO(self.fetch(state['params'])))
+            rows = list(page)
+            if page.error_code == 'badResumptionToken':
+                # The token expired while we were stopped, so start the window over
+                print('Resumption token expired, restarting {} {}'.format(window.set_spec, window.start))
+                for path in glob.glob(os.path.join(window_dir, 'page-*.parquet')):
+                    os.remove(path)
+                state = {'params': first_params, 'pages': 0, 'rows': 0}
+                continue
+            if page.error_code not in (None, 'noRecordsMatch'):
+                raise OAIError('{}: {}'.format(page.error_code, page.error))
+            if rows:
+                page_path = os.path.join(window_dir, 'page-{:05d}.parquet'.format(state['pages']))
+                pd.DataFrame(rows, columns=COLUMNS).to_parquet(page_path + '.tmp', index=False)
+                os.replace(page_path + '.tmp', page_path)
+                state['pages'] += 1
+                state['rows'] += len(rows)
+            state['params'] = None
+            if page.resumption_token is not None:
+                print('{} {}: {}/{}...'.format(window.set_spec, window.start, state['rows'], page.complete_list_size))
+                state['params'] = {'verb': 'ListRecords', 'resumptionToken': page.resumption_token}
+            # Only now is the page complete, so a restart continues after it
+            write_json(state_path, state)
+        return state['rows']
+
+    def harvest(self, start=None, end=None):
+        '''
+        Harvests every set between the given dates (defaults: the earliest datestamp to today)
+        into root, skipping windows already finished. Returns the number of rows saved.
+        '''
+
+        windows = self.plan(start, end)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return sum(executor.map(self.harvest_window, windows))
+
+    def pages(self):
+        return sorted(glob.glob(os.path.join(self.root, '*', 'page-*.parquet')))
+
+    def latest(self):
+        '''
+        Returns the rows to keep of each saved page, by position: one per identifier, with
+        the most recent datestamp of a record that appears more than once, e.g. cross-listed
+        in several sets. Only the identifier and datestamp columns are read.
+        '''
+
+        paths = self.pages()
+        keys = []
+        for number, path in enumerate(paths):
+            key = pd.read_parquet(path, columns=['identifier', 'datestamp'])
+            key['page'] = number
+            key['row'] = range(len(key))
+            keys.append(key)
+        if not keys:
+            return {}
+        keys = pd.concat(keys, ignore_index=True)
+        keys = keys.sort_values('datestamp', kind='stable', na_position='first').drop_duplicates('identifier', keep='last')
+        return {paths[page]: sorted(rows['row']) for page, rows in keys.groupby('page')}
+
+    def windows(self, mark_stored=True):
+        '''
+        Yields the saved rows of a finished harvest as data frames, one per window, deduplicated as in latest(),
+        so only one window is held in memory at a time. A window counts as stored once
+        the next one is asked for, and isn't yielded again, e.g. after an interrupted update,
+        unless mark_stored is False.
+        '''
+
+        latest = self.latest()
+        for window_dir in sorted(os.path.dirname(path) for path in glob.glob(os.path.join(self.root, '*', 'state.json'))):
+            stored_path = os.path.join(window_dir, 'stored')
+            if os.path.exists(stored_path):
+                continue
+            frames = [pd.read_parquet(path).iloc[latest[path]]
+                      for path in sorted(glob.glob(os.path.join(window_dir, 'page-*.parquet'))) if path in latest]
+            if frames:
+                yield pd.concat(frames, ignore_index=True)
+            if mark_stored:
+                open(stored_path, 'w').close()
+
+    def storing(self):
+        '''
+        Whether some windows have been stored already, i.e. the rows are being stored
+        or storing them was interrupted, so the rest should be stored before harvesting anew.
+        '''
+
+        return len(glob.glob(os.path.join(self.root, '*', 'stored'))) > 0
+
+    def load(self):
+        '''
+        Returns all the saved rows as one data frame, deduplicated as in latest().
+        '''
+
+        frames = list(self.windows(mark_stored=False))
+        if not frames:
+            return pd.DataFrame(columns=COLUMNS)
+        return pd.concat(frames, ignore_index=True)
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def write_json(path, data):
+    '''
+    Writes data to path atomically, so a crash leaves either the old or the new file.
+    '''
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,101 @@
+import hashlib
+import math
+import os
+import re
+
+
+# Old-style ids look like astro-ph/0501001 (astro-ph0501001 once the slash is dropped),
+# new-style ids look like 0704.0009 or 1501.00001, optionally with a version suffix
+VERSION_PATTERN = re.compile(r'v\d+$')
+
+
+def normalize(identifier):
+	'''
+	Returns the form of the given arXiv identifier used as a key in the index,
+	e.g. 'astro-ph/0501001v2' -> 'astro-ph0501001' and '0704.0009v1' -> '0704.0009'.
+	Accepts bare ids as well as tar member names like '0704/0704.0009.gz'.
+	'''
+
+	identifier = os.path.basename(identifier.strip())
+	for ext in ('.gz', '.pdf'):
+		if identifier.endswith(ext):
+			identifier = identifier[:-len(ext)]
+	identifier = identifier.replace('/', '')
+	return VERSION_PATTERN.sub('', identifier)
+
+
+class BloomFilter(object):
+	'''
+	Compact probabilistic set. May report false positives, never false negatives.
+	'''
+
+	def __init__(self, capacity, error_rate=0.01):
+		capacity = max(capacity, 1)
+		self.num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+		self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+		self.bits = bytearray((self.num_bits + 7) // 8)
+
+	def _positions(self, item):
+		digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+	def add(self, item):
+		for pos in self._positions(item):
+			self.bits[pos >> 3] |= 1 << (pos & 7)
+
+	def __contains__(self, item):
+		for pos in self._positions(item):
+			if not self.bits[pos >> 3] & (1 << (pos & 7)):
+				return False
+		return True
+
+
+class IdentifierIndex(object):
+	'''
+	Membership index over the arXiv identifiers we want to extract.
+	Built once from Metadata and shared read-only with pool workers,
+	so a tar member can be checked in O(1) instead of scanning every identifier.
+	'''
+
+	ids = None
+	bloom = None
+
+	def __init__(self, identifiers, use_bloom=False, error_rate=0.01):
+		self.ids = frozenset(normalize(x) for x in identifiers if isinstance(x, str) and x)
+		if use_bloom:
+			self.bloom = BloomFilter(len(self.ids), error_rate)
+			for identifier in self.ids:
+				self.bloom.add(identifier)
+
+	@classmethod
+	def from_metadata(cls, metadata, **kwargs):
+		'''
+		Builds index from the filename_parsed identifiers of a Metadata object.
+		'''
+
+		return cls(metadata.identifiers, **kwargs)
+
+	def __contains__(self, identifier):
+		identifier = normalize(identifier)
+		if self.bloom is not None and identifier not in self.bloom:
+			return False
+		return identifier in self.ids
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __iter__(self):
+		return iter(self.ids)
+
+
+def as_index(identifiers):
+	'''
+	Returns given identifiers as an IdentifierIndex, building one if needed
+	(e.g. when handed the pandas Series from Metadata.identifiers).
+	'''
+
+	if isinstance(identifiers, IdentifierIndex):
+		return identifiers
+	return IdentifierIndex(identifiers)
@@ -0,0 +1,179 @@
+import os
+import queue
+import shutil
+import socket
+import psutil
+
+
+# latexmlc's own per-document timeout, in seconds
+LATEXMLC_TIMEOUT = 240
+
+# Seconds an idle latexmls server lives before exiting
+SERVER_EXPIRE = 600
+# Conversions a latexmls server handles before LaTeXML restarts it
+SERVER_AUTOFLUSH = 100
+# Resident memory above which a latexmls server is recycled, in bytes
+SERVER_MAX_RSS = 2 * 1024 ** 3
+
+# What latexmlc logs when it couldn't reach its server, as opposed to messages about the document
+CONNECTION_ERRORS = ('IO::Socket::INET: connect:', 'Connection refused')
+
+
+class OneShotBackend(object):
+	'''
+	Runs a fresh latexmlc per submission, paying Perl startup and
+	binding loading for every document.
+	'''
+
+	name = 'oneshot'
+
+	def acquire(self):
+		return None
+
+	def release(self, slot):
+		pass
+
+	def command(self, submission, outpath, slot=None, timeout=LATEXMLC_TIMEOUT):
+		return ['latexmlc', '--timeout=' + str(timeout), '--dest=' + outpath, submission]
+
+	def failed_to_connect(self, slot, logfile_path):
+		return False
+
+	def worker_pid(self, slot):
+		'''
+		Returns the pid of the process doing the conversion for given slot,
+		if it isn't the latexmlc that is run, else None.
+		'''
+
+		return None
+
+
+class ServerBackend(OneShotBackend):
+	'''
+	Converts through long-lived latexmls servers, one per concurrent slot,
+	so LaTeXML and its bindings are loaded once per server rather than per document.
+	latexmlc starts the server for a port on first use; LaTeXML restarts it after
+	SERVER_AUTOFLUSH conversions, and we recycle it early if its memory grows past max_rss.
+	As the server is started by a latexmlc run by utils.run_latexmlc, it inherits that
+	latexmlc's address space limit, while a ResourceGovernor accounts for the server's
+	memory rather than the client's, see worker_pid().
+	'''
+
+	name = 'server'
+	available = True
+
+	def __init__(self, slots, expire=SERVER_EXPIRE, autoflush=SERVER_AUTOFLUSH, max_rss=SERVER_MAX_RSS):
+		self.expire = expire
+		self.autoflush = autoflush
+		self.max_rss = max_rss
+		self.connection_failures = 0
+		# Per port, the latexmls serving it once it has been found
+		self.servers = {}
+		self.ports = queue.Queue()
+		for _ in range(slots):
+			self.ports.put(free_port())
+
+	def acquire(self):
+		'''
+		Returns a port whose server isn't busy, blocking until one frees up.
+		'''
+
+		return self.ports.get()
+
+	def release(self, port):
+		self.recycle_if_bloated(port)
+		self.ports.put(port)
+
+	def command(self, submission, outpath, port=None, timeout=LATEXMLC_TIMEOUT):
+		if port is None or not self.available:
+			return OneShotBackend.command(self, submission, outpath, timeout=timeout)
+		return ['latexmlc', '--port=' + str(port), '--expire=' + str(self.expire), '--autoflush=' + str(self.autoflush),
+			'--timeout=' + str(timeout), '--dest=' + outpath, submission]
+
+	def failed_to_connect(self, port, logfile_path):
+		'''
+		Checks the conversion log for signs the server couldn't be reached, in which
+		case the caller should retry one-shot. Gives up on server mode after repeated failures.
+		'''
+
+		if port is None or not self.available or not os.path.isfile(logfile_path):
+			return False
+		with open(logfile_path, errors='replace') as logfile:
+			log = logfile.read()
+		if not any(error in log for error in CONNECTION_ERRORS):
+			return False
+		self.connection_failures += 1
+		if self.connection_failures >= 3:
+			print('latexmls server unavailable, falling back to one-shot latexmlc')
+			self.available = False
+		return True
+
+	def worker_pid(self, port):
+		proc = self.server_process(port) if port is not None and self.available else None
+		return proc.pid if proc is not None else None
+
+	def server_process(self, port):
+		'''
+		Returns the latexmls serving given port, or None if it isn't running.
+		The process table is only searched until the server is found, and again once it has exited.
+		'''
+
+		proc = self.servers.pop(port, None)
+		try:
+			if proc is not None and proc.is_running() and proc.status() != psutil.STATUS_ZOMBIE:
+				self.servers[port] = proc
+				return proc
+		except psutil.Error:
+			pass
+		for proc in psutil.process_iter(['cmdline']):
+			cmdline = proc.info['cmdline'] or []
+			if any('latexmls' in part for part in cmdline) and '--port=' + str(port) in cmdline:
+				self.servers[port] = proc
+				return proc
+		return None
+
+	def recycle_if_bloated(self, port):
+		proc = self.server_process(port)
+		try:
+			if proc is not None and proc.memory_info().rss > self.max_rss:
+				print('Recycling latexmls server on port {}'.format(port))
+				proc.kill()
+		except psutil.NoSuchProcess:
+			pass
+
+	def shutdown(self):
+		while not self.ports.empty():
+			proc = self.server_process(self.ports.get())
+			try:
+				if proc is not None:
+					proc.kill()
+			except psutil.NoSuchProcess:
+				pass
+
+
+def free_port():
+	'''
+	Returns a local TCP port that is free right now.
+	'''
+
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+
+backends = {}
+
+
+def get_backend(name=None, slots=1):
+	'''
+	Returns the conversion backend to use: 'server' (the default, set by ARXIV_LATEXML_BACKEND)
+	when latexmls is installed, otherwise one-shot latexmlc.
+	Backends are created once per process, so their servers are reused across tars.
+	'''
+
+	name = name or os.environ.get('ARXIV_LATEXML_BACKEND', 'server')
+	if name == 'server' and not shutil.which('latexmls'):
+		name = 'oneshot'
+	if (name, slots) not in backends:
+		backends[(name, slots)] = ServerBackend(slots) if name == 'server' else OneShotBackend()
+	return backends[(name, slots)]
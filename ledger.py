@@ -0,0 +1,204 @@
+import contextlib
+import glob
+import os
+import sqlite3
+import threading
+import time
+
+
+LEDGER_PATH = 'ledger.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+	kind TEXT NOT NULL,
+	name TEXT NOT NULL,
+	stage TEXT NOT NULL,
+	status TEXT NOT NULL,
+	parent TEXT,
+	started REAL,
+	finished REAL,
+	seconds REAL,
+	bytes INTEGER,
+	error TEXT,
+	PRIMARY KEY (kind, name, stage)
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (kind, stage, status);
+CREATE INDEX IF NOT EXISTS jobs_by_parent ON jobs (parent, stage);
+CREATE TABLE IF NOT EXISTS conversion_costs (
+	name TEXT PRIMARY KEY,
+	size_bucket INTEGER NOT NULL,
+	tex_files INTEGER NOT NULL,
+	seconds REAL NOT NULL,
+	timed_out INTEGER NOT NULL
+);
+'''
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Ledger(object):
+	'''
+	Transactional record of pipeline progress, replacing file-existence checks for resume.
+	Rows are keyed by (kind, name, stage), where kind is 'tar' or 'submission',
+	and record the status, timings, output size and error class of each stage.
+	Safe to use from several threads and processes: each gets its own connection.
+	'''
+
+	path = None
+
+	def __init__(self, path=LEDGER_PATH):
+		self.path = path
+		self.local = threading.local()
+		is_new = not os.path.isfile(path)
+		self.conn.executescript(SCHEMA)
+		if is_new:
+			self.seed_from_filesystem()
+
+	@property
+	def conn(self):
+		'''
+		Connection for the current thread, reopened after a fork.
+		'''
+
+		if getattr(self.local, 'pid', None) != os.getpid():
+			conn = sqlite3.connect(self.path, timeout=60)
+			conn.execute('PRAGMA journal_mode=WAL')
+			conn.execute('PRAGMA synchronous=NORMAL')
+			self.local.conn = conn
+			self.local.pid = os.getpid()
+		return self.local.conn
+
+	def start(self, kind, name, stage, parent=None):
+		with self.conn as conn:
+			conn.execute('INSERT INTO jobs (kind, name, stage, status, parent, started) VALUES (?, ?, ?, ?, ?, ?) '
+				'ON CONFLICT (kind, name, stage) DO UPDATE SET status = excluded.status, started = excluded.started, '
+				'finished = NULL, seconds = NULL, bytes = NULL, error = NULL, parent = COALESCE(excluded.parent, parent)',
+				(kind, name, stage, RUNNING, parent, time.time()))
+
+	def finish(self, kind, name, stage, size=None, parent=None):
+		self._end(kind, name, stage, DONE, size=size, parent=parent)
+
+	def fail(self, kind, name, stage, error=None, parent=None):
+		error_class = error if error is None or isinstance(error, str) else type(error).__name__
+		self._end(kind, name, stage, FAILED, error=error_class, parent=parent)
+
+	def _end(self, kind, name, stage, status, size=None, error=None, parent=None):
+		now = time.time()
+		with self.conn as conn:
+			updated = conn.execute('UPDATE jobs SET status = ?, finished = ?, seconds = ? - started, bytes = ?, error = ?, '
+				'parent = COALESCE(?, parent) WHERE kind = ? AND name = ? AND stage = ?',
+				(status, now, now, size, error, parent, kind, name, stage)).rowcount
+			if not updated:
+				conn.execute('INSERT INTO jobs (kind, name, stage, status, parent, finished, bytes, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+					(kind, name, stage, status, parent, now, size, error))
+
+	@contextlib.contextmanager
+	def track(self, kind, name, stage, parent=None):
+		'''
+		Marks the stage running for the duration of the block, then done,
+		or failed with the exception's class if one escapes (it is re-raised).
+		Yields a dict in which the block may set 'size' to record the output size.
+		'''
+
+		job = {}
+		self.start(kind, name, stage, parent)
+		try:
+			yield job
+		except BaseException as e:
+			self.fail(kind, name, stage, e)
+			raise
+		self.finish(kind, name, stage, size=job.get('size'))
+
+	def status(self, kind, name, stage):
+		row = self.conn.execute('SELECT status FROM jobs WHERE kind = ? AND name = ? AND stage = ?',
+			(kind, name, stage)).fetchone()
+		return row[0] if row else None
+
+	def is_done(self, kind, name, stage):
+		return self.status(kind, name, stage) == DONE
+
+	def names(self, kind, stage, statuses=(DONE,)):
+		'''
+		Returns the set of names with the given stage in any of the given statuses,
+		in one indexed query, for bulk resume checks.
+		'''
+
+		placeholders = ', '.join('?' * len(statuses))
+		rows = self.conn.execute('SELECT name FROM jobs WHERE kind = ? AND stage = ? AND status IN (' + placeholders + ')',
+			(kind, stage) + tuple(statuses))
+		return set(row[0] for row in rows)
+
+	def reset(self, kind, name, stage=None):
+		'''
+		Forgets the given stage (or all stages) of a job, so it will be redone.
+		'''
+
+		with self.conn as conn:
+			if stage is None:
+				conn.execute('DELETE FROM jobs WHERE kind = ? AND name = ?', (kind, name))
+			else:
+				conn.execute('DELETE FROM jobs WHERE kind = ? AND name = ? AND stage = ?', (kind, name, stage))
+
+	def record_cost(self, name, size_bucket, tex_files, seconds, timed_out=False):
+		'''
+		Records how long converting a submission with the given features took,
+		for scheduler.CostModel. A timed out run records the timeout, a lower bound.
+		'''
+
+		with self.conn as conn:
+			conn.execute('INSERT OR REPLACE INTO conversion_costs (name, size_bucket, tex_files, seconds, timed_out) VALUES (?, ?, ?, ?, ?)',
+				(name, size_bucket, tex_files, seconds, int(timed_out)))
+
+	def cost_stats(self):
+		'''
+		Returns (size_bucket, tex_files, runs, total seconds) of the recorded conversions.
+		'''
+
+		return self.conn.execute('SELECT size_bucket, tex_files, COUNT(*), SUM(seconds) FROM conversion_costs '
+			'GROUP BY size_bucket, tex_files').fetchall()
+
+	def seed_from_filesystem(self):
+		'''
+		Records the progress left behind by runs from before the ledger existed:
+		latex/<tar>.txt logs, xml/<id>.xml outputs and logs/<id>.txt conversion attempts.
+		Only run once, when the ledger is created. Parses are seeded by parser_ec2, see seed_parsed().
+		'''
+
+		rows = []
+		for path in glob.glob('latex/*.txt'):
+			# A leftover latex/<tar>/ directory means the tar was still being worked on
+			if os.path.isdir(os.path.splitext(path)[0]):
+				continue
+			rows.append(('tar', 'src/' + os.path.splitext(os.path.basename(path))[0] + '.tar', 'convert', DONE, None))
+		attempted = set(os.path.splitext(os.path.basename(path))[0] for path in glob.glob('logs/*.txt'))
+		attempted -= set(['pdf_submissions', 'failed_conversions_log'])
+		converted = set(os.path.splitext(os.path.basename(path))[0] for path in glob.glob('xml/*.xml'))
+		for submission_id in attempted | converted:
+			rows.append(('submission', submission_id, 'convert', DONE if submission_id in converted else FAILED, None))
+		with self.conn as conn:
+			conn.executemany('INSERT OR IGNORE INTO jobs (kind, name, stage, status, error) VALUES (?, ?, ?, ?, ?)', rows)
+
+	def seed_parsed(self, doc_ids):
+		'''
+		Records the given documents, already in the corpus, as parsed, e.g. by runs
+		from before the ledger existed. Documents the ledger knows of are left alone.
+		'''
+
+		with self.conn as conn:
+			conn.executemany('INSERT OR IGNORE INTO jobs (kind, name, stage, status, error) VALUES (?, ?, ?, ?, ?)',
+				(('submission', doc_id, 'parse', DONE, None) for doc_id in doc_ids))
+
+
+ledgers = {}
+
+
+def get_ledger(path=LEDGER_PATH):
+	'''
+	Returns the ledger at given path, opening it once per process.
+	'''
+
+	if path not in ledgers:
+		ledgers[path] = Ledger(path)
+	return ledgers[path]
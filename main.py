@@ -1,104 +1,183 @@
 from metadata import Metadata
 from gdrive import Gdrive
 from amazon_s3 import Amazon_S3
+from identifier_index import IdentifierIndex
+from throttle import TokenBucket
+from pipeline import Pipeline
+from storage import TarStore, LocalTier, DriveTier, S3Tier
+from governor import ResourceGovernor
+from ledger import get_ledger
+import manifest
 import utils
 import os
 import multiprocessing as mp
 import shutil
+import threading
 import traceback
 import time
 
 global g
-global gdrive_tarfiles
 global s3
 global m
+global index
+global checksums
+global limiter
+global store
+global governor
 
+# Stream tars from S3 instead of downloading them to src/ first
+STREAM_FROM_S3 = False
 
-def work(key):
+# Only download tars from these months (inclusive, e.g. '0704'), None for no bound
+START_YYMM = None
+END_YYMM = None
+
+# Combined download rate of all workers in bytes per second, None for no cap
+BANDWIDTH_LIMIT = None
+
+# Disk space for tars kept in src/ after processing, so later runs (e.g. for another
+# category) needn't fetch them again, in bytes
+TAR_CACHE_BUDGET = 20 * 1024 ** 3
+
+# Workers per pipeline stage
+DOWNLOAD_WORKERS = 2
+EXTRACT_WORKERS = 2
+CONVERT_WORKERS = 2
+UPLOAD_WORKERS = 1
+# Each convert worker runs utils.LATEXMLC_THREADS latexmlc processes at once
+
+# Only admit another tar while this much disk and memory (in bytes) is free
+MIN_FREE_DISK = 5 * 1024 ** 3
+MIN_FREE_MEMORY = 2 * 1024 ** 3
+# Only start another latexmlc or extraction while this much memory (in bytes) would stay available
+MIN_AVAILABLE_MEMORY = 2 * 1024 ** 3
+
+
+def init_worker(shared_index, shared_checksums=None, shared_limiter=None, shared_governor=None):
 	'''
-	Defines the work to be done in each multiprocessing worker.
+	Runs once in each pool worker, keeping its own reference to the identifier index,
+	the manifest checksums, the bandwidth limiter and the resource governor,
+	so they are not pickled again for every task.
 	'''
-	
-	global g
-	global s3
-	global m
 
-	try:
-		print('{} is working on {}...'.format(mp.current_process(), key))
-		downloaded_filename = ''.join(['latex/', os.path.splitext(os.path.basename(key))[0]])
-
-		# If .txt exists, it's already been processed
-		if os.path.isfile(downloaded_filename + '.txt'):
-			print('{} has already been fully processed!'.format(key))
-			return
-
-		gtar = None
-		for gfile in gdrive_tarfiles:
-			if gfile.metadata['title'] == os.path.basename(key):
-				gtar = gfile
-		
-		#if tarfile is on local storage, extract it from here
+	global index
+	global checksums
+	global limiter
+	global governor
+	index = shared_index
+	checksums = shared_checksums or {}
+	limiter = shared_limiter
+	governor = shared_governor
+
+
+def get_tar_dir(key):
+	return ''.join(['latex/', os.path.splitext(os.path.basename(key))[0]])
+
+
+def fetch(key):
+	'''
+	Download stage, run on threads. Makes the tar available locally from the first
+	storage tier that has it (unless it will be streamed from S3) and returns its key.
+	The tar stays pinned in the local cache until the upload stage releases it.
+	'''
+
+	print('{} is fetching {}...'.format(threading.current_thread().name, key))
+
+	ledger = get_ledger()
+	if ledger.is_done('tar', key, 'convert'):
+		print('{} has already been fully processed!'.format(key))
+		return None
+
+	with ledger.track('tar', key, 'download') as job:
+		# Local cache, then Google Drive, then S3, unless it will be
+		# streamed from S3 during extraction
+		if store.acquire(key, stream=STREAM_FROM_S3) is not None:
+			job['size'] = os.path.getsize(key)
+	return key
+
+
+def extract(key):
+	'''
+	Extract stage, run in a process pool.
+	'''
+
+	print('{} is extracting {}...'.format(mp.current_process(), key))
+	with get_ledger().track('tar', key, 'extract'), governor.job('extract'):
 		if os.path.isfile(key):
-			utils.extract(key, m.identifiers)
-			if len(os.listdir(downloaded_filename)) > 0:
-				utils.convert(downloaded_filename)
-			else:
-				print(key + ' contains no astro-ph submissions.')
-			os.remove(key)
-			shutil.rmtree(downloaded_filename, ignore_errors=True)
-			# print('Completed and removed {}'.format(key))
-		# If tarfile is in Google Drive, extract it from there
-		elif gtar:
-			g.download(gtar, key)
-			utils.extract(key, m.identifiers)
-			if len(os.listdir(downloaded_filename)) > 0:
-				utils.convert(downloaded_filename)
-			else:
-				print('Tarfile contains no astro-ph submissions.')
-			os.remove(key)
-			shutil.rmtree(downloaded_filename, ignore_errors=True)
-			print('Completed and removed {}'.format(key))
-		# Otherwise, extract it from S3
+			utils.extract(key, index)
 		else:
-			s3.download_file(key)
-			utils.extract(key, m.identifiers)
-			if len(os.listdir(downloaded_filename)) > 0:
-				try:
-					utils.convert(downloaded_filename)
-				except Exception:
-					print('Just catching this thing here...')
-			else:
-				print('Tarfile contains no astro-ph submissions.')
-			g.upload(key)
-			os.remove(key)
-			shutil.rmtree(downloaded_filename, ignore_errors=True)
-			print('Completed and removed {}'.format(key))
-	except KeyboardInterrupt:
-		# If interrupted, remove the downloaded filename, so that any incomplete downloads aren't recognized as complete
-		print('INTERRUPTED: ' + downloaded_filename)
-		if os.path.isdir(downloaded_filename):
-			print('Removing ' + downloaded_filename)
-			shutil.rmtree(downloaded_filename, ignore_errors=True)
-		if os.path.isdir('temp'):
-			print('Removing ./temp')
-			shutil.rmtree('temp', ignore_errors=True)
-		if os.path.isfile(downloaded_filename + '.txt'):
-			print('Removing ' + downloaded_filename + '.txt')
-			os.remove(downloaded_filename + '.txt')
-		os.exit(2)
-	except Exception as e:
-		print('\nSomething went wrong: {}'.format(e))
-		traceback.print_exc()
-		if os.path.isdir(downloaded_filename):
-			print('Removing ' + downloaded_filename)
-			shutil.rmtree(downloaded_filename, ignore_errors=True)
-		if os.path.isdir('temp'):
-			print('Removing ./temp')
-			shutil.rmtree('temp', ignore_errors=True)
-		if os.path.isfile(downloaded_filename + '.txt'):
-			print('Removing ' + downloaded_filename + '.txt')
-			os.remove(downloaded_filename + '.txt')
-		os.exit(2)
+			# Extract matching submissions while the tar is still arriving, never staging it on disk
+			body = s3.open_stream(key)
+			try:
+				utils.extract_stream(body, key, index)
+			finally:
+				body.close()
+	return key
+
+
+def upload(key):
+	'''
+	Upload stage, run on a thread alongside conversion.
+	Hands tars that came from S3 to Gdrive's background uploads, which release
+	the tar to the cache when done, so the pipeline never waits on an upload.
+	'''
+
+	if not os.path.isfile(key):
+		# Streamed, nothing was kept
+		return key
+	if os.path.basename(key) in g:
+		store.release(key)
+		return key
+	get_ledger().start('tar', key, 'upload')
+	size = os.path.getsize(key)
+	g.upload_async(key).add_done_callback(lambda future: uploaded(key, size, future))
+	return key
+
+
+def uploaded(key, size, future):
+	'''
+	Records a finished background upload, then releases the tar to the cache.
+	'''
+
+	ledger = get_ledger()
+	if future.exception() is not None:
+		print('Upload of {} failed: {}'.format(key, future.exception()))
+		ledger.fail('tar', key, 'upload', future.exception())
+	else:
+		ledger.finish('tar', key, 'upload', size=size)
+	store.release(key)
+
+
+def convert(key):
+	'''
+	Convert stage, run in a process pool.
+	'''
+
+	print('{} is converting {}...'.format(mp.current_process(), key))
+	tar_dir = get_tar_dir(key)
+	with get_ledger().track('tar', key, 'convert'):
+		if len(os.listdir(tar_dir)) > 0:
+			utils.convert(tar_dir, workers=utils.LATEXMLC_THREADS, governor=governor)
+		else:
+			print(key + ' contains no astro-ph submissions.')
+	shutil.rmtree(tar_dir, ignore_errors=True)
+	print('Completed and removed {}'.format(key))
+	return key
+
+
+def cleanup(key):
+	'''
+	Removes partial output for a tar that failed or was interrupted.
+	The ledger already records it as failed, so it will be redone next run.
+	'''
+
+	tar_dir = get_tar_dir(key)
+	if os.path.isdir(tar_dir):
+		print('Removing ' + tar_dir)
+		shutil.rmtree(tar_dir, ignore_errors=True)
+	if os.path.isfile(tar_dir + '.txt'):
+		print('Removing ' + tar_dir + '.txt')
+		os.remove(tar_dir + '.txt')
 
 
 def main():
@@ -106,41 +185,77 @@ def main():
 	global m
 	m = Metadata(update=True)
 	print('Identifiers collected: {}'.format(len(m.identifiers)))
+	global index
+	index = IdentifierIndex.from_metadata(m)
 
 	# Connect to Google Drive
 	global g
-	global gdrive_tarfiles
 	g = Gdrive() 
-	gdrive_tarfiles = g.get_tarfiles()
-	print('Tarfiles on Google Drive: {}'.format(len(gdrive_tarfiles)))
+	print('Tarfiles on Google Drive: {}'.format(len(g.get_tarfiles())))
 
-	# Connect to Amazon S3 and get page iterator
+	# Connect to Amazon S3 and plan which tars to download from its manifest
 	global s3
 	s3 = Amazon_S3()
+	s3.download_file(manifest.MANIFEST_KEY)
+	plan = manifest.plan_downloads(manifest.parse_manifest(), index, START_YYMM, END_YYMM)
+	print('Download plan: {}'.format(plan))
+	global checksums
+	global limiter
+	checksums = {entry.key: entry.md5 for entry in plan.entries}
+	limiter = TokenBucket(BANDWIDTH_LIMIT) if BANDWIDTH_LIMIT else None
+
+	# Tars are looked for in the local cache, then Google Drive, then S3
+	global store
+	store = TarStore(LocalTier('src', TAR_CACHE_BUDGET), [DriveTier(g), S3Tier(s3, checksums, limiter)])
 
-	# Set up the parallel task pool to use all available processors
-	pool = mp.Pool(processes=mp.cpu_count())
+	# Every latexmlc process and extraction waits for memory to be available, across all workers
+	global governor
+	governor = ResourceGovernor(max_jobs=CONVERT_WORKERS * utils.LATEXMLC_THREADS + EXTRACT_WORKERS,
+		min_available=MIN_AVAILABLE_MEMORY, job_memory={'convert': utils.MEMORY_LIMIT})
+	governor.watch()
 
-	# Iterate through each page
+	# Collect all planned tars if they haven't already been processed
+	processed = get_ledger().names('tar', 'convert')
+	tasks = [key for key in plan.keys if key not in processed]
+
+	# Set up the stages, each with its own workers, connected by bounded queues
+	p = Pipeline(min_free_disk=MIN_FREE_DISK, min_free_memory=MIN_FREE_MEMORY,
+		initializer=init_worker, initargs=(index, checksums, limiter, governor))
+	download_stage = p.add_stage('download', fetch, workers=DOWNLOAD_WORKERS, kind='thread')
+	extract_stage = p.add_stage('extract', extract, workers=EXTRACT_WORKERS, kind='process', after=download_stage)
+	p.add_stage('upload', upload, workers=UPLOAD_WORKERS, kind='thread', after=extract_stage)
+	p.add_stage('convert', convert, workers=CONVERT_WORKERS, kind='process', after=extract_stage)
+
+	interrupted = []
 	try:
-		for page in s3.get_page_iterator():
-			# Collect all tars on that page if they haven't already been downloaded 
-			tasks = [file['Key'] for file in page['Contents'] if file['Key'].endswith('.tar') and not os.path.isdir(''.join(['latex/', os.path.splitext(os.path.basename(file['Key']))[0]]))]
-			# Run the jobs 
-			pool.map_async(work, tasks)
+		completed, failures = p.run(tasks)
+		print('Converted {} tars, {} failures'.format(sum(1 for stage_name, key in completed if stage_name == 'convert'), len(failures)))
+		for stage_name, key, e in failures:
+			if stage_name in ('extract', 'convert'):
+				cleanup(key)
+			# The upload stage won't run for it, so nothing else will release it
+			if stage_name in ('download', 'extract'):
+				store.release(key)
 	except KeyboardInterrupt:
 		print('\nYou interrupted the script!')
+		p.cancel()
+		# None of them is recorded as converted, so they are redone next run
+		interrupted = p.in_flight()
+		for key in interrupted:
+			cleanup(key)
 	except Exception as e:
 		print('\nSomething went wrong: {}'.format(e))
 		traceback.print_exc()
-	finally: # IMPORTANT TO HAVE FINALLY, NOT ELSE, TO ALLOW ALL WORKERS FINISH HANDLING KEYBOARDINTERRUPT BEFORE POOL ENDS
-		pool.close() # necessary for zombies
-		pool.join() # wait for all processes to finish
+	finally:
+		print('Waiting for uploads to Google Drive...')
+		g.wait_for_uploads()
+		# Only now, as an upload still running may be reading the tar
+		for key in interrupted:
+			store.release(key)
+		print('Tar storage: {}'.format(store))
+		print('Resources: {}'.format(governor))
 		print('The end.') 
-			
-		# May need to close pool here at the end of everything...?
 
 
 if __name__ == "__main__":
 	main()
-
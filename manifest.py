@@ -0,0 +1,130 @@
+import bisect
+import collections
+import re
+import xml.etree.ElementTree as ET
+from identifier_index import normalize
+
+
+MANIFEST_KEY = 'src/arXiv_src_manifest.xml'
+
+# Requester-pays transfer out of us-east-1, in USD per GB
+PRICE_PER_GB = 0.09
+
+OLD_STYLE_PATTERN = re.compile(r'^[a-z\-]+(\d{4})(\d{3})$')
+NEW_STYLE_PATTERN = re.compile(r'^(\d{4})\.(\d{4,5})$')
+
+# One row of the manifest, i.e. one tar in the arxiv bucket
+ManifestEntry = collections.namedtuple('ManifestEntry', ['key', 'size', 'md5', 'yymm', 'first_item', 'last_item'])
+
+
+def parse_manifest(manifest_path=MANIFEST_KEY):
+	'''
+	Parses the bucket manifest into a list of ManifestEntry,
+	one per tar, streaming through the XML instead of loading it whole.
+	'''
+
+	entries = []
+	for event, elem in ET.iterparse(manifest_path, events=('end',)):
+		if elem.tag != 'file':
+			continue
+		entries.append(ManifestEntry(
+			key=elem.findtext('filename'),
+			size=int(elem.findtext('size') or 0),
+			md5=elem.findtext('md5sum'),
+			yymm=elem.findtext('yymm'),
+			first_item=elem.findtext('first_item'),
+			last_item=elem.findtext('last_item')))
+		elem.clear()
+	return entries
+
+
+def month_key(yymm):
+	'''
+	Returns a yymm as yyyymm, so months compare in order across the 1999/2000 boundary,
+	e.g. 9501 before 0704. arXiv started in 1991, so 9x is 199x and anything else 20xx.
+	'''
+
+	return ('19' if yymm[0] >= '9' else '20') + yymm
+
+
+def split_identifier(identifier):
+	'''
+	Returns (yymm, number) for an old-style (astro-ph0501001) or
+	new-style (0704.0009) identifier, or None if it is neither.
+	'''
+
+	identifier = normalize(identifier)
+	match = NEW_STYLE_PATTERN.match(identifier) or OLD_STYLE_PATTERN.match(identifier)
+	if match is None:
+		return None
+	return match.group(1), int(match.group(2))
+
+
+class DownloadPlan(object):
+	'''
+	The tars that can contain wanted submissions, with the bytes (and requester-pays cost)
+	it will take to download them.
+	'''
+
+	entries = None
+	total_bytes = 0
+
+	def __init__(self, entries):
+		self.entries = entries
+		self.total_bytes = sum(entry.size for entry in entries)
+
+	@property
+	def keys(self):
+		return [entry.key for entry in self.entries]
+
+	def estimated_cost(self, price_per_gb=PRICE_PER_GB):
+		return self.total_bytes / 1e9 * price_per_gb
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __str__(self):
+		return '{} tars, {:.1f} GB, ~${:.2f} requester-pays transfer'.format(
+			len(self.entries), self.total_bytes / 1e9, self.estimated_cost())
+
+
+def plan_downloads(entries, identifiers, start_yymm=None, end_yymm=None):
+	'''
+	Intersects manifest entries with the wanted identifiers,
+	returning a DownloadPlan of the tars that can contain them.
+	Tars are matched on yymm; new-style tars are further pruned by their
+	first/last item range. start_yymm and end_yymm (inclusive, e.g. '0704')
+	bound the run by date.
+	'''
+
+	# Collect the wanted item numbers per month
+	start_key = month_key(start_yymm) if start_yymm else None
+	end_key = month_key(end_yymm) if end_yymm else None
+	wanted = collections.defaultdict(list)
+	for identifier in identifiers:
+		parts = split_identifier(identifier) if isinstance(identifier, str) else None
+		if parts is None:
+			continue
+		yymm, number = parts
+		if (start_key and month_key(yymm) < start_key) or (end_key and month_key(yymm) > end_key):
+			continue
+		wanted[yymm].append(number)
+	for numbers in wanted.values():
+		numbers.sort()
+
+	planned = []
+	for entry in entries:
+		if entry.yymm not in wanted:
+			continue
+		first = NEW_STYLE_PATTERN.match(entry.first_item or '')
+		last = NEW_STYLE_PATTERN.match(entry.last_item or '')
+		# Old-style tars hold every archive for the month, so yymm is all we can go by
+		if first and last:
+			low, high = int(first.group(2)), int(last.group(2))
+			numbers = wanted[entry.yymm]
+			i = bisect.bisect_left(numbers, low)
+			if i == len(numbers) or numbers[i] > high:
+				continue
+		planned.append(entry)
+
+	return DownloadPlan(planned)
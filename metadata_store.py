@@ -0,0 +1,107 @@
+import glob
+import os
+import pandas as pd
+
+
+METADATA_DIR = 'metadata'
+METADATA_CSV = 'arxiv_metadata_astroph.csv'
+# Columns with few distinct values, stored dictionary-encoded and loaded as categoricals
+CATEGORICAL = ['categories', 'spec']
+# dtypes the CSV had to be read with
+CSV_DTYPES = {'filename': str, 'filename_parsed': str, 'identifier': str, 'updated': str, 'doi': str}
+# Rows per Parquet row group, the unit lookups by filename_parsed skip over
+ROW_GROUP_SIZE = 10000
+
+
+class MetadataStore(object):
+    '''
+    Metadata kept as Parquet partitions under root, one per update, so an update
+    appends a partition rather than rewriting everything. Each partition is sorted
+    by filename_parsed, so the min/max statistics of its row groups act as an index on it,
+    and only the columns asked for are read.
+    '''
+
+    root = METADATA_DIR
+
+    def __init__(self, root=METADATA_DIR):
+        self.root = root
+
+    def partitions(self):
+        return sorted(glob.glob(os.path.join(self.root, 'part-*.parquet')))
+
+    def __bool__(self):
+        return len(self.partitions()) > 0
+
+    def append(self, df):
+        '''
+        Writes given rows as a new partition.
+        '''
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        df = df.sort_values('filename_parsed').reset_index(drop=True)
+        for column in CATEGORICAL:
+            if column in df:
+                df[column] = df[column].astype('category')
+        partitions = self.partitions()
+        number = int(os.path.basename(partitions[-1])[5:10]) + 1 if partitions else 0
+        path = os.path.join(self.root, 'part-{:05d}.parquet'.format(number))
+        # Write under a temporary name first, so a crash never leaves a partial partition
+        df.to_parquet(path + '.tmp', index=False, row_group_size=ROW_GROUP_SIZE)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def load(self, columns=None, filters=None):
+        '''
+        Returns the metadata as a data frame, reading only the given columns
+        and the rows matching the given pyarrow filters, if any.
+        '''
+
+        partitions = self.partitions()
+        if not partitions:
+            return pd.DataFrame(columns=columns)
+        df = pd.concat([pd.read_parquet(path, columns=columns, filters=filters) for path in partitions],
+                       ignore_index=True, sort=False)
+        # Partitions may have different categories, which concat turns into objects
+        for column in CATEGORICAL:
+            if column in df:
+                df[column] = df[column].astype('category')
+        return df
+
+    def get(self, filename_parsed, columns=None):
+        '''
+        Returns the rows for given identifier, skipping partitions whose
+        statistics show they don't contain it.
+        '''
+
+        return self.load(columns, filters=[('filename_parsed', '==', filename_parsed)])
+
+    def identifiers(self):
+        return self.load(['filename_parsed'])['filename_parsed']
+
+    def last_retrieved(self):
+        '''
+        Returns the latest date_retrieved, as a UTC timestamp, or None if empty.
+        '''
+
+        if not self:
+            return None
+        date = self.load(['date_retrieved'])['date_retrieved'].max()
+        return date.tz_localize('UTC') if date.tzinfo is None else date
+
+    def import_csv(self, csv_path=METADATA_CSV):
+        '''
+        Moves the metadata in the old CSV format into a partition.
+        '''
+
+        df = pd.read_csv(csv_path, dtype=CSV_DTYPES, parse_dates=['date_retrieved'])
+        print('Importing {} rows from {}'.format(len(df), csv_path))
+        return self.append(df)
+
+
+def load_metadata(columns=None, root=METADATA_DIR):
+    '''
+    Returns the stored metadata, e.g. for notebooks, instead of re-reading the CSV.
+    '''
+
+    return MetadataStore(root).load(columns)
@@ -0,0 +1,101 @@
+from lxml import etree
+
+
+# Columns of a metadata row, in order, and the OAI arXiv-format elements they come from
+COLUMNS = ['identifier', 'filename', 'spec', 'title', 'datestamp', 'created', 'updated',
+           'authors', 'categories', 'journal', 'doi', 'abstract', 'comments']
+FIELDS = {
+    'identifier': 'identifier',
+    'id': 'filename',
+    'setSpec': 'spec',
+    'title': 'title',
+    'datestamp': 'datestamp',
+    'created': 'created',
+    'updated': 'updated', # may have more than one instance that we're missing
+    'categories': 'categories',
+    'journal-ref': 'journal',
+    'doi': 'doi',
+    'abstract': 'abstract',
+    'comments': 'comments',
+}
+
+
+def localname(element):
+    tag = element.tag
+    return tag.rpartition('}')[2] if isinstance(tag, str) else None
+
+
+def text(element):
+    return ''.join(element.itertext())
+
+
+def parse_record(record):
+    '''
+    Returns the row for an OAI <record> element, taking the first of each element.
+    '''
+
+    row = dict.fromkeys(COLUMNS)
+    authors = []
+    for element in record.iter():
+        name = localname(element)
+        if name == 'author':
+            forenames = keyname = None
+            for part in element.iter():
+                part_name = localname(part)
+                if part_name == 'forenames' and forenames is None:
+                    forenames = text(part)
+                elif part_name == 'keyname' and keyname is None:
+                    keyname = text(part)
+            if forenames and keyname:
+                authors.append(forenames.strip() + ' ' + keyname.strip())
+        elif name in FIELDS and row[FIELDS[name]] is None:
+            row[FIELDS[name]] = text(element)
+    row['authors'] = ', '.join(authors)
+    return row
+
+
+def earliest_datestamp(source):
+    '''
+    Returns the earliestDatestamp of an Identify response from a file-like source, or None.
+    '''
+
+    for event, element in etree.iterparse(source, events=('end',)):
+        if localname(element) == 'earliestDatestamp':
+            return element.text.strip() if element.text else None
+    return None
+
+
+class OAIPage(object):
+    '''
+    Parses a ListRecords response incrementally from a file-like source,
+    yielding a row per record as soon as it has been read, then freeing it.
+    After iteration, resumption_token, cursor and complete_list_size are set
+    from the page's resumptionToken (resumption_token is None on the last page),
+    and error_code and error to an OAI error, e.g. noRecordsMatch, if there was one.
+    '''
+
+    resumption_token = None
+    cursor = None
+    complete_list_size = None
+    error_code = None
+    error = None
+
+    def __init__(self, source):
+        self.source = source
+
+    def __iter__(self):
+        for event, element in etree.iterparse(self.source, events=('end',)):
+            name = localname(element)
+            if name == 'record':
+                yield parse_record(element)
+                element.clear()
+                # Drop the records already handled from the tree too
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            elif name == 'resumptionToken':
+                self.resumption_token = element.text or None
+                self.cursor = element.get('cursor')
+                self.complete_list_size = element.get('completeListSize')
+            elif name == 'error':
+                self.error_code = element.get('code')
+                self.error = element.text
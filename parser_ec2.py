@@ -1,10 +1,12 @@
 import os
 import glob
 import utils
+from corpus import CorpusWriter, doc_ids
+from ledger import get_ledger
 import re
 from bs4 import BeautifulSoup
-import nltk
-import numpy as np
+from lxml import etree
+import tokenizer
 import traceback, sys
 import multiprocessing as mp
 import time
@@ -13,16 +15,18 @@ class Parser(object):
     '''
     Parses corpus, utilizing multiprocessing.
     Input: XML files from ./xml/
-    Output: Parsed .npy files into ./corpus/ 
+    Output: Token ids of parsed documents into shards in ./corpus/, see corpus.py
     '''
 
     soup = None
     parenthetical_citations = 0
     intext_citations = 0
     xml_folder = 'xml'
+    numeric_authors = re.compile(r'^[(]?\d*[)]?$')
 
     def __init__(self):
-        pass
+        self.bib_authors = {}
+        self.numeric_keys = {}
     
     def remove_stuff(self, section):
         titles = section.find_all('title', recursive=True)
@@ -69,19 +73,67 @@ class Parser(object):
         for error in errors:
             error.decompose()
             
-    def render_authors(self, citation, bib_item):
-        intext_citations = 0
-        
-        authors = bib_item.find(attrs={'role': 'refnum'}, recursive=True)
-        if authors != None and authors.text != None:
+    def index_bibitems(self):
+        '''
+        Maps each bibitem key to the text of its refnum tag (None if it has none),
+        once per document, so citations don't each search the whole tree.
+        '''
+
+        self.bib_authors = {}
+        self.numeric_keys = {}
+        for bib_item in self.soup.find_all('bibitem'):
+            key = bib_item.get('key')
+            if key is not None and key not in self.bib_authors:
+                authors = bib_item.find(attrs={'role': 'refnum'}, recursive=True)
+                self.bib_authors[key] = authors.text if authors != None and authors.text != None else None
+
+    def is_numeric(self, key):
+        '''
+        Returns whether the authors text of given bibitem is numeric only, e.g. '(12)',
+        checking each bibitem once.
+        '''
+
+        if key not in self.numeric_keys:
+            self.numeric_keys[key] = bool(self.numeric_authors.match(self.bib_authors[key].strip()))
+        return self.numeric_keys[key]
+
+    def resolve_citation(self, bibrefs):
+        '''
+        Resolves every key in a citation's bibrefs, e.g. 'a,b'. Returns (outcome, text) where outcome is
+        'missing' if no key has a bibitem, 'intext' with the joined author strings to render,
+        'no_authors' if a bibitem lacks authors, or 'numeric' if the authors are only numbers.
+        '''
+
+        keys = [key.strip() for key in bibrefs.split(',') if key.strip() in self.bib_authors]
+        if not keys:
+            return 'missing', None
+        rendered = []
+        missing_authors = False
+        for key in keys:
+            if self.bib_authors[key] is None:
+                missing_authors = True
+            elif not self.is_numeric(key):
+                rendered.append(self.bib_authors[key])
+        if rendered:
+            return 'intext', ', '.join(rendered)
+        if missing_authors:
+            return 'no_authors', None
+        return 'numeric', None
+
+    def render_authors(self, citation, bibrefs):
+        outcome, authors = self.resolve_citation(bibrefs)
+        if outcome == 'missing':
+            # Decompose list of authors which usually indicates parenthetical citations
+            # print('Could not find reference for ' + citation['class'] + ': ' + bibrefs)
+            citation.decompose()
+            self.parenthetical_citations += 1
+        elif outcome == 'intext':
+            # Replace citation tag with in-text citation string
+            citation.replace_with(authors)
+            self.intext_citations += 1
+        elif outcome == 'numeric':
             # If the authors text is numeric only, don't use
-            regex = re.compile(r'^[(]?\d*[)]?$')
-            if regex.match(authors.text.strip()):
-                self.parenthetical_citations += 1
-            else:
-                # Replace citation tag with in-text citation string
-                citation.replace_with(authors.text)
-                self.intext_citations += 1
+            self.parenthetical_citations += 1
         else:
             print('Authors not found')
             
@@ -96,15 +148,7 @@ class Parser(object):
                     self.parenthetical_citations += 1
                 # Process in-text citations
                 elif citation['class'] == 'ltx_citemacro_citet' or citation['class'] == 'ltx_citemacro_cite':
-                    bibref = citation.bibref['bibrefs']
-                    bib_item = self.soup.find('bibitem', attrs={'key': bibref})
-                    if bib_item:
-                        self.render_authors(citation, bib_item)
-                    else: 
-                        # Decompose list of authors which usually indicates parenthetical citations
-                        # print('Could not find reference for ' + citation['class'] + ': ' + bibref)
-                        citation.decompose()
-                        self.parenthetical_citations += 1
+                    self.render_authors(citation, citation.bibref['bibrefs'])
                         
 
     def parse(self, xml_path):
@@ -116,6 +160,7 @@ class Parser(object):
 
         with open(xml_path) as xml:
             self.soup = BeautifulSoup(xml, 'xml')
+            self.index_bibitems()
             sections = self.soup.find_all('section')
             print('Sections: ' + str(len(sections)))
             
@@ -170,64 +215,275 @@ class Parser(object):
         return None
     
     
-    def cleanse(self, doc):
-        # Convert to lowercase
-        doc = doc.lower()
-        # Tokenize alphanumeric characters only, 
+    def cleanse(self, doc, vocabulary=None):
+        # Convert to lowercase,
+        # tokenize alphanumeric characters only, 
         # removing punctuation, 
-        # changing all numbers to <num> metatoken
-        tokenizer = nltk.tokenize.RegexpTokenizer(r'\w+')
-        num_pattern = re.compile(r'^\d*$')
-        tokens = ['<num>' if num_pattern.match(x) else '<latex>' if x == 'latex_metatoken' else x for x in tokenizer.tokenize(doc)]
-        return tokens
+        # changing all numbers to <num> metatoken,
+        # and to token ids if given a vocabulary
+        return tokenizer.tokenize(doc, vocabulary)
         
+def localname(element):
+    '''
+    Returns the tag of an lxml element without its namespace, or None for comments etc.
+    '''
+
+    tag = element.tag
+    return tag.rpartition('}')[2] if isinstance(tag, str) else None
+
+
+class LxmlParser(Parser):
+    '''
+    Parser engine with the same output as Parser.parse, built on lxml iterparse.
+    Instead of one BeautifulSoup traversal per removed element type, it renders each
+    section's text in a single walk, skipping removed elements, substituting Math,
+    and collecting text into a list. Processed elements are cleared as it goes,
+    so memory stays bounded on very large documents.
+    '''
+
+    # Elements dropped along with their contents, as in Parser.remove_stuff
+    dropped = frozenset(['title', 'note', 'tabular', 'caption', 'toccaption', 'figure', 'tags', 'tag', 'ERROR'])
+
+    def index_bibliography(self, xml_path):
+        '''
+        First pass: maps each bibitem key to the text of its refnum tag
+        (None if it has none), keeping only the first bibitem per key.
+        '''
+
+        self.bib_authors = {}
+        self.numeric_keys = {}
+        in_bibitem = 0
+        for event, element in etree.iterparse(xml_path, events=('start', 'end')):
+            name = localname(element)
+            if event == 'start':
+                if name == 'bibitem':
+                    in_bibitem += 1
+                continue
+            if name == 'bibitem':
+                in_bibitem -= 1
+                key = element.get('key')
+                if key is not None and key not in self.bib_authors:
+                    refnum = next((x for x in element.iterdescendants() if x.get('role') == 'refnum'), None)
+                    if refnum is not None:
+                        out = []
+                        self.render(refnum, out, transform=False)
+                        self.bib_authors[key] = ''.join(out)
+                    else:
+                        self.bib_authors[key] = None
+            if not in_bibitem:
+                self.release(element)
+
+    def release(self, element):
+        '''
+        Frees a fully processed element and the already processed siblings before it.
+        '''
+
+        element.clear(keep_tail=True)
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
+
+    def render_citation(self, citation, out):
+        '''
+        Appends the text a citation renders as, as Parser.process_citations would.
+        Returns False if the citation should instead be rendered as it is.
+        '''
+
+        cls = citation.get('class')
+        if cls == 'ltx_citemacro_citep':
+            self.parenthetical_citations += 1
+            return True
+        if cls != 'ltx_citemacro_citet' and cls != 'ltx_citemacro_cite':
+            return False
+        bibref = next((x for x in citation.iterdescendants() if localname(x) == 'bibref'), None)
+        outcome, authors = self.resolve_citation(bibref.get('bibrefs', '') if bibref is not None else '')
+        if outcome == 'missing':
+            self.parenthetical_citations += 1
+            return True
+        if outcome == 'intext':
+            out.append(authors)
+            self.intext_citations += 1
+            return True
+        if outcome == 'numeric':
+            self.parenthetical_citations += 1
+        else:
+            print('Authors not found')
+        return False
+
+    def render(self, element, out, transform=True):
+        '''
+        Appends the text inside element to out. With transform, removed elements are
+        skipped, Math becomes latex_metatoken and citations are rendered.
+        Comments are skipped, like BeautifulSoup's get_text does.
+        '''
+
+        if element.text:
+            out.append(element.text)
+        for child in element:
+            name = localname(child)
+            if name is None:
+                pass
+            elif not transform:
+                self.render(child, out, transform)
+            elif name in self.dropped:
+                pass
+            elif name == 'Math':
+                out.append(' latex_metatoken ')
+            elif name == 'cite' and child.get('class') is not None and self.render_citation(child, out):
+                pass
+            else:
+                self.render(child, out)
+            if child.tail:
+                out.append(child.tail)
+
+    def parse(self, xml_path):
+        '''
+        Parses full XML file at given path.
+        '''
+
+        self.index_bibliography(xml_path)
+        # (order of start tag, text), so nested elements come out in document order like find_all
+        section_texts = []
+        para_texts = []
+        open_sections = []
+        open_paras = []
+        sections_seen = 0
+        paras_seen = 0
+
+        for event, element in etree.iterparse(xml_path, events=('start', 'end')):
+            name = localname(element)
+            if event == 'start':
+                if name == 'section':
+                    open_sections.append(sections_seen)
+                    sections_seen += 1
+                elif name == 'para' and not sections_seen:
+                    open_paras.append(paras_seen)
+                    paras_seen += 1
+                continue
+            # Paragraphs only matter if the document turns out to have no sections
+            if name == 'section':
+                out = []
+                self.render(element, out)
+                section_texts.append((open_sections.pop(), ''.join(out)))
+            elif name == 'para' and open_paras:
+                out = []
+                self.render(element, out)
+                para_texts.append((open_paras.pop(), ''.join(out)))
+            if not open_sections and not open_paras:
+                self.release(element)
+
+        print('Sections: ' + str(len(section_texts)))
+        if section_texts:
+            texts = section_texts
+        else:
+            print('Paragraphs: ' + str(len(para_texts)))
+            texts = para_texts
+        return ''.join(text for order, text in sorted(texts))
+
+
+# Parser engines with the same output, selected by PARSER_ENGINE
+ENGINES = {'bs4': Parser, 'lxml': LxmlParser}
+PARSER_ENGINE = 'lxml'
+
+# Parse pool settings: files handed to a worker at a time, and files a worker
+# parses before it is replaced with a fresh one (None to keep workers for the whole run)
+PARSE_WORKERS = mp.cpu_count()
+CHUNKSIZE = 16
+MAX_TASKS_PER_CHILD = None
+
+# The parser and corpus writer of the current worker, built once by init_worker
+parser = None
+writer = None
+
+def init_worker(engine=None):
+    '''
+    Runs once in each pool worker, building its parser and corpus writer.
+    '''
+
+    global parser
+    global writer
+    parser = ENGINES[engine or PARSER_ENGINE]()
+    # Confirm 'corpus' dir exists
+    utils.confirmDir('corpus')
+    writer = CorpusWriter('corpus')
+
 def work(xf):
-    print('{} is working on {}...'.format(mp.current_process(), xf))
-    try:
-        p = Parser()
-        # Confirm 'corpus' dir exists
-        utils.confirmDir('corpus')
+    '''
+    Parses a single XML file, appending its tokens to the worker's corpus shard.
+    Returns (arxiv_id, status, seconds, error), where status is 'parsed', 'skipped' or 'failed'.
+    '''
 
-        # Get id of xml file
-        arxiv_id = os.path.splitext(os.path.basename(xf))[0]
-        npf = 'corpus/' + arxiv_id + '.npy'
+    if parser is None:
+        init_worker()
+    starttime = time.time()
+    # Get id of xml file
+    arxiv_id = os.path.splitext(os.path.basename(xf))[0]
+    try:
+        ledger = get_ledger()
         # If XML file has already been parsed, don't parse again
-        if os.path.isfile(npf):
-            print('{} has already been parsed.'.format(arxiv_id))
-        else:
-            print('Parsing {}...'.format(arxiv_id))
-            fulltext = p.parse(xf)
-            tokens = p.cleanse(fulltext) # array
-            np.save(npf, tokens)
-            print('Saved ' + npf)
+        if ledger.is_done('submission', arxiv_id, 'parse'):
+            return arxiv_id, 'skipped', time.time() - starttime, None
+        with ledger.track('submission', arxiv_id, 'parse') as job:
+            fulltext = parser.parse(xf)
+            ids = parser.cleanse(fulltext, writer.vocabulary) # array
+            job['size'] = writer.add(arxiv_id, ids)
+        return arxiv_id, 'parsed', time.time() - starttime, None
     except Exception as e:
-        print('\nSomething went wrong: {}'.format(e))
+        print('\nSomething went wrong parsing {}: {}'.format(arxiv_id, e))
         traceback.print_exc()
-        
-def main():
-    # Set up the parallel task pool to use all available processors
-    pool = mp.Pool(processes=mp.cpu_count())
-    print('Executing with ' + str(mp.cpu_count()) + ' workers...')
-    processes = []
+        return arxiv_id, 'failed', time.time() - starttime, '{}: {}'.format(type(e).__name__, e)
+
+def report(results):
+    '''
+    Prints aggregated timings and failures for the given work() results.
+    '''
+
+    parsed = [r for r in results if r[1] == 'parsed']
+    failed = [r for r in results if r[1] == 'failed']
+    print('{} parsed, {} skipped, {} failed'.format(len(parsed), len(results) - len(parsed) - len(failed), len(failed)))
+    if parsed:
+        seconds = sorted(r[2] for r in parsed)
+        print('Seconds per file: mean {:.2f}, median {:.2f}, max {:.2f}, total {:.1f}'.format(
+            sum(seconds) / len(seconds), seconds[len(seconds) // 2], seconds[-1], sum(seconds)))
+        for arxiv_id, status, took, error in sorted(parsed, key=lambda r: r[2], reverse=True)[:5]:
+            print('  slowest: {} ({:.2f}s)'.format(arxiv_id, took))
+    for arxiv_id, status, took, error in failed:
+        print('  failed: {} ({})'.format(arxiv_id, error))
+
+def main(workers=PARSE_WORKERS, chunksize=CHUNKSIZE, maxtasksperchild=MAX_TASKS_PER_CHILD):
     tasks = glob.glob('xml/*[.xml]')
+    # Leave out files that have already been parsed, in one query
+    ledger = get_ledger()
+    parsed = ledger.names('submission', 'parse')
+    if not parsed:
+        # Documents parsed before the ledger existed are only in the corpus
+        ledger.seed_parsed(doc_ids())
+        parsed = ledger.names('submission', 'parse')
+    tasks = [task for task in tasks if os.path.splitext(os.path.basename(task))[0] not in parsed]
     print(str(len(tasks)) + ' files to parse...')
-    
+
+    # Set up a bounded pool of workers, each keeping its parser across files
+    print('Executing with ' + str(workers) + ' workers...')
+    pool = mp.Pool(processes=workers, initializer=init_worker, maxtasksperchild=maxtasksperchild)
+    results = []
     try:
-        for task in tasks:
-            p = mp.Process(target=work, args=(task,))
-            processes.append(p)
-            p.start()
-        
-        for process in processes:
-            process.join()
+        for result in pool.imap_unordered(work, tasks, chunksize=chunksize):
+            results.append(result)
+        pool.close()
+    except KeyboardInterrupt:
+        print('Interrupted, terminating workers...')
+        pool.terminate()
     except Exception as e:
         print('Something went wrong: {}'.format(e))
         traceback.print_exc()
+        pool.terminate()
     finally:
-        pool.close()
         pool.join()
+        report(results)
         sys.stdout.flush()
         print('The end.')
+    return results
 
 if __name__ == '__main__':
     '''
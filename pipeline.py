@@ -0,0 +1,262 @@
+import collections
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import threading
+import time
+import traceback
+import psutil
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Marks the end of a stage's input
+DONE = object()
+
+
+def start_worker(pids, initializer=None, initargs=()):
+	'''
+	Initializer of process stage workers: records the worker's pid in the first free
+	slot of pids, as ProcessPoolExecutor has no public way to stop the tasks it is running,
+	then runs the pipeline's own initializer.
+	'''
+
+	with pids.get_lock():
+		pids[pids[:].index(0)] = os.getpid()
+	if initializer is not None:
+		initializer(*initargs)
+
+
+class Stage(object):
+	'''
+	One step of the pipeline. fn is called on each item and returns the item
+	to hand to the downstream stages, or None to drop it.
+	kind is 'thread' for I/O bound steps or 'process' for CPU bound ones,
+	which run in a process pool of the given number of workers.
+	'''
+
+	name = None
+	fn = None
+	workers = 1
+	kind = 'thread'
+	downstream = None
+
+	def __init__(self, name, fn, workers=1, kind='thread', queue_size=2):
+		self.name = name
+		self.fn = fn
+		self.workers = workers
+		self.kind = kind
+		self.downstream = []
+		self.queue = queue.Queue(maxsize=queue_size)
+		self.executor = None
+		self.running = 0
+		self.lock = threading.Lock()
+		# Pids of the process pool's workers, recorded by each as it starts, see start_worker()
+		self.pids = None
+
+
+class Pipeline(object):
+	'''
+	Runs items through a tree of stages, each with its own workers, connected by bounded queues.
+	A full queue blocks the stage feeding it, and new items are only admitted while there is
+	enough free disk and memory, so e.g. the next tar is prefetched while the current one is
+	converting, but downloads never run arbitrarily far ahead.
+	Items must be hashable, as the pipeline keeps count of those in flight, see cancel().
+	'''
+
+	stages = None
+	root = None
+
+	def __init__(self, min_free_disk=0, min_free_memory=0, disk_path='.', poll_interval=5,
+				initializer=None, initargs=()):
+		self.stages = []
+		self.min_free_disk = min_free_disk
+		self.min_free_memory = min_free_memory
+		self.disk_path = disk_path
+		self.poll_interval = poll_interval
+		self.initializer = initializer
+		self.initargs = initargs
+		self.failures = []
+		self.completed = []
+		self.results_lock = threading.Lock()
+		# Per item, the stages it is queued for or in
+		self.pending = collections.Counter()
+		self.cancelled = threading.Event()
+		self.interrupt = None
+
+	def add_stage(self, name, fn, workers=1, kind='thread', after=None, queue_size=2):
+		'''
+		Adds a stage fed by the given upstream stage (the first stage is fed by run()).
+		Several stages may come after the same one, e.g. an upload running
+		in the background alongside conversion.
+		'''
+
+		stage = Stage(name, fn, workers, kind, queue_size)
+		if after is None:
+			if self.root is not None:
+				raise ValueError('Pipeline already has a first stage: ' + self.root.name)
+			self.root = stage
+		else:
+			after.downstream.append(stage)
+		self.stages.append(stage)
+		return stage
+
+	def has_resources(self):
+		if shutil.disk_usage(self.disk_path).free < self.min_free_disk:
+			return False
+		if psutil.virtual_memory().available < self.min_free_memory:
+			return False
+		return True
+
+	def wait_for_resources(self):
+		'''
+		Blocks until there is enough free disk and memory to admit another item.
+		'''
+
+		waited = False
+		while not self.has_resources():
+			if not waited:
+				print('Pipeline is waiting for free disk or memory...')
+				waited = True
+			time.sleep(self.poll_interval)
+
+	def call(self, stage, item):
+		if stage.executor is not None:
+			return stage.executor.submit(stage.fn, item).result()
+		return stage.fn(item)
+
+	def hand_over(self, item, result, stages):
+		'''
+		Counts result as pending in the given stages, and item as no longer pending in the one it left.
+		'''
+
+		with self.results_lock:
+			for _ in stages:
+				self.pending[result] += 1
+			if item is not None:
+				self.pending[item] -= 1
+				if self.pending[item] <= 0:
+					del self.pending[item]
+
+	def worker(self, stage):
+		while True:
+			item = stage.queue.get()
+			if item is DONE:
+				break
+			if self.cancelled.is_set():
+				continue
+			try:
+				result = self.call(stage, item)
+			except BaseException as e:
+				if not isinstance(e, Exception):
+					# E.g. KeyboardInterrupt: stop the pipeline, but still hand DONE on below
+					self.interrupt = e
+					self.cancel()
+				if not self.cancelled.is_set():
+					print('\nSomething went wrong in stage {} on {}: {}'.format(stage.name, item, e))
+					traceback.print_exc()
+					with self.results_lock:
+						self.failures.append((stage.name, item, e))
+					self.hand_over(item, None, [])
+				continue
+			if self.cancelled.is_set():
+				continue
+			downstream = stage.downstream if result is not None else []
+			self.hand_over(item, result, downstream)
+			if result is None:
+				continue
+			if not stage.downstream:
+				with self.results_lock:
+					self.completed.append((stage.name, result))
+			for downstream in stage.downstream:
+				downstream.queue.put(result)
+
+		# The last worker out tells the downstream stages there is nothing more coming
+		with stage.lock:
+			stage.running -= 1
+			last = stage.running == 0
+		if last:
+			for downstream in stage.downstream:
+				for _ in range(downstream.workers):
+					downstream.queue.put(DONE)
+
+	def run(self, items):
+		'''
+		Feeds items through the pipeline and waits for all stages to finish.
+		Returns (completed items as (last stage name, item), failures as (stage name, item, exception)).
+		A KeyboardInterrupt raised in a stage cancels the pipeline, and is re-raised once every worker has stopped.
+		'''
+
+		threads = []
+		for stage in self.stages:
+			if stage.kind == 'process':
+				stage.pids = mp.Array('i', stage.workers)
+				stage.executor = ProcessPoolExecutor(max_workers=stage.workers,
+					initializer=start_worker, initargs=(stage.pids, self.initializer, self.initargs))
+			stage.running = stage.workers
+			for _ in range(stage.workers):
+				thread = threading.Thread(target=self.worker, args=(stage,), daemon=True)
+				thread.start()
+				threads.append(thread)
+
+		try:
+			for item in items:
+				if self.cancelled.is_set():
+					break
+				self.wait_for_resources()
+				self.hand_over(None, item, [self.root])
+				self.root.queue.put(item)
+			for _ in range(self.root.workers):
+				self.root.queue.put(DONE)
+			for thread in threads:
+				thread.join()
+			if self.interrupt is not None:
+				raise self.interrupt
+		except BaseException:
+			# E.g. KeyboardInterrupt: stop instead of waiting for every item admitted
+			self.cancel()
+			raise
+		finally:
+			for stage in self.stages:
+				if stage.executor is not None:
+					stage.executor.shutdown(wait=not self.cancelled.is_set(), cancel_futures=True)
+
+		return self.completed, self.failures
+
+	def cancel(self):
+		'''
+		Stops the pipeline: workers drop the items they get from now on, and the processes
+		of process stages are killed along with everything they started, e.g. latexmlc,
+		which runs in its own session and so misses a Ctrl-C. Items in flight are left
+		as they were, see in_flight(), for the caller to clean up.
+		'''
+
+		if self.cancelled.is_set():
+			return
+		self.cancelled.set()
+		# Collect every process first, as the pool terminates its other workers once one dies
+		procs = []
+		for stage in self.stages:
+			if stage.pids is None:
+				continue
+			for pid in stage.pids[:]:
+				if not pid:
+					continue
+				try:
+					proc = psutil.Process(pid)
+					procs += proc.children(recursive=True) + [proc]
+				except psutil.Error:
+					pass
+		for proc in procs:
+			try:
+				proc.kill()
+			except psutil.Error:
+				pass
+
+	def in_flight(self):
+		'''
+		Returns the items admitted that haven't made it through, or failed in, every stage.
+		'''
+
+		with self.results_lock:
+			return list(self.pending)
@@ -0,0 +1,110 @@
+import collections
+import os
+import zipfile
+from ledger import get_ledger
+
+
+# Prior cost of a conversion, until enough similar ones have been timed
+BASE_SECONDS = 10
+SECONDS_PER_MB = 20
+# Timed runs of similar submissions needed before their mean replaces the prior
+MIN_SAMPLES = 3
+# Submissions with more .tex files than this are considered alike
+MAX_TEX_FILES = 8
+# Wall-clock limit of a conversion, as utils.HARD_TIMEOUT
+HARD_TIMEOUT = 300
+
+# A submission to convert, with its features, estimated seconds and timeout
+Job = collections.namedtuple('Job', ['submission', 'input_bytes', 'tex_files', 'estimate', 'timeout'])
+
+
+def features(submission):
+	'''
+	Returns (input bytes, number of .tex files) of an extracted submission:
+	a .tex file, .zip or directory, see utils.extract.
+	'''
+
+	if os.path.isdir(submission):
+		input_bytes = tex_files = 0
+		for root, dirs, files in os.walk(submission):
+			for name in files:
+				input_bytes += os.path.getsize(os.path.join(root, name))
+				tex_files += name.lower().endswith('.tex')
+		return input_bytes, tex_files
+	if submission.endswith('.zip'):
+		try:
+			with zipfile.ZipFile(submission) as zipf:
+				infos = zipf.infolist()
+		except zipfile.BadZipFile:
+			return os.path.getsize(submission), 0
+		return sum(info.file_size for info in infos), sum(info.filename.lower().endswith('.tex') for info in infos)
+	return os.path.getsize(submission), 1
+
+
+def size_bucket(input_bytes):
+	# Sizes within a factor of two of each other
+	return int(input_bytes).bit_length()
+
+
+class CostModel(object):
+	'''
+	Estimates the seconds a conversion takes from the mean of past runs (in the ledger)
+	of submissions of similar size and number of .tex files, falling back to
+	submissions of similar size only, then to a prior linear in size.
+	'''
+
+	def __init__(self, stats=()):
+		self.similar = {}
+		by_size = collections.defaultdict(lambda: [0, 0.0])
+		for bucket, tex_files, runs, seconds in stats:
+			self.similar[bucket, tex_files] = (runs, seconds)
+			by_size[bucket][0] += runs
+			by_size[bucket][1] += seconds
+		self.by_size = dict(by_size)
+
+	@classmethod
+	def from_ledger(cls, ledger=None):
+		return cls((ledger or get_ledger()).cost_stats())
+
+	def estimate(self, input_bytes, tex_files):
+		'''
+		Returns (estimated seconds, number of past runs it is the mean of),
+		the number being 0 if it is only the prior.
+		'''
+
+		bucket = size_bucket(input_bytes)
+		for runs, seconds in (self.similar.get((bucket, min(tex_files, MAX_TEX_FILES)), (0, 0)), self.by_size.get(bucket, (0, 0))):
+			if runs >= MIN_SAMPLES:
+				return seconds / runs, runs
+		return BASE_SECONDS + SECONDS_PER_MB * input_bytes / 1024 ** 2, 0
+
+
+class Scheduler(object):
+	'''
+	Orders the submissions of a tar longest first, so the few pathological papers
+	start early instead of holding up the end of the tar. Every submission gets the
+	hard timeout: timeouts scaled to estimates cut off long papers that would have
+	finished, whose retries then cost more than they saved (see benchmarks.py conversion_schedule).
+	'''
+
+	def __init__(self, model=None, hard_timeout=HARD_TIMEOUT):
+		self.model = model or CostModel()
+		self.hard_timeout = hard_timeout
+
+	def plan(self, submissions):
+		jobs = []
+		for submission in submissions:
+			input_bytes, tex_files = features(submission)
+			estimate, runs = self.model.estimate(input_bytes, tex_files)
+			jobs.append(Job(submission, input_bytes, tex_files, estimate, self.hard_timeout))
+		return sorted(jobs, key=lambda job: -job.estimate)
+
+	def record(self, job, result, ledger=None):
+		'''
+		Records the runtime of a finished conversion, so later estimates learn from it.
+		Skipped and cached submissions say nothing about the cost of converting.
+		'''
+
+		if result.status in ('done', 'NoOutput', 'TimeoutExpired'):
+			(ledger or get_ledger()).record_cost(os.path.basename(os.path.normpath(job.submission)), size_bucket(job.input_bytes),
+				min(job.tex_files, MAX_TEX_FILES), result.seconds, result.status == 'TimeoutExpired')
@@ -0,0 +1,183 @@
+import collections
+import glob
+import os
+import threading
+
+
+# Disk space the local tar cache may use, in bytes
+TAR_CACHE_BUDGET = 20 * 1024 ** 3
+
+
+class LocalTier(object):
+	'''
+	Tars kept on local disk under root after use, up to budget bytes,
+	evicting the least recently used. Pinned tars are never evicted.
+	Keys are local paths, e.g. src/arXiv_src_1801_001.tar.
+	'''
+
+	name = 'local'
+	root = 'src'
+	budget = TAR_CACHE_BUDGET
+
+	def __init__(self, root='src', budget=TAR_CACHE_BUDGET):
+		self.root = root
+		self.budget = budget
+		self.pins = collections.Counter()
+		self.lock = threading.Lock()
+
+	def has(self, key):
+		return os.path.isfile(key)
+
+	def touch(self, key):
+		# Mark as recently used
+		os.utime(key)
+
+	def pin(self, key):
+		with self.lock:
+			self.pins[key] += 1
+
+	def unpin(self, key):
+		with self.lock:
+			self.pins[key] -= 1
+			if self.pins[key] <= 0:
+				del self.pins[key]
+
+	def evict(self, needed=0):
+		'''
+		Deletes least recently used unpinned tars until the cache fits its budget,
+		with needed bytes to spare for a tar about to be fetched.
+		Returns the number of bytes freed.
+		'''
+
+		with self.lock:
+			entries = []
+			for path in glob.glob(os.path.join(self.root, '*.tar')):
+				try:
+					stat = os.stat(path)
+				except FileNotFoundError:
+					continue
+				entries.append((stat.st_mtime, stat.st_size, path))
+			total = sum(size for mtime, size, path in entries)
+			freed = 0
+			for mtime, size, path in sorted(entries):
+				if total + needed <= self.budget:
+					break
+				if self.pins[path] > 0:
+					continue
+				print('Evicting ' + path)
+				os.remove(path)
+				total -= size
+				freed += size
+			return freed
+
+
+class DriveTier(object):
+	'''
+	Tars backed up to Google Drive, see gdrive.py.
+	'''
+
+	name = 'gdrive'
+	streamable = False
+
+	def __init__(self, g):
+		self.g = g
+
+	def has(self, key):
+		return self.g.get(os.path.basename(key)) is not None
+
+	def size(self, key):
+		gfile = self.g.get(os.path.basename(key))
+		return int(gfile['fileSize']) if gfile is not None and gfile.get('fileSize') else None
+
+	def fetch(self, key):
+		# Download under a temporary name, so a partial download is never taken for a cached tar
+		self.g.download(self.g.get(os.path.basename(key)), key + '.part')
+		os.replace(key + '.part', key)
+
+
+class S3Tier(object):
+	'''
+	The arxiv requester-pays bucket, see amazon_s3.py. Downloads are checked
+	against the manifest md5s and share the bandwidth limiter, if given.
+	'''
+
+	name = 's3'
+	streamable = True
+
+	def __init__(self, s3, checksums=None, limiter=None):
+		self.s3 = s3
+		self.checksums = checksums or {}
+		self.limiter = limiter
+
+	def has(self, key):
+		return True
+
+	def size(self, key):
+		return self.s3.get_size(key)
+
+	def fetch(self, key):
+		if not self.s3.download_file(key, md5=self.checksums.get(key), limiter=self.limiter):
+			raise IOError('Download of {} failed'.format(key))
+
+
+class TarStore(object):
+	'''
+	Resolves a tar key through the local cache, then each remote tier in order,
+	copying it into the cache from the first remote tier that has it.
+	A tar is pinned from acquire() until release(), and only evicted after that.
+	stats counts hits, misses and bytes served per tier.
+	'''
+
+	def __init__(self, local, remotes):
+		self.local = local
+		self.remotes = remotes
+		self.stats = collections.defaultdict(collections.Counter)
+
+	def acquire(self, key, stream=False):
+		'''
+		Makes the tar available at its key, pinning it, and returns the key.
+		If stream is set and only a streamable tier (S3) has the tar, it isn't
+		downloaded: None is returned and the caller should stream it instead.
+		'''
+
+		if self.local.has(key):
+			self.local.pin(key)
+			self.local.touch(key)
+			self.served(self.local, key)
+			return key
+		self.stats[self.local.name]['misses'] += 1
+		for tier in self.remotes:
+			if not tier.has(key):
+				self.stats[tier.name]['misses'] += 1
+				continue
+			if stream and tier.streamable:
+				self.stats[tier.name]['streams'] += 1
+				return None
+			# Make room for the tar first, so the cache stays within budget
+			self.local.evict(needed=tier.size(key) or 0)
+			self.local.pin(key)
+			try:
+				tier.fetch(key)
+			except BaseException:
+				self.local.unpin(key)
+				raise
+			self.served(tier, key)
+			return key
+		raise IOError('No storage tier has ' + key)
+
+	def served(self, tier, key):
+		self.stats[tier.name]['hits'] += 1
+		self.stats[tier.name]['bytes'] += os.path.getsize(key)
+
+	def release(self, key):
+		'''
+		Unpins the tar once no stage needs it any more, evicting tars over the budget.
+		'''
+
+		if key in self.local.pins:
+			self.local.unpin(key)
+			self.local.evict()
+
+	def __str__(self):
+		return ', '.join('{}: {} hits, {} misses, {:.1f} GB'.format(name, counts['hits'], counts['misses'], counts['bytes'] / 1024 ** 3)
+			for name, counts in self.stats.items())
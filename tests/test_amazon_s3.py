@@ -0,0 +1,110 @@
+import hashlib
+import io
+import os
+import zipfile
+import pytest
+import amazon_s3
+import ledger
+import utils
+from amazon_s3 import Amazon_S3, LocalBucket
+from benchmarks import make_identifiers, make_submission_tar
+
+
+KEY = 'src/arXiv_src_0001_001.tar'
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    os.makedirs(str(tmp_path / 'bucket' / 'src'))
+    make_submission_tar(str(tmp_path / 'bucket' / KEY), make_identifiers(6), figure_bytes=64 * 1024)
+    return LocalBucket(str(tmp_path / 'bucket'))
+
+
+def extracted(root):
+    '''
+    Maps each file under root to its contents, or to those of its members if it is a zip.
+    '''
+
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if name.endswith('.zip'):
+                with zipfile.ZipFile(path) as archive:
+                    files[os.path.relpath(path, root)] = {member: archive.read(member) for member in archive.namelist()}
+            else:
+                with open(path, 'rb') as f:
+                    files[os.path.relpath(path, root)] = f.read()
+    return files
+
+
+def test_stream_extracts_what_download_does(tmp_path, bucket, monkeypatch):
+    identifiers = make_identifiers(6)[::2]
+    results = {}
+    for how in ('download', 'stream'):
+        os.makedirs(str(tmp_path / how))
+        monkeypatch.chdir(str(tmp_path / how))
+        monkeypatch.setattr(ledger, 'ledgers', {})
+        if how == 'download':
+            assert bucket.download_file(KEY)
+            count = utils.extract(KEY, identifiers)
+        else:
+            with bucket.open_stream(KEY) as stream:
+                count = utils.extract_stream(stream, KEY, identifiers)
+        results[how] = count, extracted('latex')
+    assert results['stream'] == results['download']
+    assert results['stream'][0] == len(identifiers)
+
+
+class FakeClient(object):
+    '''
+    Serves one object's bytes to Amazon_S3 the way the S3 client would,
+    cutting the first response to each range in fail_ranges short.
+    '''
+
+    def __init__(self, data, fail_ranges=()):
+        self.data = data
+        self.fail_ranges = set(fail_ranges)
+        self.requests = []
+
+    def head_object(self, Bucket, Key, RequestPayer):
+        return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, RequestPayer, Range):
+        start, end = (int(part) for part in Range[len('bytes='):].split('-'))
+        self.requests.append(start)
+        body = self.data[start:end + 1]
+        if start in self.fail_ranges:
+            self.fail_ranges.remove(start)
+            body = body[:len(body) // 2]
+        return {'Body': io.BytesIO(body)}
+
+
+def s3_for(client):
+    s3 = Amazon_S3.__new__(Amazon_S3)
+    s3.s3resource = type('Resource', (object,), {'meta': type('Meta', (object,), {'client': client})})()
+    return s3
+
+
+@pytest.fixture
+def data(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(amazon_s3.time, 'sleep', lambda seconds: None)
+    return os.urandom(100 * 1024)
+
+
+def test_md5_mismatch_fails_download(data):
+    s3 = s3_for(FakeClient(data))
+    assert not s3.download_file(KEY, md5=hashlib.md5(b'something else').hexdigest(), part_size=16 * 1024)
+    assert not os.path.exists(KEY) and not os.path.exists(KEY + '.part')
+    assert s3.download_file(KEY, md5=hashlib.md5(data).hexdigest(), part_size=16 * 1024)
+
+
+def test_failed_part_is_retried(data):
+    part_size = 16 * 1024
+    client = FakeClient(data, fail_ranges=[part_size * 2])
+    assert s3_for(client).download_file(KEY, md5=hashlib.md5(data).hexdigest(), part_size=part_size)
+    # Every part once, and the one cut short again
+    assert sorted(client.requests) == sorted(list(range(0, len(data), part_size)) + [part_size * 2])
+    with open(KEY, 'rb') as f:
+        assert f.read() == data
@@ -0,0 +1,37 @@
+import os
+import tarfile
+import pytest
+import triage
+import utils
+from benchmarks import make_identifiers, make_submission_tar
+
+
+def extract_all(tar_path, out_dir, filter_members, monkeypatch):
+    monkeypatch.setattr(utils, 'FILTER_MEMBERS', filter_members)
+    with tarfile.open(tar_path) as tar:
+        for member in tar:
+            submission_id = os.path.splitext(os.path.basename(member.name))[0]
+            utils.extract_submission(tar.extractfile(member), os.path.join(out_dir, submission_id), 'directory')
+    return {os.path.relpath(os.path.join(root, name), out_dir): os.path.getsize(os.path.join(root, name))
+            for root, dirs, files in os.walk(out_dir) for name in files}
+
+
+@pytest.fixture
+def tar_path(tmp_path):
+    path = str(tmp_path / 'arXiv_src_0001_001.tar')
+    make_submission_tar(path, make_identifiers(5), figure_bytes=64 * 1024)
+    return path
+
+
+def test_stubs_keep_every_file_latexmlc_may_look_for(tmp_path, tar_path, monkeypatch):
+    assert utils.STUB_DROPPED
+    full = extract_all(tar_path, str(tmp_path / 'full'), False, monkeypatch)
+    filtered = extract_all(tar_path, str(tmp_path / 'filtered'), True, monkeypatch)
+    assert sorted(filtered) == sorted(full)
+    for path, size in filtered.items():
+        assert size == (full[path] if path.endswith('.tex') else 0)
+    for submission_id in os.listdir(str(tmp_path / 'full')):
+        before = triage.preflight(str(tmp_path / 'full' / submission_id))
+        after = triage.preflight(str(tmp_path / 'filtered' / submission_id))
+        assert after.reason == before.reason == triage.OK
+        assert os.path.basename(after.main) == os.path.basename(before.main)
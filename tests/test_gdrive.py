@@ -0,0 +1,39 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import gdrive
+from benchmarks import FakeDrive
+from gdrive import Gdrive
+
+
+def test_downloads_and_refreshes_from_several_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(gdrive, 'DOWNLOAD_CHUNK_SIZE', 1000)
+    drive = FakeDrive(['a.tar', 'b.tar'], page_size=1)
+    for file in drive.files.values():
+        file['content'] = os.urandom(2500)
+    g = Gdrive(drive)
+    # Only listed on the download threads, by get()
+    g.refreshed = 0
+
+    def fetch(title):
+        path = str(tmp_path / title)
+        g.download(g.get(title), path)
+        return open(path, 'rb').read()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        contents = list(executor.map(fetch, ['a.tar', 'b.tar']))
+    assert contents == [g.get(title)['content'] for title in ['a.tar', 'b.tar']]
+
+
+def test_refresh_drops_trashed_and_deleted_files():
+    drive = FakeDrive(['a.tar', 'b.tar', 'c.tar'])
+    g = Gdrive(drive)
+    assert sorted(file['title'] for file in g.get_tarfiles()) == ['a.tar', 'b.tar', 'c.tar']
+    drive.trash(g.get('a.tar')['id'])
+    g.refresh()
+    assert set(g.catalog) == {'b.tar', 'c.tar'}
+    drive.delete(g.get('b.tar')['id'])
+    g.refresh()
+    assert 'b.tar' in g
+    g.rebuilt = 0
+    g.refresh()
+    assert set(g.catalog) == {'c.tar'}
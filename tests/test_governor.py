@@ -0,0 +1,82 @@
+import subprocess as sp
+import sys
+import threading
+import time
+import psutil
+import governor
+import utils
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Stands in for latexmlc: grows to the given number of MB, 50 MB at a time, then finishes
+FAKE_CONVERTER = (
+    'import sys, time\n'
+    'blocks = []\n'
+    'for _ in range(int(sys.argv[1]) // 50):\n'
+    '    blocks.append(b"x" * (50 * 1024 ** 2))\n'
+    '    time.sleep(0.05)\n'
+    'time.sleep(float(sys.argv[2]))\n'
+)
+
+
+def test_governed_stress_stays_within_budget(num_jobs=12, workers=6, job_mb=150, balloon_every=4, budget_mb=600):
+    '''
+    Runs num_jobs fake converters that each grow to job_mb (every balloon_every-th tries
+    for three times the child memory limit) on workers threads through utils.run_latexmlc,
+    governed as if only budget_mb could be spared. The children should stay within the budget,
+    throttling instead, and only the balloons should fail.
+    '''
+
+    child_limit = 2 * job_mb * 1024 ** 2
+    g = governor.ResourceGovernor(max_jobs=workers, min_available=psutil.virtual_memory().available - budget_mb * 1024 ** 2,
+                                  job_memory={'convert': child_limit}, poll_interval=0.05)
+    me = psutil.Process()
+    peak = [0]
+    stop = threading.Event()
+
+    def monitor():
+        while not stop.is_set():
+            rss = 0
+            for child in me.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            peak[0] = max(peak[0], rss)
+            time.sleep(0.02)
+
+    def is_balloon(i):
+        return i % balloon_every == balloon_every - 1
+
+    def job(i):
+        mb = job_mb * 6 if is_balloon(i) else job_mb
+        command = [sys.executable, '-c', FAKE_CONVERTER, str(mb), '0.3']
+        return utils.run_latexmlc(command, sp.DEVNULL, timeout=60, memory_limit=child_limit, governor=g)
+
+    thread = threading.Thread(target=monitor, daemon=True)
+    thread.start()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        codes = list(executor.map(job, range(num_jobs)))
+    stop.set()
+    thread.join()
+    assert peak[0] <= budget_mb * 1024 ** 2
+    assert [code != 0 for code in codes] == [is_balloon(i) for i in range(num_jobs)]
+    assert g.stats['throttled'] > 0
+
+
+def test_shed_kills_newest_conversion_first():
+    g = governor.ResourceGovernor(max_jobs=3, min_available=0, critical_memory=float('inf'))
+    procs = []
+    for kind in ['convert', 'convert', 'extract']:
+        slot = g.admit(kind, memory=0)
+        procs.append(sp.Popen(['sleep', '30']))
+        g.attach(slot, procs[-1].pid)
+    try:
+        assert g.shed() == procs[1].pid
+        assert procs[1].wait(5) < 0
+        assert procs[0].poll() is None and procs[2].poll() is None
+        assert g.stats['shed'] == 1
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
@@ -0,0 +1,113 @@
+import datetime
+import os
+import pandas as pd
+import pytest
+import requests
+import harvest
+from benchmarks import FakeOAI
+from harvest import Harvester, write_json
+from oai import COLUMNS
+
+
+def save_page(harvester, window, number, rows):
+    window_dir = os.path.join(harvester.root, window)
+    if not os.path.isdir(window_dir):
+        os.makedirs(window_dir)
+    df = pd.DataFrame([dict(dict.fromkeys(COLUMNS), identifier=identifier, datestamp=datestamp, title=title)
+                       for identifier, datestamp, title in rows], columns=COLUMNS)
+    df.to_parquet(os.path.join(window_dir, 'page-{:05d}.parquet'.format(number)), index=False)
+    write_json(os.path.join(window_dir, 'state.json'), {'params': None, 'pages': number + 1, 'rows': 0})
+
+
+def harvested(tmp_path):
+    harvester = Harvester(root=str(tmp_path))
+    save_page(harvester, 'a', 0, [('1', '2020-01-01', 'old'), ('2', '2020-01-01', 'two')])
+    save_page(harvester, 'a', 1, [('3', '2020-01-02', 'three')])
+    save_page(harvester, 'b', 0, [('1', '2021-01-01', 'new'), ('4', '2021-01-01', 'four')])
+    return harvester
+
+
+def test_windows_keep_latest_datestamp(tmp_path):
+    windows = list(harvested(tmp_path).windows())
+    assert [list(window['title']) for window in windows] == [['two', 'three'], ['new', 'four']]
+
+
+def test_load_matches_windows(tmp_path):
+    assert list(harvested(tmp_path).load()['identifier']) == ['2', '3', '1', '4']
+
+
+def test_interrupted_store_resumes(tmp_path):
+    harvester = harvested(tmp_path)
+    assert not harvester.storing()
+    windows = harvester.windows()
+    next(windows)
+    # The first window is stored once the second is asked for
+    next(windows)
+    assert harvester.storing()
+    assert [list(window['identifier']) for window in harvester.windows()] == [['1', '4']]
+
+
+RECORDS = [('2015.{:05d}'.format(i), '2015-01-{:02d}'.format(1 + i % 28), 'physics:astro-ph') for i in range(250)]
+EXPECTED = sorted('oai:arXiv.org:' + record[0] for record in RECORDS)
+START, END = datetime.date(2015, 1, 1), datetime.date(2015, 1, 31)
+
+
+@pytest.fixture
+def fake_oai():
+    fakes = []
+
+    def start(**kwargs):
+        fakes.append(FakeOAI(RECORDS, **kwargs))
+        return fakes[-1]
+
+    yield start
+    for fake in fakes:
+        fake.close()
+
+
+def harvester_for(fake, tmp_path):
+    return Harvester(fake.url, ['physics:astro-ph'], workers=1, rate=1000, root=str(tmp_path / 'harvest'))
+
+
+def test_waits_out_503(tmp_path, fake_oai):
+    fake = fake_oai(throttle_every=2, retry_after=0.01)
+    harvester = harvester_for(fake, tmp_path)
+    assert harvester.harvest(START, END) == len(RECORDS)
+    assert fake.throttled > 0
+    assert sorted(harvester.load()['identifier']) == EXPECTED
+
+
+def test_retries_dropped_connection(tmp_path, fake_oai, monkeypatch):
+    monkeypatch.setattr(harvest, 'DEFAULT_RETRY_AFTER', 0.01)
+    fake = fake_oai(drop=[2])
+    harvester = harvester_for(fake, tmp_path)
+    assert harvester.harvest(START, END) == len(RECORDS)
+    assert sorted(harvester.load()['identifier']) == EXPECTED
+
+
+def test_restarts_window_on_bad_resumption_token(tmp_path, fake_oai):
+    fake = fake_oai(expire_tokens=1)
+    harvester = harvester_for(fake, tmp_path)
+    assert harvester.harvest(START, END) == len(RECORDS)
+    # The first page, then the expired token, then the window again
+    assert fake.requests == 2 + 3
+    assert sorted(harvester.load()['identifier']) == EXPECTED
+
+
+def test_resumes_from_mid_window_checkpoint(tmp_path, fake_oai):
+    crashing = fake_oai(fail_after=2)
+    harvester = harvester_for(crashing, tmp_path)
+    with pytest.raises(requests.HTTPError):
+        harvester.harvest(START, END)
+    fake = fake_oai()
+    harvester.url = fake.url
+    assert harvester.harvest(START, END) == len(RECORDS)
+    # Only the page that failed and those after it
+    assert fake.requests == 1
+    assert sorted(harvester.load()['identifier']) == EXPECTED
+
+
+def test_plan_starts_at_earliest_datestamp(tmp_path, fake_oai):
+    harvester = harvester_for(fake_oai(), tmp_path)
+    windows = harvester.plan(end=END)
+    assert windows[0].start == datetime.date(2015, 1, 1)
@@ -0,0 +1,40 @@
+import subprocess as sp
+import sys
+import psutil
+from latexml import ServerBackend
+
+
+def fake_server(port):
+    return sp.Popen([sys.executable, '-c', 'import time; time.sleep(30)', 'latexmls', '--port=' + str(port)])
+
+
+def test_server_pid_is_looked_up_once(monkeypatch):
+    backend = ServerBackend(1)
+    port = backend.acquire()
+    server = fake_server(port)
+    try:
+        assert backend.worker_pid(port) == server.pid
+
+        def process_iter(*args, **kwargs):
+            raise AssertionError('process table searched again')
+
+        monkeypatch.setattr(psutil, 'process_iter', process_iter)
+        assert backend.worker_pid(port) == server.pid
+        server.kill()
+        server.wait()
+        monkeypatch.undo()
+        assert backend.worker_pid(port) is None
+    finally:
+        server.kill()
+        server.wait()
+
+
+def test_document_messages_are_not_connection_failures(tmp_path):
+    backend = ServerBackend(1)
+    port = backend.acquire()
+    log = tmp_path / 'convert.log'
+    log.write_text('Warning:undefined:\\Socket The control sequence \\Socket is undefined\n')
+    assert not backend.failed_to_connect(port, str(log))
+    log.write_text('IO::Socket::INET: connect: Connection refused\n')
+    assert backend.failed_to_connect(port, str(log))
+    assert backend.connection_failures == 1
@@ -0,0 +1,59 @@
+import os
+import pytest
+import ledger
+import utils
+from ledger import DONE, FAILED, Ledger
+
+
+@pytest.fixture
+def run_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(ledger, 'ledgers', {})
+    return tmp_path
+
+
+def touch(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+
+
+def test_seed_skips_tars_left_mid_conversion(run_dir):
+    touch('latex/arXiv_src_0001_001.txt')
+    touch('latex/arXiv_src_0001_002.txt')
+    # The second tar's submissions were still being converted
+    touch('latex/arXiv_src_0001_002/0001.00002.tex')
+    touch('xml/0001.00001.xml')
+    touch('logs/0001.00001.txt')
+    touch('logs/0001.00002.txt')
+    touch('logs/pdf_submissions.txt')
+    ledger_ = Ledger()
+    assert ledger_.names('tar', 'convert') == set(['src/arXiv_src_0001_001.tar'])
+    assert ledger_.status('tar', 'src/arXiv_src_0001_002.tar', 'convert') is None
+    assert ledger_.names('submission', 'convert') == set(['0001.00001'])
+    assert ledger_.names('submission', 'convert', (FAILED,)) == set(['0001.00002'])
+
+
+def test_track_records_exception_class(run_dir):
+    ledger_ = Ledger()
+    with pytest.raises(KeyError):
+        with ledger_.track('submission', '0001.00001', 'extract', parent='src/arXiv_src_0001_001.tar'):
+            raise KeyError('missing')
+    row = ledger_.conn.execute('SELECT status, error, parent FROM jobs WHERE name = ?', ('0001.00001',)).fetchone()
+    assert row == (FAILED, 'KeyError', 'src/arXiv_src_0001_001.tar')
+    with ledger_.track('submission', '0001.00001', 'extract') as job:
+        job['size'] = 10
+    row = ledger_.conn.execute('SELECT status, error, bytes FROM jobs WHERE name = ?', ('0001.00001',)).fetchone()
+    assert row == (DONE, None, 10)
+
+
+def test_submissions_to_convert_skips_done_and_failed(run_dir):
+    for name in ('0001.00001.tex', '0001.00002.zip', '0001.00003.tex', '0001.00004.txt'):
+        touch('latex/arXiv_src_0001_001/' + name)
+    os.makedirs('latex/arXiv_src_0001_001/0001.00005')
+    ledger_ = ledger.get_ledger()
+    ledger_.finish('submission', '0001.00001', 'convert')
+    ledger_.fail('submission', '0001.00002', 'convert', 'TimeoutExpired')
+    ledger_.start('submission', '0001.00003', 'convert')
+    submissions = utils.get_submissions_to_convert('latex/arXiv_src_0001_001')
+    assert sorted(utils.get_submission_id(path) for path in submissions) == ['0001.00003', '0001.00005']
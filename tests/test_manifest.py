@@ -0,0 +1,29 @@
+from manifest import ManifestEntry, month_key, plan_downloads
+
+
+def entry(yymm):
+    return ManifestEntry('src/arXiv_src_{}_001.tar'.format(yymm), 1, None, yymm, None, None)
+
+
+def planned_months(start_yymm, end_yymm):
+    months = ['9201', '9501', '9912', '0001', '0012', '0703', '0704', '1801']
+    identifiers = ['astro-ph{}001'.format(yymm) if yymm < '0704' or yymm[0] == '9' else '{}.00001'.format(yymm)
+                   for yymm in months]
+    plan = plan_downloads([entry(yymm) for yymm in months], identifiers, start_yymm, end_yymm)
+    return [e.yymm for e in plan.entries]
+
+
+def test_month_key_orders_across_2000():
+    assert sorted(['0704', '9501', '0001', '9912'], key=month_key) == ['9501', '9912', '0001', '0704']
+
+
+def test_start_bound_drops_1990s():
+    assert planned_months('0704', None) == ['0704', '1801']
+
+
+def test_end_bound_keeps_1990s():
+    assert planned_months(None, '0012') == ['9201', '9501', '9912', '0001', '0012']
+
+
+def test_bounds_spanning_2000():
+    assert planned_months('9912', '0001') == ['9912', '0001']
@@ -0,0 +1,56 @@
+import os
+import re
+import shutil
+import subprocess as sp
+import nltk
+import pytest
+import tokenizer
+from benchmarks import make_latexml_xml
+from latexml import OneShotBackend
+from parser_ec2 import Parser, LxmlParser
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def cleanse(doc):
+    '''
+    The nltk-based Parser.cleanse that tokenizer.tokenize replaced.
+    '''
+
+    doc = doc.lower()
+    regexp_tokenizer = nltk.tokenize.RegexpTokenizer(r'\w+')
+    num_pattern = re.compile(r'^\d*$')
+    return ['<num>' if num_pattern.match(x) else '<latex>' if x == 'latex_metatoken' else x for x in regexp_tokenizer.tokenize(doc)]
+
+
+def assert_engines_agree(xml_path):
+    old = Parser().parse(xml_path)
+    assert old.strip()
+    assert LxmlParser().parse(xml_path) == old
+    assert tokenizer.tokenize(old) == cleanse(old)
+
+
+@pytest.mark.parametrize('multi_key_rate', [0, 0.1])
+def test_engines_agree_on_synthetic_xml(tmp_path, multi_key_rate):
+    xml_path = str(tmp_path / 'doc.xml')
+    make_latexml_xml(xml_path, multi_key_rate=multi_key_rate)
+    assert_engines_agree(xml_path)
+
+
+@pytest.mark.skipif(shutil.which('latexmlc') is None, reason='LaTeXML is not installed')
+@pytest.mark.parametrize('name', ['sections', 'paragraphs'])
+def test_engines_agree_on_latexml_output(tmp_path, name):
+    xml_path = str(tmp_path / (name + '.xml'))
+    sp.run(OneShotBackend().command(os.path.join(FIXTURES, name + '.tex'), xml_path),
+           cwd=str(tmp_path), stdout=sp.DEVNULL, stderr=sp.DEVNULL, check=True)
+    assert_engines_agree(xml_path)
+
+
+@pytest.mark.parametrize('doc', [
+    'The star Galaxy mass, of 12 and in (2018) latex_metatoken x_1 disk flux 3.5 M_sun',
+    'Ångström ١٢ e.g. 1e10 --- 5% 3.5\'\' ~ a-b a_b_ _ __ 0_1',
+    '',
+])
+def test_tokenizer_matches_nltk(doc):
+    assert tokenizer.tokenize(doc) == cleanse(doc)
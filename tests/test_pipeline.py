@@ -0,0 +1,82 @@
+import time
+import threading
+import psutil
+import pytest
+from pipeline import Pipeline
+
+
+def test_run_leaves_nothing_in_flight():
+    p = Pipeline()
+    first = p.add_stage('first', lambda item: item, workers=2)
+    p.add_stage('odd', lambda item: item if item % 2 else None, after=first)
+    p.add_stage('all', lambda item: item, after=first)
+    completed, failures = p.run(range(4))
+    assert sorted(completed) == [('all', 0), ('all', 1), ('all', 2), ('all', 3), ('odd', 1), ('odd', 3)]
+    assert failures == []
+    assert p.in_flight() == []
+
+
+def test_interrupt_cancels_and_reports_in_flight():
+    started = threading.Event()
+    blocked = threading.Event()
+
+    def block(item):
+        started.set()
+        blocked.wait(10)
+        return item
+
+    def items():
+        yield 'a'
+        started.wait(10)
+        raise KeyboardInterrupt
+
+    p = Pipeline()
+    p.add_stage('block', block)
+    with pytest.raises(KeyboardInterrupt):
+        p.run(items())
+    assert p.in_flight() == ['a']
+    blocked.set()
+
+
+def test_interrupt_in_stage_cancels_and_stops_workers():
+    def interrupt(item):
+        if item == 'b':
+            raise KeyboardInterrupt
+        return item
+
+    p = Pipeline()
+    first = p.add_stage('interrupt', interrupt)
+    p.add_stage('after', lambda item: item, after=first)
+    with pytest.raises(KeyboardInterrupt):
+        p.run(['a', 'b', 'c'])
+    assert p.cancelled.is_set()
+    assert p.failures == []
+    assert 'b' in p.in_flight()
+
+
+def test_cancel_kills_process_stage_workers():
+    p = Pipeline()
+    stage = p.add_stage('sleep', time.sleep, workers=2, kind='process')
+    runner = threading.Thread(target=p.run, args=([30, 30],), daemon=True)
+    runner.start()
+    deadline = time.monotonic() + 10
+    while not all(stage.pids[:] if stage.pids else [0]) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    pids = stage.pids[:]
+    assert all(pids)
+    p.cancel()
+    runner.join(10)
+    assert not runner.is_alive()
+    assert not any(alive(pid, timeout=5) for pid in pids)
+
+
+def alive(pid, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if psutil.Process(pid).status() == psutil.STATUS_ZOMBIE:
+                return False
+        except psutil.NoSuchProcess:
+            return False
+        time.sleep(0.05)
+    return True
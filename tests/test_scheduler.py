@@ -0,0 +1,19 @@
+import benchmarks
+import scheduler
+
+
+def test_plan_orders_longest_first_with_hard_timeout(tmp_path):
+    submissions = []
+    for size in [10, 100000, 1000]:
+        path = tmp_path / '{}.tex'.format(size)
+        path.write_bytes(b'x' * size)
+        submissions.append(str(path))
+    jobs = scheduler.Scheduler(hard_timeout=300).plan(submissions)
+    assert [job.input_bytes for job in jobs] == [100000, 1000, 10]
+    assert all(job.timeout == 300 for job in jobs)
+
+
+def test_schedule_does_not_regress():
+    # Asserts against glob order itself, for a few draws of the pathological papers
+    for seed in range(3):
+        benchmarks.bench_conversion_schedule(num_submissions=500, seed=seed)
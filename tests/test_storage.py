@@ -0,0 +1,46 @@
+import glob
+import os
+import pytest
+from amazon_s3 import LocalBucket
+from benchmarks import FakeDrive
+from gdrive import Gdrive
+from storage import DriveTier, LocalTier, S3Tier, TarStore
+
+
+BUDGET = 3000
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    '''
+    A full local cache of three tars, src/old0.tar being the least recently used.
+    '''
+
+    monkeypatch.chdir(str(tmp_path))
+    os.makedirs('src')
+    for i in range(3):
+        with open('src/old{}.tar'.format(i), 'wb') as f:
+            f.write(os.urandom(BUDGET // 3))
+        os.utime('src/old{}.tar'.format(i), (i, i))
+    return LocalTier('src', BUDGET)
+
+
+def cached():
+    return sorted(glob.glob('src/*.tar')), sum(os.path.getsize(path) for path in glob.glob('src/*.tar'))
+
+
+def test_s3_fetch_makes_room_for_incoming_tar(tmp_path, cache):
+    os.makedirs(str(tmp_path / 'bucket' / 'src'))
+    with open(str(tmp_path / 'bucket' / 'src' / 'new.tar'), 'wb') as f:
+        f.write(os.urandom(1500))
+    store = TarStore(cache, [S3Tier(LocalBucket(str(tmp_path / 'bucket')))])
+    assert store.acquire('src/new.tar') == 'src/new.tar'
+    assert cached() == (['src/new.tar', 'src/old2.tar'], 2500)
+
+
+def test_drive_fetch_makes_room_for_incoming_tar(cache):
+    drive = FakeDrive(['new.tar'])
+    drive.files[Gdrive(drive).get('new.tar')['id']]['content'] = os.urandom(2500)
+    store = TarStore(cache, [DriveTier(Gdrive(drive))])
+    assert store.acquire('src/new.tar') == 'src/new.tar'
+    assert cached() == (['src/new.tar'], 2500)
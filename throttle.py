@@ -0,0 +1,50 @@
+import multiprocessing as mp
+import time
+
+
+class TokenBucket(object):
+	'''
+	Token bucket rate limiter whose state lives in shared memory,
+	so a single bucket can be handed to every pool worker (e.g. through
+	the pool initializer) and caps their combined rate.
+	rate is in tokens (e.g. bytes) per second, capacity is the allowed burst.
+	'''
+
+	rate = None
+	capacity = None
+
+	def __init__(self, rate, capacity=None):
+		self.rate = float(rate)
+		self.capacity = float(capacity or rate)
+		self._tokens = mp.Value('d', self.capacity)
+		self._updated = mp.Value('d', time.monotonic(), lock=False)
+
+	def consume(self, amount=1):
+		'''
+		Takes amount tokens from the bucket, sleeping until they are available.
+		Callers may go into debt, which later callers pay off by waiting,
+		so large requests aren't starved by small ones.
+		'''
+
+		with self._tokens.get_lock():
+			now = time.monotonic()
+			# Negative while the bucket is paused
+			elapsed = now - self._updated.value
+			tokens = min(self.capacity, self._tokens.value + max(0.0, elapsed) * self.rate) - amount
+			self._tokens.value = tokens
+			self._updated.value = max(now, self._updated.value)
+		wait = max(0.0, -elapsed) + max(0.0, -tokens) / self.rate
+		if wait > 0:
+			time.sleep(wait)
+
+	def pause(self, seconds):
+		'''
+		Stops the bucket refilling for the given number of seconds from now, and empties it,
+		so every caller waits at least that long, e.g. when a server sends Retry-After.
+		'''
+
+		with self._tokens.get_lock():
+			now = time.monotonic()
+			elapsed = max(0.0, now - self._updated.value)
+			self._tokens.value = min(0.0, self._tokens.value + elapsed * self.rate)
+			self._updated.value = max(self._updated.value, now + seconds)
@@ -0,0 +1,22 @@
+import re
+
+
+# Word characters only, dropping punctuation, as nltk's RegexpTokenizer(r'\w+') did
+TOKEN = re.compile(r'\w+')
+# What Parser substitutes for math, see Parser.remove_stuff
+LATEX_METATOKEN = 'latex_metatoken'
+
+
+def tokenize(doc, vocabulary=None):
+    '''
+    Lowercases and tokenizes given text, replacing numbers with the <num> metatoken
+    and math with <latex>. Returns a list of tokens, or their uint32 ids
+    if given a corpus.Vocabulary.
+    '''
+
+    # str.isdecimal matches the same characters as \d, so this is the old ^\d*$ test
+    tokens = ['<num>' if token.isdecimal() else '<latex>' if token == LATEX_METATOKEN else token
+        for token in TOKEN.findall(doc.lower())]
+    if vocabulary is not None:
+        return vocabulary.ids(tokens)
+    return tokens
@@ -0,0 +1,178 @@
+import collections
+import json
+import os
+import re
+import threading
+import time
+import zipfile
+
+
+# Submissions skipped before conversion, and conversions that failed, one JSON object per line
+FAILURES_LOG = 'logs/conversion_failures.jsonl'
+# Bytes of each .tex file read when looking for the main file
+READ_BYTES = 256 * 1024
+# With several complete documents, the largest is taken as the main file
+# only if it is at least this many times larger than the next
+MAIN_SIZE_RATIO = 2
+
+# Reason codes
+OK = 'ok'
+EMPTY = 'empty'
+# No .tex file, e.g. only figures were left
+NO_TEX = 'no_tex'
+# Not LaTeX at all, e.g. a gzip-only submission that is really a PDF or PostScript
+NOT_LATEX = 'not_latex'
+# .tex files, but none that starts a document
+NO_MAIN = 'no_main'
+# Several complete documents of similar size, e.g. a paper and its reply to the referee
+MULTIPLE_ROOTS = 'multiple_roots'
+UNREADABLE = 'unreadable'
+
+DOCUMENT_START = re.compile(rb'\\(documentclass|documentstyle)\b')
+BEGIN_DOCUMENT = b'\\begin{document}'
+# Magic numbers of formats submitted in place of LaTeX
+NOT_LATEX_MAGIC = (b'%PDF', b'%!PS', b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'PK\x03\x04', b'\x1f\x8b')
+
+# Outcome of triaging a submission: a reason code, the main file to convert if OK,
+# which for a .zip is the .zip itself, and a detail for the failures log
+Triage = collections.namedtuple('Triage', ['submission', 'reason', 'main', 'detail'])
+
+
+class TexFile(object):
+	'''
+	What triage needs of a .tex file: its name, size and first READ_BYTES.
+	'''
+
+	def __init__(self, name, size, head):
+		self.name = name
+		self.size = size
+		self.head = head
+
+	@property
+	def depth(self):
+		return self.name.count('/')
+
+	@property
+	def starts_document(self):
+		return DOCUMENT_START.search(self.head) is not None
+
+	@property
+	def is_complete(self):
+		return self.starts_document and BEGIN_DOCUMENT in self.head
+
+
+def directory_tex_files(directory):
+	tex_files = []
+	others = 0
+	for root, dirs, files in os.walk(directory):
+		for name in files:
+			path = os.path.join(root, name)
+			if not name.lower().endswith('.tex'):
+				others += 1
+				continue
+			with open(path, 'rb') as f:
+				head = f.read(READ_BYTES)
+			tex_files.append(TexFile(os.path.relpath(path, directory).replace(os.sep, '/'), os.path.getsize(path), head))
+	return tex_files, others
+
+
+def zip_tex_files(zip_path):
+	tex_files = []
+	others = 0
+	with zipfile.ZipFile(zip_path) as zipf:
+		for info in zipf.infolist():
+			if info.is_dir():
+				continue
+			if not info.filename.lower().endswith('.tex'):
+				others += 1
+				continue
+			with zipf.open(info) as f:
+				head = f.read(READ_BYTES)
+			tex_files.append(TexFile(info.filename, info.file_size, head))
+	return tex_files, others
+
+
+def find_main(tex_files):
+	'''
+	Returns (reason, main TexFile) for the .tex files of a tarred submission.
+	The main file is the one that starts a document, preferring one that also
+	begins it, then the shallowest, then the largest.
+	'''
+
+	if not tex_files:
+		return NO_TEX, None
+	candidates = [tex for tex in tex_files if tex.starts_document]
+	if not candidates:
+		return NO_MAIN, None
+	roots = sorted((tex for tex in candidates if tex.is_complete), key=lambda tex: -tex.size)
+	if len(roots) > 1 and roots[0].size < MAIN_SIZE_RATIO * roots[1].size:
+		return MULTIPLE_ROOTS, None
+	return OK, min(candidates, key=lambda tex: (not tex.is_complete, tex.depth, -tex.size))
+
+
+def preflight(submission):
+	'''
+	Inspects an extracted submission (a .tex file, .zip or directory, see utils.extract)
+	without running anything, and returns a Triage saying whether latexmlc can
+	convert it and, if so, which file to give it.
+	'''
+
+	submission_id = os.path.basename(os.path.normpath(submission))
+	if not os.path.isdir(submission):
+		submission_id = os.path.splitext(submission_id)[0]
+
+	# A gzip-only submission: the single file is the main file, if it is LaTeX at all
+	if submission.endswith('.tex'):
+		with open(submission, 'rb') as f:
+			head = f.read(READ_BYTES)
+		if not head.strip():
+			return Triage(submission_id, EMPTY, None, None)
+		if head.startswith(NOT_LATEX_MAGIC) or b'\0' in head:
+			return Triage(submission_id, NOT_LATEX, None, repr(head[:8]))
+		return Triage(submission_id, OK, submission, None)
+
+	try:
+		if os.path.isdir(submission):
+			tex_files, others = directory_tex_files(submission)
+		else:
+			tex_files, others = zip_tex_files(submission)
+	except (OSError, zipfile.BadZipFile) as e:
+		return Triage(submission_id, UNREADABLE, None, str(e))
+	if not tex_files and not others:
+		return Triage(submission_id, EMPTY, None, None)
+	reason, main = find_main(tex_files)
+	if reason == MULTIPLE_ROOTS:
+		return Triage(submission_id, reason, None, ', '.join(tex.name for tex in tex_files if tex.is_complete))
+	if reason != OK:
+		return Triage(submission_id, reason, None, '{} .tex files, {} others'.format(len(tex_files), others))
+	# latexmlc looks for the main file of a .zip itself
+	if not os.path.isdir(submission):
+		return Triage(submission_id, OK, submission, main.name)
+	return Triage(submission_id, OK, os.path.join(submission, main.name), None)
+
+
+log_lock = threading.Lock()
+
+
+def record_failure(submission_id, reason, tar=None, stage='convert', detail=None, path=FAILURES_LOG):
+	'''
+	Appends a skipped or failed submission to the failures log, which
+	unlike logs/failed_conversions_log.txt is never overwritten.
+	'''
+
+	entry = {'submission': submission_id, 'tar': tar, 'stage': stage, 'reason': reason,
+		'detail': detail, 'time': time.time()}
+	with log_lock:
+		with open(path, 'a') as f:
+			f.write(json.dumps(entry) + '\n')
+
+
+def read_failures(path=FAILURES_LOG):
+	'''
+	Returns the entries of the failures log, e.g. to count them by reason.
+	'''
+
+	if not os.path.isfile(path):
+		return []
+	with open(path) as f:
+		return [json.loads(line) for line in f if line.strip()]
@@ -3,9 +3,20 @@ import gzip
 import shutil
 import os
 import glob
-import pathlib
 import zipfile
 import subprocess as sp
+import collections
+import resource
+import signal
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from identifier_index import as_index
+import latexml
+import conversion_cache
+import triage
+from scheduler import Scheduler, CostModel
+from ledger import get_ledger, DONE, FAILED, RUNNING
 
 
 def confirmDir(dir_name):
@@ -13,23 +24,62 @@ def confirmDir(dir_name):
 		os.makedirs(dir_name)
 
 
+def get_submission_id(path):
+	'''
+	Returns the arxiv id of an extracted submission, i.e. of a .tex or .zip file,
+	or of a directory, whose name keeps the dot of new-style ids.
+	'''
+
+	name = os.path.basename(os.path.normpath(path))
+	if os.path.isdir(path):
+		return name
+	return os.path.splitext(name)[0]
+
+
 def get_outpath(inpath):
 	'''
 	Returns the filepath for a XML file,
 	based on the given TEX filepath. 
 	'''
 
-	path_parts = pathlib.Path(inpath).parts
-	arxiv_id = os.path.splitext(path_parts[2])[0]
+	arxiv_id = get_submission_id(inpath)
 	confirmDir('xml')
 	outpath = 'xml/' + arxiv_id + '.xml'
 	return outpath
 
 
+# How tarred submissions are laid out for latexmlc: 'directory' copies their members
+# into a plain directory per submission, so latexmlc can be given its main file,
+# 'zip_stored' into an uncompressed .zip, and 'zip' recompresses them into a deflated .zip, as before
+EXTRACT_MODE = os.environ.get('ARXIV_EXTRACT_MODE', 'directory')
+EXTRACT_MODES = ('zip_stored', 'directory', 'zip')
+# Size of the buffer members are copied through, so no member is read into memory whole
+COPY_BUFFER = 1024 * 1024
+# A submission streamed from S3 is spooled to disk above this size, in bytes
+SPOOL_BYTES = 64 * 1024 * 1024
+
+# Drop the members of tarred submissions that latexmlc doesn't need, as the parser throws figures away
+FILTER_MEMBERS = True
+# Members always kept, whatever their size: what latexmlc needs to typeset the text
+KEEP_EXTENSIONS = ('.tex', '.ltx', '.bbl', '.bib', '.sty', '.cls', '.bst', '.clo', '.cfg', '.def')
+# Members always dropped: figures, and the data and archives they come in
+DROP_EXTENSIONS = ('.eps', '.ps', '.epsi', '.epsf', '.pdf', '.png', '.jpg', '.jpeg', '.gif', '.tif', '.tiff', '.bmp',
+	'.svg', '.ai', '.fits', '.fit', '.fts', '.gz', '.tgz', '.z', '.tar', '.zip')
+# Any other member larger than this is dropped too, in bytes (None for no cap)
+MAX_MEMBER_BYTES = 1024 ** 2
+# Leave an empty file in place of each dropped member, so \\includegraphics still finds it
+# and latexmlc sees the same files as without filtering
+STUB_DROPPED = True
+# Per-tar counts of what extraction kept and dropped, one tab-separated line per tar
+EXTRACT_STATS_LOG = 'logs/extract_stats.tsv'
+
+
 def extract(filepath, identifiers):
 	'''
 	Extracts astro-ph submissions from given tar filepath.
 	Logs which submissions belong to particular tarfile.
+	identifiers may be an IdentifierIndex (preferred, built once and shared
+	across workers) or any iterable of identifiers, e.g. Metadata.identifiers.
 	'''
 
 	# Quit if given file is not tarfile
@@ -37,117 +87,404 @@ def extract(filepath, identifiers):
 		# print('can\'t unzip {}, not a .tar file'.format(filepath))
 		return
 
+	# Open tarfile, read-only
+	# print('Extracting {}'.format(filepath))
+	with tarfile.open(filepath) as tar:
+		return extract_members(tar, filepath, identifiers)
+
+
+def extract_stream(fileobj, key, identifiers):
+	'''
+	Extracts astro-ph submissions from a tar that is still arriving over the network,
+	e.g. the body returned by Amazon_S3.open_stream(key). The tar is read once,
+	front to back, in stream mode: matching submissions are pulled out as their
+	bytes arrive, everything else is skipped without ever touching the disk.
+	'''
+
+	with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+		return extract_members(tar, key, identifiers, stream=True)
+
+
+def extract_members(tar, filepath, identifiers, stream=False, mode=EXTRACT_MODE):
+	'''
+	Iterates over the members of an open tar (random access or stream mode),
+	extracting the wanted submissions into latex/<tar name>/, laid out as given by mode.
+	Returns the number of submissions extracted.
+	'''
+
+	identifiers = as_index(identifiers)
+	ledger = get_ledger()
+	converted = ledger.names('submission', 'convert')
 	total_submissions_extracted = 0
+	stats = collections.Counter()
 	tar_dir = 'latex/' + os.path.splitext(os.path.basename(filepath))[0] 
 	confirmDir(tar_dir)
 	confirmDir('logs')
-		
-	# Open tarfile, read-only
-	# print('Extracting {}'.format(filepath))
-	tar = tarfile.open(filepath)
+
 	# Iterate over submissions, extracting only those that belong to the astro-ph category, 
 	# logging which submissions belong to which tarfile
 	with open(tar_dir + '.txt', 'w+') as logfile:
 		logfile.write('TARFILE: {}'.format(os.path.basename(filepath)))
-		for submission in tar.getmembers():
+		# Iterate lazily rather than with getmembers(), which would consume a stream
+		for submission in tar:
 			submission_id = os.path.splitext(os.path.basename(submission.name))[0]
 			# Note if submission is .pdf, we will skip this
 			if submission.name.endswith('.pdf'):
 				with open('logs/pdf_submissions.txt', 'a+') as pdf_logfile:
 					pdf_logfile.write(submission_id + '\n')
-			elif submission.name.endswith('.gz') and identifiers.str.contains(submission_id).any():
+			elif submission.name.endswith('.gz') and submission_id in identifiers:
 				logfile.write('\n' + submission_id)
 				submission_path = tar_dir + '/' + submission_id
 				# If it's been converted already, don't bother extracting it
-				if os.path.isfile(get_outpath(submission_path)):
+				if submission_id in converted:
 					# print('{} exists, already extracted and converted {}!'.format(get_outpath(submission_path), submission_id))
 					continue
-				# Extract the submission as a .gzip
-				try:   
-					# print('Extracting {}...'.format(submission_id)) 
-					# Extract and convert to .zip
-					gz_obj = tar.extractfile(submission)
-					gz = tarfile.open(fileobj=gz_obj)
-					zipf = zipfile.ZipFile(file=submission_path + '.zip', mode='a', compression=zipfile.ZIP_DEFLATED)                
-								
-					for m in gz: 
-						f = gz.extractfile(m)
-						if m.isdir():
-							continue
-						f_out = f.read()
-						f_in = m.name
-						zipf.writestr(f_in, f_out)
-					zipf.close()
-					gz.close()
-					total_submissions_extracted += 1
-				except tarfile.ReadError:
-					confirmDir('temp')
-					tar.extract(submission, 'temp')
-					with gzip.open('temp/' + submission.name, 'rb') as f_in:
-						with open(submission_path + '.tex', 'wb+') as f_out:
-							shutil.copyfileobj(f_in, f_out)
-							total_submissions_extracted += 1
-	tar.close()
-	# Delete the temporary folder for those wonky gz files
-	shutil.rmtree('temp/', ignore_errors=True)
+				# print('Extracting {}...'.format(submission_id)) 
+				gz_obj = tar.extractfile(submission)
+				# A stream can't seek back, so hold this one submission aside, on disk if it's large
+				if stream:
+					spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+					shutil.copyfileobj(gz_obj, spool, COPY_BUFFER)
+					spool.seek(0)
+					gz_obj = spool
+				with ledger.track('submission', submission_id, 'extract', parent=filepath) as job:
+					extract_submission(gz_obj, submission_path, mode, stats)
+					job['size'] = submission.size
+				total_submissions_extracted += 1
 	# print(filepath + ' extraction complete')
 	# print('Number of submissions obtained: ' + str(total_submissions_extracted))
+	log_extract_stats(filepath, total_submissions_extracted, stats)
+	return total_submissions_extracted
+
+
+def extract_submission(gz_obj, submission_path, mode=EXTRACT_MODE, stats=None):
+	'''
+	Extracts a single submission from the given seekable .gz file object.
+	Tarred submissions are laid out as given by mode (see EXTRACT_MODE), since latexmlc
+	reads .zip files and main .tex files but not tars, while the wonky gzip-only
+	submissions are a single .tex file. Members are copied through a COPY_BUFFER
+	sized buffer, so large figures are never held in memory, and filtered by
+	keep_member() if FILTER_MEMBERS is set. Returns a Counter of the members and
+	bytes kept and dropped, added to stats if given.
+	'''
+
+	if mode not in EXTRACT_MODES:
+		raise ValueError('Unknown extract mode ' + repr(mode))
+	stats = collections.Counter() if stats is None else stats
+	try:   
+		gz = tarfile.open(fileobj=gz_obj)
+	except tarfile.ReadError:
+		gz_obj.seek(0)
+		with gzip.GzipFile(fileobj=gz_obj, mode='rb') as f_in:
+			with open(submission_path + '.tex', 'wb+') as f_out:
+				shutil.copyfileobj(f_in, f_out, COPY_BUFFER)
+				stats['members_kept'] += 1
+				stats['bytes_kept'] += f_out.tell()
+		return stats
+	with gz:
+		if mode == 'directory':
+			extract_to_directory(gz, submission_path, stats)
+		else:
+			compression = zipfile.ZIP_STORED if mode == 'zip_stored' else zipfile.ZIP_DEFLATED
+			extract_to_zip(gz, submission_path + '.zip', compression, stats)
+	return stats
+
+
+def keep_member(member):
+	'''
+	Whether a member of a tarred submission is worth handing to latexmlc,
+	going by KEEP_EXTENSIONS, DROP_EXTENSIONS and MAX_MEMBER_BYTES.
+	'''
+
+	extension = os.path.splitext(member.name)[1].lower()
+	if extension in KEEP_EXTENSIONS:
+		return True
+	if extension in DROP_EXTENSIONS:
+		return False
+	return MAX_MEMBER_BYTES is None or member.size <= MAX_MEMBER_BYTES
+
+
+def filter_members(gz, stats):
+	'''
+	Yields (member, keep) for each regular file in a tarred submission, counting them in stats.
+	'''
+
+	for m in gz:
+		if not m.isfile():
+			continue
+		keep = not FILTER_MEMBERS or keep_member(m)
+		outcome = 'kept' if keep else 'dropped'
+		stats['members_' + outcome] += 1
+		stats['bytes_' + outcome] += m.size
+		if keep or STUB_DROPPED:
+			yield m, keep
+
+
+def extract_to_zip(gz, zip_path, compression, stats):
+	with zipfile.ZipFile(zip_path, mode='w', compression=compression, allowZip64=True) as zipf:
+		for m, keep in filter_members(gz, stats):
+			info = zipfile.ZipInfo(m.name, time.localtime()[:6])
+			info.compress_type = compression
+			if not keep:
+				zipf.writestr(info, b'')
+				continue
+			# Known up front, so zipfile decides on zip64 before writing
+			info.file_size = m.size
+			with gz.extractfile(m) as f_in, zipf.open(info, 'w') as f_out:
+				shutil.copyfileobj(f_in, f_out, COPY_BUFFER)
+
+
+def extract_to_directory(gz, directory, stats):
+	confirmDir(directory)
+	root = os.path.realpath(directory)
+	for m, keep in filter_members(gz, stats):
+		path = os.path.realpath(os.path.join(root, m.name))
+		# Never write outside the submission's directory
+		if not path.startswith(root + os.sep):
+			print('Skipping {} in {}'.format(m.name, directory))
+			continue
+		confirmDir(os.path.dirname(path))
+		with open(path, 'wb') as f_out:
+			if keep:
+				with gz.extractfile(m) as f_in:
+					shutil.copyfileobj(f_in, f_out, COPY_BUFFER)
+
+
+def log_extract_stats(filepath, submissions, stats):
+	'''
+	Appends the members and bytes kept and dropped from a tar to EXTRACT_STATS_LOG.
+	'''
+
+	columns = ['members_kept', 'bytes_kept', 'members_dropped', 'bytes_dropped']
+	is_new = not os.path.isfile(EXTRACT_STATS_LOG)
+	with open(EXTRACT_STATS_LOG, 'a') as f:
+		if is_new:
+			f.write('\t'.join(['tar', 'submissions'] + columns) + '\n')
+		f.write('\t'.join([os.path.basename(filepath), str(submissions)] + [str(stats[column]) for column in columns]) + '\n')
+	if stats['bytes_dropped']:
+		print('{}: kept {:.1f} MB, dropped {:.1f} MB of figures and data'.format(
+			os.path.basename(filepath), stats['bytes_kept'] / 1024 ** 2, stats['bytes_dropped'] / 1024 ** 2))
 
 
 def get_submissions_to_convert(base_path):
 	'''
 	Returns a list of strings. Each string 
-	is a path to a submission directory or .tex file within
+	is a path to a submission directory, .zip or .tex file within
 	the tar directory that has not yet been converted to XML,
-	or attempted to be converted (as evidenced by existence of logfile)
+	or attempted to be converted (as recorded in the ledger)
 	'''
 	
-	submissions = glob.glob(base_path + '/*[.tex|.zip]')
+	submissions = [path for path in glob.glob(base_path + '/*')
+		if path.endswith(('.tex', '.zip')) or os.path.isdir(path)]
+	attempted = get_ledger().names('submission', 'convert', (DONE, FAILED))
 	submissions_to_convert = []
 
 	for submission_path in submissions:
-		outpath = get_outpath(submission_path)
-		logfile_path = 'logs/' + os.path.splitext(os.path.basename(submission_path))[0] + '.txt'
-		if not os.path.isfile(outpath) and not os.path.isfile(logfile_path):
+		if get_submission_id(submission_path) not in attempted:
 			submissions_to_convert.append(submission_path)
 
 	# print('{} submissions already converted, {} submissions still to be converted...'.format(len(submissions) - len(submissions_to_convert), len(submissions_to_convert)))
 	return submissions_to_convert
 
 
-def convert(tar_path):
+# latexmlc processes run at once per tar being converted, overridden by ARXIV_LATEXMLC_THREADS.
+# main.py converts CONVERT_WORKERS (2) tars at once, so by default each gets half the CPUs
+LATEXMLC_THREADS = int(os.environ.get('ARXIV_LATEXMLC_THREADS', 0)) or max(1, (os.cpu_count() or 1) // 2)
+# Wall-clock limit after which a latexmlc process group is killed
+HARD_TIMEOUT = 300
+# Address space limit for each latexmlc process, in bytes
+MEMORY_LIMIT = 4 * 1024 ** 3
+# Reuse XML converted from identical submissions, see conversion_cache.py
+USE_CONVERSION_CACHE = True
+
+# Outcome of converting a single submission
+ConversionResult = collections.namedtuple('ConversionResult', ['submission_id', 'status', 'returncode', 'seconds'])
+
+
+def run_latexmlc(command, logfile, timeout=HARD_TIMEOUT, memory_limit=MEMORY_LIMIT, processes=None, governor=None, memory_pid=None):
+	'''
+	Runs given latexmlc command in its own process group, so that it and
+	anything it spawns (e.g. image converters) can be killed together on timeout.
+	Returns the exit code, raising subprocess.TimeoutExpired after killing the group.
+	processes, if given, is a set the running Popen is kept in, for interrupts.
+	The child runs under the given address space limit. If a ResourceGovernor
+	is given, the command only starts once it admits it, and the timeout runs from then.
+	The governor accounts for the memory of memory_pid, e.g. a latexmls server doing
+	the work, if given, else of the child.
+	'''
+
+	slot = governor.admit('convert') if governor is not None else None
+	try:
+		proc = sp.Popen(command, stdout=sp.DEVNULL, stderr=logfile, start_new_session=True,
+			preexec_fn=child_limits(memory_limit))
+	except BaseException:
+		if slot is not None:
+			governor.release(slot)
+		raise
+	if processes is not None:
+		processes.add(proc)
+	try:
+		if slot is not None:
+			governor.attach(slot, memory_pid or proc.pid)
+		try:
+			return proc.wait(timeout=timeout)
+		except sp.TimeoutExpired:
+			kill_group(proc)
+			raise
+	finally:
+		if processes is not None:
+			processes.discard(proc)
+		if slot is not None:
+			governor.release(slot)
+
+
+def child_limits(memory_limit):
 	'''
-	Converts submission into XML, calling 
+	Returns a function that sets the address space limit in the child itself,
+	between fork and exec, so nothing it allocates or spawns escapes it.
+	'''
+
+	def apply():
+		if memory_limit:
+			resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+	return apply
+
+
+def kill_group(proc):
+	try:
+		os.killpg(proc.pid, signal.SIGKILL)
+	except ProcessLookupError:
+		pass
+	proc.wait()
+
+
+def convert_submission(submission, tar_key=None, timeout=HARD_TIMEOUT, memory_limit=MEMORY_LIMIT, processes=None, backend=None, cache=None, governor=None):
+	'''
+	Converts a single submission into XML with the given latexml backend,
+	recording the attempt in the ledger. Returns a ConversionResult.
+	If a ConversionCache is given, identical submissions are converted only once,
+	and a ResourceGovernor is passed on to run_latexmlc. Submissions that
+	triage.preflight finds latexmlc can't convert are skipped; those and
+	failed conversions are added to the failures log.
+	'''
+
+	ledger = get_ledger()
+	backend = backend or latexml.OneShotBackend()
+	# Get its outpath
+	outpath = get_outpath(submission)
+	submission_id = get_submission_id(submission)
+	logfile_path = 'logs/' + submission_id + '.txt'
+	returncode = None
+	starttime = time.time()
+	ledger.start('submission', submission_id, 'convert', parent=tar_key)
+	try:
+		# Skip what is bound to fail, rather than wait for the timeout
+		checked = triage.preflight(submission)
+		if checked.reason != triage.OK:
+			print('Skipping {}: {}'.format(submission_id, checked.reason))
+			ledger.fail('submission', submission_id, 'convert', checked.reason)
+			triage.record_failure(submission_id, checked.reason, tar_key, 'triage', checked.detail)
+			return ConversionResult(submission_id, checked.reason, None, time.time() - starttime)
+		# Reuse the XML of an identical submission, e.g. a revision repeated in a later tar
+		if cache is not None:
+			key = conversion_cache.submission_hash(submission)
+			if cache.get(key, outpath):
+				ledger.finish('submission', submission_id, 'convert', size=os.path.getsize(outpath))
+				return ConversionResult(submission_id, 'cached', None, time.time() - starttime)
+		# latexmlc is given the main .tex file of a directory, and finds the rest next to it
+		source = checked.main
+		# latexmlc's own timeout keeps the same share of the wall-clock limit
+		latexmlc_timeout = max(1, int(timeout * latexml.LATEXMLC_TIMEOUT / HARD_TIMEOUT))
+		# print('Converting {} to {}...'.format(submission, outpath))
+		slot = backend.acquire()
+		try:
+			# With a latexmls server, the server does the work and holds the memory
+			with open(logfile_path, 'w+') as logfile:
+				returncode = run_latexmlc(backend.command(source, outpath, slot, latexmlc_timeout), logfile, timeout, memory_limit, processes, governor,
+					backend.worker_pid(slot))
+			# If the server couldn't be reached, convert it the old way
+			if not os.path.isfile(outpath) and backend.failed_to_connect(slot, logfile_path):
+				with open(logfile_path, 'w+') as logfile:
+					returncode = run_latexmlc(backend.command(source, outpath, timeout=latexmlc_timeout), logfile, timeout, memory_limit, processes, governor)
+		finally:
+			backend.release(slot)
+		print('Writing logfile for ' + submission_id)
+		if os.path.isfile(outpath):
+			status = 'done'
+			if cache is not None:
+				cache.put(key, outpath)
+			ledger.finish('submission', submission_id, 'convert', size=os.path.getsize(outpath))
+		else:
+			status = 'NoOutput'
+			ledger.fail('submission', submission_id, 'convert', status)
+			triage.record_failure(submission_id, status, tar_key, detail='returncode {}'.format(returncode))
+	except sp.TimeoutExpired: # prevents hanging, for now
+		print(submission_id + ' timed out!')
+		status = 'TimeoutExpired'
+		ledger.fail('submission', submission_id, 'convert', status)
+		triage.record_failure(submission_id, status, tar_key, detail='{}s'.format(timeout))
+	except Exception as e:
+		print('Something went wrong in convert(): {}'.format(e))
+		status = type(e).__name__
+		ledger.fail('submission', submission_id, 'convert', e)
+		triage.record_failure(submission_id, status, tar_key, detail=str(e))
+	return ConversionResult(submission_id, status, returncode, time.time() - starttime)
+
+
+def convert(tar_path, workers=LATEXMLC_THREADS, timeout=HARD_TIMEOUT, memory_limit=MEMORY_LIMIT, backend=None, cache=None, governor=None):
+	'''
+	Converts submissions into XML, calling 
 	latexmlc --dest=[output_file] [input_file]
 	Latexmlc will be able to extract ZIPs (not Tars unfortunately)
 	https://github.com/brucemiller/LaTeXML/issues/1091
+	Up to workers latexmlc processes run at once, each under the given
+	memory limit, longest estimated first (see scheduler.py), each with a wall-clock
+	limit of timeout. backend defaults to latexml.get_backend(),
+	i.e. persistent latexmls servers when available. cache defaults to the
+	conversion cache when USE_CONVERSION_CACHE is set. A ResourceGovernor, if given,
+	holds back latexmlc processes while memory is short, see governor.py.
+	Returns a list of ConversionResult, in the order they finished.
 	'''
 
 	confirmDir('logs')
+	tar_key = 'src/' + os.path.basename(os.path.normpath(tar_path)) + '.tar'
 	submissions = get_submissions_to_convert(tar_path)
+	processes = set()
+	futures = {}
+	backend = backend or latexml.get_backend(slots=workers)
+	if cache is None and USE_CONVERSION_CACHE:
+		cache = conversion_cache.get_cache()
 
-	for submission in submissions:
-		# Get its outpath
-		outpath = get_outpath(submission)
-		submission_id = os.path.splitext(os.path.basename(outpath))[0]
-		logfile_path = 'logs/' + submission_id + '.txt'
-		try:
-			# print('Converting {} to {}...'.format(submission, outpath))
-			with open(logfile_path, 'w+') as logfile:
-				sp.call(['latexmlc', '--timeout=240', '--dest=' + outpath, submission], timeout=300, stderr=logfile)
-			print('Writing logfile for ' + submission_id)
-		except sp.TimeoutExpired: # prevents hanging, for now
-			print(submission_id + 'timed out!')
-			with open('logs/failed_conversions_log.txt', 'w+') as failed_logfile:
-				failed_logfile.write(submission_id + '\n')
-		except KeyboardInterrupt:
-			# If I interrupt the conversion, remove the logfile so it can be reattempted
-			print('You interrupted convert()!')
-			print('Removing ' + logfile_path)
-			os.remove(logfile_path)
-			raise
-		except Exception as e:
-			print('Something went wrong in convert(): ' + e)
-			raise
+	scheduler = Scheduler(CostModel.from_ledger(), hard_timeout=timeout)
+	results = []
 
+	# Each thread just supervises its latexmlc process, which does the actual work
+	executor = ThreadPoolExecutor(max_workers=workers)
 
+	try:
+		for job in scheduler.plan(submissions):
+			futures[executor.submit(convert_submission, job.submission, tar_key, job.timeout, memory_limit, processes, backend, cache, governor)] = job
+		for future in as_completed(futures):
+			result = future.result()
+			scheduler.record(futures[future], result)
+			results.append(result)
+		return results
+	except KeyboardInterrupt:
+		# If I interrupt the conversion, forget the attempts so they can be reattempted
+		print('You interrupted convert()!')
+		for future in futures:
+			future.cancel()
+		for proc in list(processes):
+			kill_group(proc)
+		ledger = get_ledger()
+		for submission in submissions:
+			submission_id = get_submission_id(submission)
+			if ledger.status('submission', submission_id, 'convert') == RUNNING:
+				ledger.reset('submission', submission_id, 'convert')
+				if os.path.isfile('logs/' + submission_id + '.txt'):
+					print('Removing logs/' + submission_id + '.txt')
+					os.remove('logs/' + submission_id + '.txt')
+		raise
+	finally:
+		executor.shutdown(wait=False)